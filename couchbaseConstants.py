@@ -162,6 +162,13 @@ FLAG_DCP_CONSUMER = 0x00
 FLAG_DCP_PRODUCER = 0x01
 FLAG_DCP_XATTRS = 0x04
 
+# DCP end stream flags
+FLAG_DCP_END_STREAM_OK = 0x00
+FLAG_DCP_END_STREAM_CLOSED = 0x01
+FLAG_DCP_END_STREAM_STATE_CHANGED = 0x02
+FLAG_DCP_END_STREAM_DISCONNECTED = 0x03
+FLAG_DCP_END_STREAM_TOO_SLOW = 0x04
+
 # DCP control keys
 KEY_DCP_CONNECTION_BUFFER_SIZE = b"connection_buffer_size"
 KEY_DCP_STREAM_BUFFER_SIZE = b"stream_buffer_size"
@@ -241,6 +248,7 @@ DCP_DELETE_PKT_FMT = ">QQH"
 DCP_VB_UUID_SEQNO_PKT_FMT = ">QQ"
 DCP_VB_SEQNO_PKT_FMT = ">Q"
 DCP_SNAPSHOT_PKT_FMT = ">QQI"
+DCP_END_STREAM_PKT_FMT = ">I"
 DCP_EXTRA_META_PKG_FMT = ">BH"
 
 DCP_EXTRA_META_VERSION = 0x01
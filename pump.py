@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
+import asyncio
 import base64
 import copy
 import http.client
+import importlib
 import json
 import logging
+import multiprocessing
+import multiprocessing.managers
 import os
 import queue
 import re
@@ -17,16 +21,32 @@ import urllib.error
 import urllib.parse
 import urllib.request
 import zlib
-from collections import defaultdict
-from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from collections import defaultdict, deque
+from types import ModuleType
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union
 
 import snappy  # pylint: disable=import-error
 
 import cb_bin_client
 import couchbaseConstants
+import pump_checkpoint
+import pump_checksum
+import pump_coalesce
+import pump_filter
+import pump_memory
+import pump_metrics
+import pump_profile
+import pump_ratelimit
+import pump_topology
 from cb_util import tag_user_data
 from cluster_manager import ClusterManager
 
+numpy: Optional[ModuleType]
+try:
+    numpy = importlib.import_module('numpy')
+except ImportError:
+    numpy = None
+
 # TODO: (1) optionally log into backup directory
 
 LOGGING_FORMAT = '%(asctime)s: %(threadName)s %(message)s'
@@ -41,10 +61,13 @@ class Batch(object):
         self.source = source
         self.msgs: List[couchbaseConstants.BATCH_MSG] = []
         self.bytes: int = 0
+        # The bytes each msg was counted with, in the order of msgs.
+        self.msg_bytes: List[int] = []
         self.adjust_size: int = 0
 
     def append(self, msg: couchbaseConstants.BATCH_MSG, num_bytes: int):
         self.msgs.append(msg)
+        self.msg_bytes.append(num_bytes)
         self.bytes = self.bytes + num_bytes
 
     def size(self) -> int:
@@ -54,25 +77,53 @@ class Batch(object):
         return self.msgs[i]
 
     def group_by_vbucket_id(self, vbuckets_num, rehash=0) -> Dict[int, List[couchbaseConstants.BATCH_MSG]]:
-        """Returns dict of vbucket_id->[msgs] grouped by msg's vbucket_id."""
+        """Returns dict of vbucket_id->[msgs] grouped by msg's vbucket_id. The
+           msgs are not rebuilt, so a msg's own vbucket_id may differ from the
+           one it is grouped under when that was hashed from its key."""
         g: Dict[int, List[couchbaseConstants.BATCH_MSG]] = defaultdict(list)
-        for msg in self.msgs:
-            cmd, vbucket_id, key = msg[:3]
-            if vbucket_id == 0x0000ffff or rehash == 1:
-                if self.source.opts.collection:
-                    # Collections embeds the ID into the key field, but does not
-                    # hash the ID as part of VB hashing
-                    key = cb_bin_client.skip_collection_id(key)
-
-                if isinstance(key, str):
-                    key = key.encode()
-                # Special case when the source did not supply a vbucket_id
-                # (such as stdin source), so we calculate it.
-                vbucket_id = ((zlib.crc32(key) >> 16) & 0x7FFF) % vbuckets_num
-                msg = (cmd, vbucket_id) + msg[2:]  # type: ignore
+        for msg, vbucket_id in zip(self.msgs, self.vbucket_ids(vbuckets_num, rehash)):
             g[vbucket_id].append(msg)
         return g
 
+    def vbucket_ids(self, vbuckets_num, rehash=0) -> List[int]:
+        """Returns every msg's vbucket_id, hashing the keys of all msgs whose
+           source did not supply one (such as stdin source) in one go, or of
+           all msgs when rehash is 1."""
+        msgs = self.msgs
+        vbucket_ids = [msg[1] for msg in msgs]
+        if rehash == 1:
+            indexes: Sequence[int] = range(len(vbucket_ids))
+        else:
+            indexes = [i for i, vbucket_id in enumerate(vbucket_ids) if vbucket_id == 0x0000ffff]
+        if not indexes:
+            return vbucket_ids
+
+        keys: List[Union[str, bytes]] = [msgs[i][2] for i in indexes]
+        if self.source.opts.collection:
+            # Collections embeds the ID into the key field, but does not
+            # hash the ID as part of VB hashing
+            keys = [cb_bin_client.skip_collection_id(key.encode() if isinstance(key, str) else key) for key in keys]
+
+        hashed = hash_vbucket_ids(keys, vbuckets_num)
+        if rehash == 1:
+            return hashed
+        for i, vbucket_id in zip(indexes, hashed):
+            vbucket_ids[i] = vbucket_id
+        return vbucket_ids
+
+
+def hash_vbucket_ids(keys: Sequence[Union[str, bytes]], vbuckets_num: int) -> List[int]:
+    """Returns the vbucket_id that each key hashes to. crc32 is still called
+       once per key; with numpy, the shift, mask and modulo of all the crcs
+       are done together."""
+    crc32 = zlib.crc32
+    # Some sources, such as stdin source, supply str keys.
+    data = [key.encode() if isinstance(key, str) else key for key in keys]
+    if numpy is not None:
+        crcs = numpy.fromiter(map(crc32, data), dtype=numpy.uint32, count=len(data))
+        return (((crcs >> 16) & 0x7FFF) % vbuckets_num).tolist()
+    return [((crc32(key) >> 16) & 0x7FFF) % vbuckets_num for key in data]
+
 
 class SinkBatchFuture(object):
     """Future completion of a sink consuming a batch."""
@@ -82,11 +133,30 @@ class SinkBatchFuture(object):
         self.batch = batch
         self.done = threading.Event()
         self.done_rv = None
+        self.lock = threading.Lock()
+        self.callbacks: List[Callable[[Any], None]] = []
 
     def wait_until_consumed(self):
         self.done.wait()
         return self.done_rv
 
+    def add_done_callback(self, callback: Callable[[Any], None]):
+        """Calls callback with the result once the batch is consumed, from the
+           thread that finishes the future, or right away if it already is."""
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self.done_rv)
+
+    def set_done(self, rv):
+        with self.lock:
+            self.done_rv = rv
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(rv)
+
 
 # --------------------------------------------------
 
@@ -123,6 +193,13 @@ class ProgressReporter(object):
                 per_sec = f'{(c[k] - p[k]) / delta:0.1f}'
                 emit(f'{prefix} {k.replace("tot_sink_", ""):<{width_k}} : {c[k]!s:>{width_v}} | '
                      f'{(c[k]-p[k])!s:>{width_d}} | {per_sec:>{width_s}}')
+        if c.get(pump_coalesce.COALESCE_MSG):
+            emit(f'{prefix} coalesced : {c[pump_coalesce.COALESCE_MSG]} msgs, '
+                 f'{c[pump_coalesce.COALESCE_BYTE]} bytes')
+        memory = getattr(self, "memory", None)
+        if memory:
+            used, peak, limit = memory.usage()
+            emit(f'{prefix} memory : {used} bytes in use of {limit}, peak: {peak}')
         self.prev_time = cur_time
         self.prev = copy.copy(c)
 
@@ -140,9 +217,70 @@ class ProgressReporter(object):
                 f'msgs){cr}')
 
 
+class SharedCtl(object):
+    """The ctl dict of a PumpingStation, shared with its worker processes
+       through a multiprocessing manager."""
+
+    def __init__(self, manager, ctl: Dict[str, Any]):
+        self.values = manager.dict(ctl)
+        self.lock = manager.Lock()
+
+    def __getitem__(self, key: str) -> Any:
+        return self.values[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self.values[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.values
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.values.get(key, default)
+
+    def add(self, key: str, n: int):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+class PumpManager(multiprocessing.managers.SyncManager):
+    """Serves the objects that PumpingStation shares with worker processes."""
+
+
+# The manager generates these proxy types at runtime, so pylint cannot see them.
+# pylint: disable=no-member
+PumpManager.register('Checkpoint', pump_checkpoint.Checkpoint)
+PumpManager.register('Digests', pump_checksum.Digests)
+PumpManager.register('MemoryBudget', pump_memory.MemoryBudget)
+PumpManager.register('Metrics', pump_metrics.Metrics)
+PumpManager.register('RateLimiter', pump_ratelimit.RateLimiter)
+# pylint: enable=no-member
+
+
+def add_ctl(ctl, key: str, n: int):
+    """Adds n to a ctl counter, atomically when ctl is shared between processes."""
+    if isinstance(ctl, SharedCtl):
+        ctl.add(key, n)
+    else:
+        ctl[key] = ctl.get(key, 0) + n
+
+
+def estimated_total(estimate: int, adjust: int, current: int) -> int:
+    """The total msgs of a progress bar: the estimate, adjusted by the msgs
+       the sources found to be extra or left out, but never less than the
+       current msgs. 0, for no bar, when there is no estimate to adjust."""
+    if not estimate:
+        return 0
+    return max(current, estimate + adjust)
+
+
 class PumpingStation(ProgressReporter):
     """Queues and watchdogs multiple pumps across concurrent workers."""
 
+    # How many times, FOLLOW_WAIT seconds apart, the source bucket config is
+    # fetched to find the new node of a moved vbucket.
+    FOLLOW_ATTEMPTS = 10
+    FOLLOW_WAIT = 1.0
+
     def __init__(self, opts, source_class, source_spec, sink_class, sink_spec):
         self.opts = opts
         self.source_class = source_class
@@ -150,17 +288,106 @@ class PumpingStation(ProgressReporter):
         self.sink_class = sink_class
         self.sink_spec = sink_spec
         self.queue = None
+        self.pool = None
+        self.manager = None
+        self.metrics = pump_metrics.Metrics()
+        self.limiter = pump_ratelimit.RateLimiter.from_opts(opts)
+        # Bounds the bytes buffered by all the pumps, with -x memory_budget.
+        self.memory = pump_memory.MemoryBudget.from_opts(opts)
+        self.exporter: Optional[pump_metrics.MetricsExporter] = None
+        self.checkpoint: Optional[pump_checkpoint.Checkpoint] = None
+        self.checkpoint_writer: Optional[pump_checkpoint.CheckpointWriter] = None
+        # Per-vbucket digests of the documents transferred, with -x checksum=1
+        # or --verify.
+        self.digests: Optional[pump_checksum.Digests] = None
+        if int(opts.extra.get("checksum", 0)) or getattr(opts, "verify", False):
+            self.digests = pump_checksum.Digests()
+        # The times the units of each source node were re-queued after failing.
+        self.node_retries: Dict[str, int] = defaultdict(int)
+        # The buckets whose msgs are being transferred, by name.
+        self.transfers: Dict[Any, BucketTransfer] = {}
+        # The sink map of each source bucket, when a bucket_map renames them.
+        self.sink_maps: Dict[Any, Any] = {}
+        # Counts the units put to the workers that haven't been merged back by
+        # unit_done yet; waited on, together with units_done, by wait_for_units.
+        self.units_outstanding = 0
+        self.units_done = threading.Condition()
         tmstamp = time.strftime("%Y-%m-%dT%H%M%SZ", time.gmtime())
         self.ctl = {'stop': False,
                     'rv': 0,
                     'new_session': True,
-                    'new_timestamp': tmstamp}
+                    'new_timestamp': tmstamp,
+                    'metrics': self.metrics,
+                    'limiter': self.limiter,
+                    'memory': self.memory,
+                    'digests': self.digests}
         self.cur = defaultdict(int)
 
     def run(self):
+        rv = self.init_checkpoint()
+        if rv != 0:
+            return rv
+        if getattr(self.opts, "processes", False):
+            # A forked process only has the thread that forked it, so the
+            # workers are forked before any helper thread starts.
+            self.start_processes()
+        metrics_file = self.opts.extra.get("metrics_file", "")
+        if metrics_file:
+            self.exporter = pump_metrics.MetricsExporter(metrics_file,
+                                                         float(self.opts.extra.get("metrics_interval", 10)),
+                                                         lambda: self.metrics.snapshot(),
+                                                         self.metrics_counters)
+            self.exporter.start()
+        if self.checkpoint_writer:
+            self.checkpoint_writer.start()
+        try:
+            return self.transfer()
+        finally:
+            if self.exporter:
+                self.exporter.stop()
+            if self.checkpoint_writer:
+                self.checkpoint_writer.stop()
+            self.stop_workers()
+            pump_profile.stop_sampler()
+
+    def init_checkpoint(self) -> couchbaseConstants.PUMP_ERROR:
+        """Loads the checkpoint given with --resume, and sets up the periodic
+           save of progress to it, or to the checkpoint_file if one is given.
+           Without either, progress is still kept in memory when node_retry
+           or topology_interval is set, for re-queued units and units that
+           follow moved vbuckets to resume from."""
+        resume = getattr(self.opts, "resume", None)
+        path = self.opts.extra.get("checkpoint_file", "") or resume
+        if resume:
+            rv, self.checkpoint = pump_checkpoint.Checkpoint.load(resume)
+            if rv != 0:
+                return rv
+            logging.info(f'resuming from checkpoint: {resume}')
+        elif path or int(self.opts.extra.get("node_retry", 0)) > 0 or \
+                float(self.opts.extra.get("topology_interval", 0)) > 0:
+            self.checkpoint = pump_checkpoint.Checkpoint()
+        if not self.checkpoint:
+            return 0
+
+        self.ctl['checkpoint'] = self.checkpoint
+        if not path:
+            return 0
+        self.checkpoint_writer = pump_checkpoint.CheckpointWriter(
+            float(self.opts.extra.get("checkpoint_interval", 10)),
+            lambda: self.checkpoint.save(path))  # type: ignore
+        return 0
+
+    def metrics_counters(self) -> Dict[str, int]:
+        with self.units_done:
+            counters = {k: v for k, v in self.cur.items() if isinstance(v, int)}
+        counters['run_msg'] = self.ctl.get('run_msg', 0)
+        counters['tot_msg'] = self.ctl.get('tot_msg', 0)
+        if self.memory:
+            counters['memory_used'], counters['memory_peak'], _ = self.memory.usage()
+        return counters
+
+    def transfer(self):
         # TODO: (6) PumpingStation - monitor source for topology changes.
-        # TODO: (4) PumpingStation - retry on err N times, M times / server.
-        # TODO: (2) PumpingStation - track checksum in backup, for later restore.
 
         rv, source_map, sink_map = self.check_endpoints()
         if rv != 0:
@@ -177,40 +404,99 @@ class PumpingStation(ProgressReporter):
                 return f'error: there is no bucket: {bucket_source} at source: {self.source_spec}'
             return f'error: no transferable buckets at source: {self.source_spec}'
 
-        for source_bucket in sorted(source_buckets,
-                                    key=lambda b: b['name']):
-            logging.info(f'bucket: {source_bucket["name"]}')
+        rv = self.transfer_buckets(sorted(source_buckets, key=lambda b: b['name']), source_map, sink_map)
+        if rv != 0:
+            return rv
 
-            if not self.opts.extra.get("design_doc_only", 0):
-                rv = self.transfer_bucket_msgs(source_bucket, source_map, sink_map)
+        # TODO: (4) PumpingStation - validate source/sink maps were stable.
+
+        sys.stderr.write("done\n")
+        return 0
+
+    def transfer_buckets(self, source_buckets: List[Dict[str, Any]], source_map,
+                         sink_map) -> couchbaseConstants.PUMP_ERROR:
+        """Transfers up to bucket_concurrency buckets at a time, whose units
+           share the workers. As soon as one bucket's units are all done, its
+           design docs and index definitions follow and the next bucket
+           starts."""
+        concurrency = max(1, int(self.opts.extra.get("bucket_concurrency", 1)))
+        active: List[BucketTransfer] = []
+        rv: couchbaseConstants.PUMP_ERROR = 0
+        while rv == 0 and (source_buckets or active):
+            while source_buckets and len(active) < concurrency:
+                source_bucket = source_buckets.pop(0)
+                logging.info(f'bucket: {source_bucket["name"]}')
+                bucket_sink_map = self.sink_maps.get(source_bucket['name'], sink_map)
+                if self.opts.extra.get("design_doc_only", 0):
+                    sys.stderr.write("transfer design doc only. bucket msgs will be skipped.\n")
+                    rv = self.finish_bucket(source_bucket, source_map, bucket_sink_map)
+                    if rv != 0:
+                        break
+                    continue
+                rv, transfer = self.start_bucket_msgs(source_bucket, source_map, bucket_sink_map, concurrency)
+                if transfer:
+                    active.append(transfer)
                 if rv != 0:
-                    return rv
-            else:
-                sys.stderr.write("transfer design doc only. bucket msgs will be skipped.\n")
-
-            if not self.opts.extra.get("data_only", 0):
-                rv = self.transfer_bucket_design(source_bucket, source_map, sink_map)
-                if rv:
-                    logging.warn(rv)
-                rv = self.transfer_bucket_index(source_bucket, source_map, sink_map)
-                if rv:
-                    logging.warn(rv)
-                rv = self.transfer_bucket_fts_index(source_bucket, source_map, sink_map)
-                if rv:
-                    logging.warn(rv)
-                rv = self.transfer_fts_alias(source_bucket, source_map, sink_map)
-                if rv:
-                    logging.warn(rv)
+                    break
+                if transfer:
+                    self.start_metadata(transfer)
+            if rv != 0 or not active:
+                continue
 
+            transfer = self.wait_for_bucket(active)
+            active.remove(transfer)
+            rv = self.finish_bucket_msgs(transfer)
+            if rv == 0:
+                rv = self.finish_bucket(transfer.source_bucket, source_map, transfer.sink_map, transfer)
+
+        if active:
+            # Stop the buckets still transferring after another one failed.
+            self.ctl['stop'] = True
+            self.wait_for_units()
+            for transfer in active:
+                self.end_bucket(transfer)
+        return rv
+
+    def finish_bucket(self, source_bucket: Dict[str, Any], source_map, sink_map,
+                      transfer: Optional['BucketTransfer'] = None) -> couchbaseConstants.PUMP_ERROR:
+        """Transfers a bucket's design docs and index definitions once its
+           msgs are transferred, unless they already were alongside them, and
+           checks its digests."""
+        if not self.opts.extra.get("data_only", 0):
+            if transfer and transfer.metadata:
+                transfer.metadata.join()
             else:
-                sys.stderr.write("transfer data only. bucket design docs and index meta will be skipped.\n")
+                self.transfer_bucket_metadata(source_bucket, source_map, sink_map)
 
-            # TODO: (5) PumpingStation - validate bucket transfers.
+        else:
+            sys.stderr.write("transfer data only. bucket design docs and index meta will be skipped.\n")
 
-        # TODO: (4) PumpingStation - validate source/sink maps were stable.
+        return self.check_digests(source_bucket, source_map)
 
-        sys.stderr.write("done\n")
-        return 0
+    def start_metadata(self, transfer: 'BucketTransfer'):
+        """Transfers a bucket's design docs and index definitions in the
+           background while its msgs are pumped, when the sink allows it, so
+           that their REST round trips don't add to the transfer time."""
+        if self.opts.extra.get("data_only", 0) or not self.sink_class.overlap_metadata(self.opts):
+            return
+        transfer.metadata = threading.Thread(target=self.transfer_bucket_metadata,
+                                             args=(transfer.source_bucket, transfer.source_map, transfer.sink_map),
+                                             name="metadata", daemon=True)
+        transfer.metadata.start()
+
+    def transfer_bucket_metadata(self, source_bucket: Dict[str, Any], source_map, sink_map):
+        rv = self.transfer_bucket_design(source_bucket, source_map, sink_map)
+        if rv:
+            logging.warn(rv)
+        rv = self.transfer_bucket_index(source_bucket, source_map, sink_map)
+        if rv:
+            logging.warn(rv)
+        rv = self.transfer_bucket_fts_index(source_bucket, source_map, sink_map)
+        if rv:
+            logging.warn(rv)
+        rv = self.transfer_fts_alias(source_bucket, source_map, sink_map)
+        if rv:
+            logging.warn(rv)
 
     def check_endpoints(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Dict[str, Any], Dict[str, Any]]:
         logging.debug(f'source_class: {self.source_class}')
@@ -225,6 +511,20 @@ class PumpingStation(ProgressReporter):
         rv = self.sink_class.check_base(self.opts, self.sink_spec)
         if rv != 0:
             return rv, {}, {}
+
+        path = self.opts.extra.get("bucket_map", "")
+        if path:
+            rv, renames = load_bucket_map(path)
+            if rv != 0:
+                return rv, {}, {}
+            setattr(self.opts, "bucket_renames", renames)
+            # Each source bucket has its own destination bucket to check.
+            for source_bucket in self.filter_source_buckets(source_map):
+                rv, self.sink_maps[source_bucket['name']] = \
+                    self.sink_class.check(bucket_opts(self.opts, source_bucket['name']), self.sink_spec, source_map)
+                if rv != 0:
+                    return rv, {}, {}
+            return 0, source_map, {}
         rv, sink_map = self.sink_class.check(self.opts, self.sink_spec, source_map)
         if rv != 0:
             return rv, {}, {}
@@ -258,16 +558,25 @@ class PumpingStation(ProgressReporter):
         logging.debug(f' source_nodes: {",".join([return_string(n.get("hostname", NA)) for n in source_nodes])}')
         return source_nodes
 
-    def transfer_bucket_msgs(
-            self, source_bucket: Dict[str, Any],
-            source_map, sink_map) -> couchbaseConstants.PUMP_ERROR:
+    def start_bucket_msgs(
+            self, source_bucket: Dict[str, Any], source_map, sink_map,
+            concurrency: int = 1) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional['BucketTransfer']]:
+        """Queues the units that transfer a bucket's msgs, without waiting
+           for them."""
         source_nodes = self.filter_source_nodes(source_bucket, source_map)
-        # Transfer bucket msgs with a Pump per source server.
-        self.start_workers(len(source_nodes))
-        self.report_init()
-
-        self.ctl['run_msg'] = 0
-        self.ctl['tot_msg'] = 0
+        # Transfer bucket msgs with a Pump per source server, or per vbucket
+        # range of each source server when vbucket_ranges is set.
+        ranges = int(self.opts.extra.get("vbucket_ranges", 1))
+        if ranges <= 0:
+            ranges = max(1, self.opts.threads // max(1, len(source_nodes)))
+        # The units of concurrent buckets must not block on a full queue.
+        self.start_workers(len(source_nodes) * ranges if concurrency == 1 else 0)
+        if not self.transfers:
+            self.report_init()
+            self.ctl['run_msg'] = 0
+            self.ctl['tot_msg'] = 0
+            self.ctl['adjust_msg'] = 0
+        transfer = self.begin_bucket(source_bucket, source_map, sink_map, ranges)
 
         # Checks to be done:
         #    1. If source is a CB server check if hostname given is default or external:
@@ -312,40 +621,189 @@ class PumpingStation(ProgressReporter):
 
         for source_node in sorted(source_nodes,
                                   key=lambda n: return_string(n.get('hostname', NA))):
-            logging.debug(f' enqueueing node: {source_node.get("hostname", NA)}')
-            self.queue.put((source_bucket, source_node, source_map, sink_map, alt_add))
-
-            rv, tot = self.source_class.total_msgs(self.opts,
-                                                   source_bucket,
-                                                   source_node,
-                                                   source_map)
-            if rv != 0:
-                return rv
-            if tot:
-                self.ctl['tot_msg'] += tot
-
-        # Don't use queue.join() as it eats Ctrl-C's.
-        s = 0.05
-        while self.queue.unfinished_tasks:
-            time.sleep(s)
-            s = min(1.0, s + 0.01)
-
-        rv = self.ctl['rv']
+            for index, vbuckets in enumerate(self.source_class.split_vbuckets(self.opts, source_bucket,
+                                                                              source_node, ranges)):
+                logging.debug(f' enqueueing node: {source_node.get("hostname", NA)}, vbucket range: {index}')
+                self.put_unit((source_bucket, source_node, source_map, sink_map, alt_add, (index, vbuckets)))
+
+        self.start_estimates(transfer, source_nodes)
+        return 0, transfer
+
+    def start_estimates(self, transfer: 'BucketTransfer', source_nodes: List[Dict[str, Any]]):
+        """Estimates the msgs of each source node in the background, as that
+           takes REST round trips or a scan of the backup files, and adds them
+           to the progress bar's total as they land."""
+        for source_node in source_nodes:
+            estimate = threading.Thread(target=self.estimate_msgs,
+                                        args=(transfer, source_node),
+                                        name="estimate", daemon=True)
+            estimate.start()
+            transfer.estimates.append(estimate)
+
+    def estimate_msgs(self, transfer: 'BucketTransfer', source_node: Dict[str, Any]):
+        rv, tot = self.source_class.total_msgs(self.opts, transfer.source_bucket, source_node, transfer.source_map)
+        if rv != 0:
+            logging.warning(f'could not estimate msgs of node: {source_node.get("hostname", NA)}; {rv}')
+            return
+        if tot and not self.ctl['stop']:
+            add_ctl(self.ctl, 'tot_msg', tot)
+            with self.units_done:
+                transfer.tot_msg += tot
+
+    def wait_for_estimates(self, transfer: 'BucketTransfer'):
+        for estimate in transfer.estimates:
+            estimate.join()
+        transfer.estimates = []
+
+    def finish_bucket_msgs(self, transfer: 'BucketTransfer') -> couchbaseConstants.PUMP_ERROR:
+        """Reports on a bucket whose units are all done."""
+        self.wait_for_estimates(transfer)
+        self.end_bucket(transfer)
+        source_bucket = transfer.source_bucket
+
+        # Other buckets may be transferring at the same time, so report only
+        # on the counters of this bucket's units.
+        rv = transfer.rv
         if rv != 0:
             return rv
 
-        time.sleep(0.01)  # Allows threads to update counters.
-
-        sys.stderr.write(self.bar(self.ctl['run_msg'],
-                                  self.ctl['tot_msg']) + "\n")
+        sys.stderr.write(self.bar(transfer.cur['tot_sink_msg'],
+                                  estimated_total(transfer.tot_msg, transfer.cur['tot_adjust_msg'],
+                                                  transfer.cur['tot_sink_msg'])) + "\n")
         sys.stderr.write(f"bucket: {source_bucket['name']}, msgs transferred...\n")
 
         def emit(msg):
             sys.stderr.write(f'{msg}\n')
-        self.report(emit=emit)
+        transfer.report(emit=emit)
+        for line in pump_metrics.summary_lines(self.metrics.snapshot()):
+            logging.info(line)
+
+        moves = transfer.moves
+        lost = [vbucket_id for vbucket_id, _, to in moves if to is None]
+        if moves:
+            emit(f'  vbuckets moved between source nodes: {len(moves)}, followed: {len(moves) - len(lost)}')
+            for vbucket_id, frm, to in sorted(moves):
+                emit(f'    vbucket {vbucket_id}: {frm} -> {to or "not found"}')
+        if lost:
+            return f'error: could not follow vbuckets that moved during the transfer: {sorted(lost)}'
+
+        return 0
 
+    def check_digests(self, source_bucket: Dict[str, Any], source_map) -> couchbaseConstants.PUMP_ERROR:
+        """Reports the digests of a bucket's transferred documents, and saves
+           them to the checksum_file. With --verify, which reads back what an
+           earlier transfer wrote, compares them to the digests that transfer
+           recorded instead, and fails on any vbucket that differs."""
+        if self.digests is None:
+            return 0
+        name = return_string(source_bucket['name'])
+        actual = self.digests.bucket(name)
+        sys.stderr.write(f'  checksums: {len(actual)} vbuckets\n')
+        path = self.opts.extra.get("checksum_file", "")
+        if not getattr(self.opts, "verify", False):
+            if path:
+                pump_checksum.save_file(path, self.digests.state())
+            return 0
+
+        if path:
+            rv, buckets = pump_checksum.load_file(path)
+            if rv != 0:
+                return rv
+            # --verify swaps -b and -B, so that -B names the bucket read back.
+            expected = buckets.get(getattr(self.opts, "bucket_destination", None) or name)  # type: ignore
+        else:
+            rv, expected = self.source_class.provide_digests(self.opts, self.source_spec, source_bucket, source_map)
+            if rv != 0:
+                return rv
+        if expected is None:
+            return f'error: no checksums were recorded for bucket: {name}; give the checksum_file of its transfer'
+
+        mismatches = pump_checksum.compare(expected, actual)
+        for vbucket_id, want, got in mismatches:
+            sys.stderr.write(f'    vbucket {vbucket_id}: expected: {want:016x}, found: {got:016x}\n')
+        if mismatches:
+            return f'error: bucket: {name} differs from its transfer in vbuckets: {[m[0] for m in mismatches]}'
+        sys.stderr.write(f'  verified: {len(expected)} vbuckets\n')
         return 0
 
+    def begin_bucket(self, source_bucket: Dict[str, Any], source_map, sink_map, ranges: int) -> 'BucketTransfer':
+        """Registers a bucket whose units are about to be queued, and starts
+           following its topology, when the source supports it and the
+           transfer is not from a single node."""
+        transfer = BucketTransfer(self.opts, source_bucket, source_map, sink_map, ranges, self.memory)
+        with self.units_done:
+            self.transfers[source_bucket['name']] = transfer
+        interval = float(self.opts.extra.get("topology_interval", 0))
+        if interval <= 0 or getattr(self.opts, "single_node", None):
+            return transfer
+        rv, bucket = self.source_class.refresh_bucket(self.opts, self.source_spec, source_bucket['name'])
+        if rv != 0 or not bucket:
+            return transfer
+        transfer.watcher = pump_topology.TopologyWatcher(
+            interval, bucket,
+            lambda: self.source_class.refresh_bucket(self.opts, self.source_spec, source_bucket['name']))
+        transfer.watcher.start()
+        return transfer
+
+    def end_bucket(self, transfer: 'BucketTransfer'):
+        with self.units_done:
+            self.transfers.pop(transfer.source_bucket['name'], None)
+        if transfer.watcher:
+            transfer.watcher.stop()
+            if transfer.watcher.changes:
+                logging.info(f'source topology changes seen: {transfer.watcher.changes}')
+            transfer.watcher = None
+
+    def wait_for_bucket(self, active: List['BucketTransfer']) -> 'BucketTransfer':
+        """Waits until the units of one of the active buckets are all done,
+           as wait_for_units does for all of them."""
+        with self.units_done:
+            while True:
+                for transfer in active:
+                    if transfer.units_outstanding <= 0:
+                        return transfer
+                self.units_done.wait(1.0)
+
+    def follow_moves(self, item, moved: List[int], attempt: int = 0):
+        """Queues a unit on each source node that vbuckets moved to while
+           they were streamed, which resumes them from the checkpoint. The
+           config is fetched again, FOLLOW_WAIT seconds later, while the move
+           settles. Runs deferred, off the thread that merges unit results."""
+        source_bucket, source_node, source_map, sink_map, alt_add, _ = item
+        hostname = source_node.get('hostname', NA)
+        transfer = self.transfers.get(source_bucket['name'])
+        if transfer is None:
+            logging.error(f'could not follow vbuckets: {moved} that moved from node: {hostname}, '
+                          f'as their bucket is no longer transferring')
+            return
+        targets: Dict[str, Tuple[Dict[str, Any], Dict[str, Any], List[int]]] = {}
+        if transfer.watcher:
+            bucket = transfer.watcher.poll()
+            pending = []
+            for vbucket_id in moved:
+                node = self.source_class.find_vbucket_node(bucket, vbucket_id)
+                if not node or node.get('hostname') == hostname:
+                    pending.append(vbucket_id)
+                    continue
+                if node['hostname'] not in targets:
+                    targets[node['hostname']] = (bucket, node, [])
+                targets[node['hostname']][2].append(vbucket_id)
+            moved = pending
+
+        for to, (bucket, node, vbuckets) in sorted(targets.items()):
+            with self.units_done:
+                index = transfer.next_range_index
+                transfer.next_range_index += 1
+                transfer.moves.extend((vbucket_id, hostname, to) for vbucket_id in vbuckets)
+            logging.warning(f'following vbuckets: {vbuckets} from node: {hostname} to node: {to}')
+            self.put_unit((bucket, node, source_map, sink_map, alt_add, (index, vbuckets)))
+        if moved and transfer.watcher and attempt + 1 < PumpingStation.FOLLOW_ATTEMPTS and not self.ctl['stop']:
+            self.defer(PumpingStation.FOLLOW_WAIT, transfer, self.follow_moves, item, moved, attempt + 1)
+        elif moved:
+            logging.error(f'could not find the new node of vbuckets: {moved} that moved from node: {hostname}')
+            with self.units_done:
+                transfer.moves.extend((vbucket_id, hostname, None) for vbucket_id in moved)
+
     def transfer_bucket_design(self, source_bucket, source_map, sink_map) -> couchbaseConstants.PUMP_ERROR:
         """Transfer bucket design (e.g., design docs, views)."""
         rv, source_design = self.source_class.provide_design(self.opts, self.source_spec, source_bucket, source_map)
@@ -383,68 +841,209 @@ class PumpingStation(ProgressReporter):
     @staticmethod
     def run_worker(self, thread_index):
         while not self.ctl['stop']:
-            source_bucket, source_node, source_map, sink_map, alt_add = \
-                self.queue.get()
-            hostname = source_node.get('hostname', NA)
-            logging.debug(f' node: {hostname}')
-            logging.debug(f' Use alternate addresses: {alt_add}')
-
-            curx = defaultdict(int)
-            self.source_class.check_spec(source_bucket,
-                                         source_node,
-                                         self.opts,
-                                         self.source_spec,
-                                         curx)
-            self.sink_class.check_spec(source_bucket,
-                                       source_node,
-                                       self.opts,
-                                       self.sink_spec,
-                                       curx)
-
-            source = self.source_class(self.opts, self.source_spec, source_bucket,
-                                       source_node, source_map, sink_map, self.ctl,
-                                       curx)
-            setattr(source, 'alt_add', alt_add['source'])
-            sink = self.sink_class(self.opts, self.sink_spec, source_bucket,
-                                   source_node, source_map, sink_map, self.ctl,
-                                   curx)
-            setattr(sink, 'alt_add', alt_add['sink'])
-
-            src_conf_res = source.get_conflict_resolution_type()
-            snk_conf_res = sink.get_conflict_resolution_type()
-            _, snk_bucket = find_sink_bucket_name(self.opts, source_bucket["name"])
-
-            forced = False
-            if int(self.opts.extra.get("try_xwm", 1)) == 0:
-                forced = True
-
-            if int(self.opts.extra.get("conflict_resolve", 1)) == 0:
-                forced = True
-
-            if not forced and snk_conf_res != "any" and src_conf_res != "any" and src_conf_res != snk_conf_res:
-                logging.error(f'Cannot transfer data, source bucket `{source_bucket["name"]}` uses {src_conf_res} '
-                              f'conflict resolution but sink bucket `{snk_bucket}` uses {snk_conf_res} conflict '
-                              f'resolution')
+            item = self.queue.get()
+            try:
+                result = PumpingStation.run_unit(self.opts, self.source_class, self.source_spec,
+                                                 self.sink_class, self.sink_spec, self.ctl, item)
+            except Exception as e:
+                logging.exception(f'error: worker {thread_index} failed')
+                result = (f'error: worker failed: {e}', {}, [])
+            self.unit_done(result, item)
+            self.queue.task_done()
+
+    @staticmethod
+    def run_unit(opts, source_class, source_spec, sink_class, sink_spec, ctl,
+                 item) -> Tuple[couchbaseConstants.PUMP_ERROR, Dict[str, int], List[int]]:
+        """Pumps one queued node (or vbucket range of a node), returning the
+           pump's result, its counters and the vbuckets that moved off the node.
+           Runs in a worker thread, or in a worker process when --processes is
+           given."""
+        runner = PumpingStation.make_pump(opts, source_class, source_spec, sink_class, sink_spec, ctl, item)
+        if runner is None:
+            return 0, {}, []
+        with pump_profile.profiled(runner.opts, "worker", item[0]['name'], item[1].get('hostname', NA)):
+            rv = runner.run()
+        if pump_profile.profile_dir(runner.opts):
+            # The sink worker writes its profile as it stops, which should be
+            # done before the unit is.
+            runner.sink.join_worker(pump_profile.JOIN_TIMEOUT)
+        return runner.unit_result(rv)
+
+    @staticmethod
+    def make_pump(opts, source_class, source_spec, sink_class, sink_spec, ctl, item,
+                  pump_class=None) -> Optional['Pump']:
+        """Builds the source, sink and pump of a queued unit, or returns None
+           if the unit is not to be transferred."""
+        source_bucket, source_node, source_map, sink_map, alt_add, vbucket_range = item
+        hostname = source_node.get('hostname', NA)
+        opts = bucket_opts(opts, source_bucket['name'])
+        logging.debug(f' node: {hostname}, vbucket range: {vbucket_range[0]}')
+        logging.debug(f' Use alternate addresses: {alt_add}')
+
+        curx: Dict[str, Any] = defaultdict(int)
+        source_class.check_spec(source_bucket,
+                                source_node,
+                                opts,
+                                source_spec,
+                                curx)
+        sink_class.check_spec(source_bucket,
+                              source_node,
+                              opts,
+                              sink_spec,
+                              curx)
+        pump_checkpoint.resume(curx, ctl.get('checkpoint'), source_bucket['name'], hostname)
+
+        source = source_class(opts, source_spec, source_bucket,
+                              source_node, source_map, sink_map, ctl,
+                              curx)
+        setattr(source, 'alt_add', alt_add['source'])
+        source.set_vbucket_range(*vbucket_range)
+        sink = sink_class(opts, sink_spec, source_bucket,
+                          source_node, source_map, sink_map, ctl,
+                          curx)
+        setattr(sink, 'alt_add', alt_add['sink'])
+        sink.set_vbucket_range(*vbucket_range)
+
+        src_conf_res = source.get_conflict_resolution_type()
+        snk_conf_res = sink.get_conflict_resolution_type()
+        _, snk_bucket = find_sink_bucket_name(opts, source_bucket["name"])
+
+        forced = False
+        if int(opts.extra.get("try_xwm", 1)) == 0:
+            forced = True
+
+        if int(opts.extra.get("conflict_resolve", 1)) == 0:
+            forced = True
+
+        if not forced and snk_conf_res != "any" and src_conf_res != "any" and src_conf_res != snk_conf_res:
+            logging.error(f'Cannot transfer data, source bucket `{source_bucket["name"]}` uses {src_conf_res} '
+                          f'conflict resolution but sink bucket `{snk_bucket}` uses {snk_conf_res} conflict '
+                          f'resolution')
+            return None
+
+        return (pump_class or Pump)(opts, source, sink, source_map, sink_map, ctl, curx)
+
+    def unit_done(self, result: Tuple[couchbaseConstants.PUMP_ERROR, Dict[str, int], List[int]], item=None):
+        """Merges a finished unit's counters and result. Only then is the unit
+           no longer outstanding, so that wait_for_units doubles as a barrier
+           after which the counters are final. A failed unit is re-queued
+           instead while its node has retries left."""
+        rv, counters, moved = result
+        if moved and item is not None:
+            self.defer(0, self.transfers.get(item[0]['name']), self.follow_moves, item, moved)
+        if rv != 0 and item is not None and self.retry_unit(rv, item):
+            rv = 0
+        with self.units_done:
+            transfer = self.transfers.get(item[0]['name']) if item is not None else None
+            for k, v in counters.items():
+                self.cur[k] = self.cur.get(k, 0) + v
+                if transfer:
+                    transfer.cur[k] += v
+
+            if self.ctl['rv'] == 0 and rv != 0:
+                self.ctl['rv'] = rv
+            if transfer and transfer.rv == 0 and rv != 0:
+                transfer.rv = rv
+
+            self.units_outstanding -= 1
+            if transfer:
+                transfer.units_outstanding -= 1
+            self.units_done.notify_all()
+
+    def unit_failed(self, error: BaseException, item=None):
+        self.unit_done((f'error: worker process failed: {error}', {}, []), item)
+
+    def retry_unit(self, rv: couchbaseConstants.PUMP_ERROR, item) -> bool:
+        """Re-queues a failed unit after a backoff, unless its source node
+           used up its node_retry budget. Only units of a resumable source are
+           retried: the sink acknowledged seqnos are in the checkpoint, from
+           which the re-queued unit resumes, so the counters of the failed
+           attempt only cover msgs that aren't sent again."""
+        if self.ctl['stop'] or not self.source_class.resumable:
+            return False
+        hostname = item[1].get('hostname', NA)
+        with self.units_done:
+            if self.node_retries[hostname] >= int(self.opts.extra.get("node_retry", 0)):
+                return False
+            self.node_retries[hostname] += 1
+            attempt = self.node_retries[hostname]
+        backoff = min(0.1 * 2 ** attempt, float(self.opts.extra.get("backoff_cap", 10)))
+        logging.warning(f'retrying node: {hostname}, vbucket range: {item[5][0]}, attempt: {attempt},'
+                        f' in: {backoff}s; after error: {rv}')
+
+        transfer = self.transfers.get(item[0]['name'])
+
+        def requeue():
+            if transfer and transfer.watcher:
+                # Retry with the latest map, without the vbuckets followed elsewhere.
+                self.put_unit((transfer.watcher.latest(),) + item[1:])
             else:
-                rv = Pump(self.opts, source, sink, source_map, sink_map, self.ctl,
-                          curx).run()
+                self.put_unit(item)
 
-                for k, v in curx.items():
-                    if isinstance(v, int):
-                        self.cur[k] = self.cur.get(k, 0) + v
+        self.defer(backoff, transfer, requeue)
+        return True
 
-                logging.debug(f' node: {hostname}, done; rv: {rv}')
-                if self.ctl['rv'] == 0 and rv != 0:
-                    self.ctl['rv'] = rv
+    def defer(self, delay: float, transfer: Optional['BucketTransfer'], fn: Callable, *args):
+        """Calls fn on a timer thread after delay seconds, so that the thread
+           merging unit results never blocks. Until fn returns it counts as an
+           outstanding unit, so that wait_for_units waits for what it queues."""
+        with self.units_done:
+            self.units_outstanding += 1
+            if transfer:
+                transfer.units_outstanding += 1
 
-            self.queue.task_done()
+        def run():
+            try:
+                fn(*args)
+            finally:
+                with self.units_done:
+                    self.units_outstanding -= 1
+                    if transfer:
+                        transfer.units_outstanding -= 1
+                    self.units_done.notify_all()
+
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        timer.start()
+
+    def put_unit(self, item):
+        with self.units_done:
+            self.units_outstanding += 1
+            transfer = self.transfers.get(item[0]['name'])
+            if transfer:
+                transfer.units_outstanding += 1
+        if self.pool:
+            self.pool.apply_async(PumpingStation.run_unit,
+                                  (self.opts, self.source_class, self.source_spec,
+                                   self.sink_class, self.sink_spec, self.ctl, item),
+                                  callback=lambda result: self.unit_done(result, item),
+                                  error_callback=lambda error: self.unit_failed(error, item))
+        else:
+            self.queue.put(item)
+
+    def wait_for_units(self):
+        # Don't use queue.join() as it eats Ctrl-C's; a bounded wait keeps the
+        # main thread responsive to KeyboardInterrupt on every platform, while
+        # unit_done wakes it up as soon as the last unit is merged.
+        with self.units_done:
+            while self.units_outstanding > 0:
+                self.units_done.wait(1.0)
 
     def start_workers(self, queue_size: int):
-        if self.queue:
+        if self.queue or self.pool:
+            return
+
+        if getattr(self.opts, "processes", False):
+            self.start_processes()
             return
 
         self.queue = queue.Queue(queue_size)
 
+        if async_engine(self.opts):
+            import pump_async
+            pump_async.start_loops(self)
+            return
+
         threads = [threading.Thread(target=PumpingStation.run_worker,
                                     name="w" + str(i), args=(self, i))
                    for i in range(self.opts.threads)]
@@ -452,6 +1051,44 @@ class PumpingStation(ProgressReporter):
             thread.daemon = True
             thread.start()
 
+    def start_processes(self):
+        """Starts the pool of worker processes that pumps run in instead of
+           threads, with --processes. The ctl dict is shared through a
+           manager, while each unit's counters are returned to, and merged
+           by, this process."""
+        if self.pool:
+            return
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods()
+                                              else None)
+        self.manager = PumpManager(ctx=context)
+        self.manager.start()
+        # pylint: disable=no-member
+        self.metrics = self.manager.Metrics()  # type: ignore
+        self.ctl['metrics'] = self.metrics
+        if self.checkpoint:
+            self.checkpoint = self.manager.Checkpoint(self.checkpoint.state())  # type: ignore
+            self.ctl['checkpoint'] = self.checkpoint
+        if self.digests is not None:
+            self.digests = self.manager.Digests()  # type: ignore
+            self.ctl['digests'] = self.digests
+        if self.limiter:
+            self.limiter = self.manager.RateLimiter(*pump_ratelimit.limits_from_opts(self.opts))  # type: ignore
+            self.ctl['limiter'] = self.limiter
+        if self.memory:
+            self.memory = self.manager.MemoryBudget(self.memory.limit)  # type: ignore
+            self.ctl['memory'] = self.memory
+        # pylint: enable=no-member
+        self.ctl = SharedCtl(self.manager, self.ctl)
+        self.pool = context.Pool(self.opts.threads)
+
+    def stop_workers(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.manager.shutdown()
+            self.manager = None
+
     @staticmethod
     def find_handler(opts, x, classes):
         for s in classes:
@@ -460,6 +1097,39 @@ class PumpingStation(ProgressReporter):
         return None
 
 
+class BucketTransfer(ProgressReporter):
+    """A bucket whose msgs are being transferred, of which several can be at
+       once with bucket_concurrency."""
+
+    def __init__(self, opts, source_bucket: Dict[str, Any], source_map, sink_map, ranges: int,
+                 memory: Optional[pump_memory.MemoryBudget] = None):
+        self.opts = opts
+        self.memory = memory
+        self.source_bucket = source_bucket
+        self.source_map = source_map
+        self.sink_map = sink_map
+        # Units queued for the bucket that haven't been merged back yet.
+        self.units_outstanding = 0
+        # Follows the bucket's topology, when the source can report it.
+        self.watcher: Optional[pump_topology.TopologyWatcher] = None
+        # The (vbucket_id, from hostname, to hostname) of vbuckets that moved
+        # between source nodes during the transfer; to is None when the
+        # vbucket's new node could not be found.
+        self.moves: List[Tuple[int, str, Optional[str]]] = []
+        self.next_range_index = ranges
+        # Transfers the bucket's design docs and index definitions alongside
+        # its msgs, when the sink allows it.
+        self.metadata: Optional[threading.Thread] = None
+        # Estimate the bucket's msgs per source node for the progress bar.
+        self.estimates: List[threading.Thread] = []
+        # The merged counters, estimated msgs and first error of the bucket's
+        # units, apart from those of buckets transferred at the same time.
+        self.cur: Dict[str, Any] = defaultdict(int)
+        self.tot_msg = 0
+        self.rv: couchbaseConstants.PUMP_ERROR = 0
+        self.report_init()
+
+
 class Pump(ProgressReporter):
     """Moves batches of data from one Source to one Sink."""
 
@@ -471,37 +1141,60 @@ class Pump(ProgressReporter):
         self.sink_map = sink_map
         self.ctl = ctl
         self.cur = cur  # Should be a defaultdict(int); 0 as default value.
+        self.metrics = ctl.get('metrics')
+        self.limiter = ctl.get('limiter')
+        self.memory = ctl.get('memory')
+        # Bytes of the batches in flight to the sink held against the memory
+        # budget.
+        self.memory_held = 0
+        self.checkpoint = ctl.get('checkpoint')
+        # The highest seqno per vbucket that the sink consumed since the last
+        # checkpoint flush.
+        self.progress: Dict[int, int] = {}
+        self.digests = ctl.get('digests')
+        # Digests per vbucket of the documents the sink consumed.
+        self.vbucket_digests: Dict[int, int] = {}
+        self.coalescer = pump_coalesce.Coalescer.from_opts(opts, source, Batch)
+        self.batch_sizer: Optional[BatchSizer] = None
+        if int(opts.extra.get("batch_auto", 0)):
+            self.batch_sizer = BatchSizer(opts, str(source))
+            source.batch_sizer = self.batch_sizer
 
     def run(self):
-        future = None
+        futures: Deque[SinkBatchFuture] = deque()
+        flushed = time.monotonic()
 
         # TODO: (2) Pump - timeouts when providing/consuming/waiting.
 
         report = int(self.opts.extra.get("report", 5))
         report_full = int(self.opts.extra.get("report_full", 2000))
+        inflight = max(1, int(self.opts.extra.get("inflight_batches", 1)))
 
         self.report_init()
 
         n = 0
 
         while not self.ctl['stop']:
-            rv_batch, batch = self.source.provide_batch()
+            start = time.monotonic()
+            if self.coalescer:
+                rv_batch, batch = self.coalescer.provide_batch(self.cur)
+            else:
+                rv_batch, batch = self.source.provide_batch()
             if rv_batch != 0:
+                # Account for the batches already sent, so that a retry of
+                # this unit resumes after them.
+                while futures and self.wait_for_future(futures.popleft()) == 0:
+                    pass
                 return self.done(rv_batch)
+            pump_metrics.observe(self.cur, 'provide', time.monotonic() - start)
 
-            if future:
-                rv = future.wait_until_consumed()
+            # Keep at most inflight batches outstanding at the sink, in order.
+            # Once the source is exhausted, drain everything that's left.
+            while futures and (not batch or len(futures) >= inflight):
+                rv = self.wait_for_oldest(futures)
                 if rv != 0:
-                    # TODO: (5) Pump - retry logic on consume error.
                     return self.done(rv)
 
-                self.cur['tot_sink_batch'] += 1
-                self.cur['tot_sink_msg'] += future.batch.size()
-                self.cur['tot_sink_byte'] += future.batch.bytes
-
-                self.ctl['run_msg'] += future.batch.size()
-                self.ctl['tot_msg'] += future.batch.adjust_size
-
             if not batch:
                 return self.done(0)
 
@@ -509,27 +1202,172 @@ class Pump(ProgressReporter):
             self.cur['tot_source_msg'] += batch.size()
             self.cur['tot_source_byte'] += batch.bytes
 
+            if self.limiter:
+                wait = self.limiter.reserve(batch.size(), batch.bytes)
+                if wait > 0:
+                    time.sleep(wait)
+                pump_metrics.observe(self.cur, 'throttle', wait)
+
+            if self.memory:
+                rv = self.hold_memory(batch.bytes, futures)
+                if rv != 0:
+                    return self.done(rv)
+
             rv_future, future = self.sink.consume_batch_async(batch)
             if rv_future != 0:
                 return self.done(rv_future)
+            futures.append(future)
+
+            if start - flushed >= 1.0:
+                pump_metrics.flush(self.cur, self.metrics)
+                self.flush_checkpoint()
+                flushed = start
 
             n = n + 1
-            if report_full > 0 and n % report_full == 0:
-                if self.opts.verbose > 0:
-                    sys.stderr.write("\n")
-                logging.info("  progress...")
-                self.report(prefix="  ")
-            elif report > 0 and n % report == 0:
-                sys.stderr.write(self.bar(self.ctl['run_msg'],
-                                          self.ctl['tot_msg']))
+            self.report_progress(n, report, report_full)
 
         return self.done(0)
 
+    def unit_result(self, rv: couchbaseConstants.PUMP_ERROR) -> \
+            Tuple[couchbaseConstants.PUMP_ERROR, Dict[str, int], List[int]]:
+        """The result of the pumped unit, with its counters and the vbuckets
+           that moved off its node."""
+        logging.debug(f' node: {self.source.source_node.get("hostname", NA)}, done; rv: {rv}')
+        return rv, {k: v for k, v in self.cur.items() if isinstance(v, int)}, self.source.moved_vbuckets
+
+    def report_progress(self, n: int, report: int, report_full: int):
+        if report_full > 0 and n % report_full == 0:
+            if self.opts.verbose > 0:
+                sys.stderr.write("\n")
+            logging.info("  progress...")
+            self.report(prefix="  ")
+        elif report > 0 and n % report == 0:
+            run_msg = self.ctl['run_msg']
+            sys.stderr.write(self.bar(run_msg,
+                                      estimated_total(self.ctl['tot_msg'], self.ctl.get('adjust_msg', 0), run_msg)))
+
+    def wait_for_future(self, future: SinkBatchFuture) -> couchbaseConstants.PUMP_ERROR:
+        """Waits for the sink to consume a batch and accounts for it."""
+        start = time.monotonic()
+        rv = future.wait_until_consumed()
+        if rv != 0:
+            return rv
+        pump_metrics.observe(self.cur, 'wait', time.monotonic() - start)
+        self.batch_consumed(future.batch)
+        return 0
+
+    def batch_consumed(self, batch: Batch):
+        """Accounts for a batch the sink consumed."""
+        self.cur['tot_sink_batch'] += 1
+        self.cur['tot_sink_msg'] += batch.size()
+        self.cur['tot_sink_byte'] += batch.bytes
+
+        add_ctl(self.ctl, 'run_msg', batch.size())
+        add_ctl(self.ctl, 'adjust_msg', batch.adjust_size)
+        self.cur['tot_adjust_msg'] += batch.adjust_size
+        if self.memory:
+            self.release_memory(batch.bytes)
+
+        if self.batch_sizer:
+            self.batch_sizer.consumed(batch, self.cur['tot_sink_tmpfail'])
+        if self.checkpoint is not None:
+            pump_checkpoint.batch_progress(batch, self.progress)
+        if self.digests is not None:
+            pump_checksum.batch_digests(batch, self.vbucket_digests)
+
+    def retry_batches(self, rv: couchbaseConstants.PUMP_ERROR, failed: SinkBatchFuture,
+                      futures: Deque[SinkBatchFuture]) -> couchbaseConstants.PUMP_ERROR:
+        """Resends a batch the sink failed to consume, and the batches that
+           were outstanding behind it, in order and after the sink reconnects,
+           up to batch_retry times. On success futures holds those of the
+           resent batches that are still outstanding. Returns the error the
+           batch first failed with once the retries run out, or straight away
+           when the sink can't reconnect."""
+        if not self.sink.reconnectable:
+            return rv
+        first_rv = rv
+        batch_retry = int(self.opts.extra.get("batch_retry", 3))
+        backoff_cap = float(self.opts.extra.get("backoff_cap", 10))
+        backoff = 0.1
+        batches = [failed.batch] + [future.batch for future in futures]
+        futures.clear()
+        for attempt in range(1, batch_retry + 1):
+            if self.ctl['stop']:
+                break
+            backoff = min(backoff * 2.0, backoff_cap)
+            logging.warning(f'retrying {len(batches)} batches, attempt: {attempt}/{batch_retry}, sleeping: {backoff};'
+                            f' after error: {rv}; sink: {self.sink}')
+            time.sleep(backoff)
+            self.cur['tot_sink_retry_reconnect'] += 1
+
+            rv = self.sink.reconnect()
+            if rv != 0:
+                continue
+            for batch in batches:
+                rv, future = self.sink.consume_batch_async(batch)
+                if rv != 0:
+                    break
+                futures.append(future)
+            if rv == 0:
+                rv = self.wait_for_future(futures.popleft())
+                if rv == 0:
+                    return 0
+            futures.clear()
+        return first_rv
+
+    def wait_for_oldest(self, futures: Deque[SinkBatchFuture]) -> couchbaseConstants.PUMP_ERROR:
+        future = futures.popleft()
+        rv = self.wait_for_future(future)
+        if rv != 0:
+            rv = self.retry_batches(rv, future, futures)
+        return rv
+
+    def hold_memory(self, nbytes: int, futures: Deque[SinkBatchFuture]) -> couchbaseConstants.PUMP_ERROR:
+        """Holds a batch's bytes against the memory budget until the sink
+           consumed it. While the budget is short, waits for the batches this
+           pump has in flight instead; once it has none the batch is sent
+           regardless, as the budget may be held by buffers waiting on this
+           pump to drain them."""
+        start = time.monotonic()
+        rv: couchbaseConstants.PUMP_ERROR = 0
+        while not self.memory.acquire(nbytes, 0):
+            if not futures:
+                self.memory.charge(nbytes)
+                break
+            rv = self.wait_for_oldest(futures)
+            if rv != 0:
+                return rv
+        self.memory_held += nbytes
+        pump_metrics.observe(self.cur, 'memory', time.monotonic() - start)
+        return rv
+
+    def release_memory(self, nbytes: int):
+        nbytes = min(nbytes, self.memory_held)
+        self.memory_held -= nbytes
+        self.memory.release(nbytes)
+
+    def flush_checkpoint(self):
+        pump_checkpoint.flush(self.cur, self.checkpoint, self.source.source_bucket.get('name', NA),
+                              self.source.source_node.get('hostname', NA), self.progress)
+
     def done(self, rv) -> couchbaseConstants.PUMP_ERROR:
         self.source.close()
         self.sink.close()
+        if self.memory:
+            self.release_memory(self.memory_held)
+        pump_metrics.flush(self.cur, self.metrics)
+        self.flush_checkpoint()
+        if self.vbucket_digests:
+            self.sink.record_digests(dict(self.vbucket_digests))
+        pump_checksum.flush(self.digests, return_string(self.source.source_bucket.get('name', NA)),
+                            self.vbucket_digests)
+        if self.batch_sizer:
+            self.batch_sizer.log_settled()
 
         logging.debug("  pump (%s->%s) done.", self.source, self.sink)
+        skipped = pump_filter.skip_counts(self.cur)
+        if skipped:
+            logging.info(f'  skipped msgs: {skipped}')
         self.report(prefix="  ")
 
         if (rv == 0 and
@@ -541,6 +1379,75 @@ class Pump(ProgressReporter):
         return rv
 
 
+class BatchSizer(object):
+    """Tunes the batch_max_size and batch_max_bytes of one pump with AIMD.
+       Every WINDOW consumed batches the limits grow by a tenth of their
+       starting values while the sink's throughput holds up. They are halved
+       when the sink asked for retries (ETMPFAIL, EBUSY or ENOMEM), and cut
+       by a quarter when throughput dropped."""
+
+    WINDOW = 8
+    DROP = 0.9  # Throughput below this fraction of the last window's is a drop.
+
+    def __init__(self, opts, name: str):
+        self.name = name
+        self.size = int(opts.extra.get("batch_max_size", 1000))
+        self.bytes = int(opts.extra.get("batch_max_bytes", 400000))
+        self.size_step = max(1, self.size // 10)
+        self.bytes_step = max(1, self.bytes // 10)
+        self.size_range = (self.size_step, self.size * 10)
+        self.bytes_range = (self.bytes_step, self.bytes * 10)
+        self.window_start = time.monotonic()
+        self.window_batches = 0
+        self.window_msgs = 0
+        self.last_throughput = 0.0
+        self.retries = 0
+
+    def limits(self) -> Tuple[int, int]:
+        return self.size, self.bytes
+
+    def consumed(self, batch: Batch, retries: int):
+        """Accounts for a batch the sink finished; retries is the sink's
+           running count of throttled requests."""
+        self.window_batches += 1
+        self.window_msgs += batch.size()
+        if self.window_batches < BatchSizer.WINDOW:
+            return
+
+        now = time.monotonic()
+        throughput = self.window_msgs / max(now - self.window_start, 1e-6)
+        throttled = retries > self.retries
+        self.retries = retries
+
+        if throttled:
+            self.resize(0.5, f'{throughput:.0f} msgs/sec, destination asked for retries')
+            # After a decrease, compare the next window only with itself.
+            throughput = 0.0
+        elif throughput < self.last_throughput * BatchSizer.DROP:
+            self.resize(0.75, f'{throughput:.0f} msgs/sec, down from {self.last_throughput:.0f}')
+            throughput = 0.0
+        else:
+            self.size = min(self.size + self.size_step, self.size_range[1])
+            self.bytes = min(self.bytes + self.bytes_step, self.bytes_range[1])
+            logging.debug(f'batch sizing: {self.name}: grew to batch_max_size={self.size},'
+                          f' batch_max_bytes={self.bytes}; {throughput:.0f} msgs/sec')
+
+        self.last_throughput = throughput
+        self.window_start = now
+        self.window_batches = 0
+        self.window_msgs = 0
+
+    def resize(self, factor: float, reason: str):
+        self.size = max(int(self.size * factor), self.size_range[0])
+        self.bytes = max(int(self.bytes * factor), self.bytes_range[0])
+        logging.info(f'batch sizing: {self.name}: shrank to batch_max_size={self.size},'
+                     f' batch_max_bytes={self.bytes}; {reason}')
+
+    def log_settled(self):
+        logging.info(f'batch sizing: {self.name}: settled at -x batch_max_size={self.size},'
+                     f'batch_max_bytes={self.bytes}')
+
+
 # --------------------------------------------------
 
 class EndPoint(object):
@@ -556,22 +1463,23 @@ class EndPoint(object):
         self.ctl = ctl
         self.cur = cur
 
-        self.only_key_re = None
-        k = getattr(opts, "key", None)
-        if k:
-            self.only_key_re = re.compile(k)
+        # Compiled from the filter options, which check_base validated.
+        _, self.msg_filter = pump_filter.MsgFilter.from_opts(opts, pump_filter.sink_vbuckets_num(sink_map))
+
+        self.vbucket_range_index = 0
+        self.vbucket_range: Optional[List[int]] = None
+
+        # Set by the Pump of a source when batch_auto tunes its batch limits.
+        self.batch_sizer: Optional[BatchSizer] = None
 
-        self.only_vbucket_id = getattr(opts, "id", None)
+        # Vbuckets that a source found moved to another node while it was
+        # streaming them, for the PumpingStation to follow.
+        self.moved_vbuckets: List[int] = []
 
     @staticmethod
     def check_base(opts, spec) -> couchbaseConstants.PUMP_ERROR:
-        k = getattr(opts, "key", None)
-        if k:
-            try:
-                re.compile(k)
-            except BaseException:
-                return f'error: could not parse key regexp: {k}'
-        return 0
+        rv, _ = pump_filter.MsgFilter.from_opts(opts)
+        return rv
 
     @staticmethod
     def check_spec(source_bucket, source_node, opts, spec, cur) -> couchbaseConstants.PUMP_ERROR:
@@ -584,21 +1492,30 @@ class EndPoint(object):
         return "any"
 
     def __repr__(self):
+        if self.vbucket_range is not None:
+            return f'{self.spec}({self.source_bucket.get("name", "")}@{self.source_node.get("hostname", "")}' \
+                f'#{self.vbucket_range_index})'
         return f'{self.spec}({self.source_bucket.get("name", "")}@{self.source_node.get("hostname", "")})'
 
+    def set_vbucket_range(self, index: int, vbuckets: Optional[List[int]]):
+        """Restricts the endpoint to a subset of the source node's vbuckets;
+           None means all of them."""
+        self.vbucket_range_index = index
+        self.vbucket_range = vbuckets
+
     def close(self):
         pass
 
-    def skip(self, key: Union[str, bytes], vbucket_id: int) -> bool:
-        if self.only_key_re and not re.search(self.only_key_re, return_string(key)):
-            logging.warning(f'skipping msg with key: {tag_user_data(key)}')
-            return True
-
-        if self.only_vbucket_id is not None and self.only_vbucket_id != vbucket_id:
-            logging.warning(f'skipping msg of vbucket_id: {vbucket_id!s}')
-            return True
-
-        return False
+    def skip(self, key: Union[str, bytes], vbucket_id: int, cmd: Optional[int] = None, exp: int = 0) -> bool:
+        """Whether a source leaves a msg out of the transfer, which is counted
+           in cur by reason."""
+        if not self.msg_filter:
+            return False
+        reason = self.msg_filter.skip(key, vbucket_id, cmd, exp)
+        if reason is None:
+            return False
+        self.cur[reason] = self.cur.get(reason, 0) + 1
+        return True
 
     def get_timestamp(self) -> str:
         # milliseconds with three digits
@@ -617,6 +1534,10 @@ class EndPoint(object):
 class Source(EndPoint):
     """Base class for all data sources."""
 
+    # Whether a re-queued unit resumes from the checkpoint, rather than
+    # reading the source again from the start.
+    resumable = False
+
     @staticmethod
     def can_handle(opts, spec):
         assert False, "unimplemented"
@@ -640,6 +1561,13 @@ class Source(EndPoint):
     def provide_design(opts, source_spec, source_bucket, source_map):
         assert False, "unimplemented"
 
+    def batch_limits(self) -> Tuple[int, int]:
+        """Returns the batch_max_size and batch_max_bytes that provide_batch
+           should fill batches up to."""
+        if self.batch_sizer:
+            return self.batch_sizer.limits()
+        return int(self.opts.extra['batch_max_size']), int(self.opts.extra['batch_max_bytes'])
+
     @staticmethod
     def provide_index(opts, source_spec, source_bucket, source_map):
         return 0, None
@@ -655,14 +1583,61 @@ class Source(EndPoint):
     def provide_batch(self):
         assert False, "unimplemented"
 
+    def reads_on_loop(self) -> bool:
+        """Subclasses whose provide_batch never waits for long, such as those
+           reading local files, return True so that the async engine calls it
+           on its event loop rather than on an executor thread."""
+        return False
+
+    async def provide_batch_async(self):
+        """Provides the next batch to the async engine. Unless the source
+           reads on the loop, provide_batch runs in the event loop's executor;
+           subclasses that can wait for their data on the loop override this."""
+        if self.reads_on_loop():
+            return self.provide_batch()
+        return await asyncio.get_running_loop().run_in_executor(None, self.provide_batch)
+
     @staticmethod
     def total_msgs(opts, source_bucket, source_node, source_map):
         return 0, None  # Subclasses can return estimate # msgs.
 
+    @staticmethod
+    def split_vbuckets(opts, source_bucket, source_node, ranges: int) -> List[Optional[List[int]]]:
+        """Subclasses that can stream a subset of a node's vbuckets return
+           up to ranges lists of vbucket ids; None means the whole node."""
+        return [None]
+
+    @staticmethod
+    def refresh_bucket(opts, spec, bucket_name: str) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[Dict[str, Any]]]:
+        """Subclasses whose source topology can change during a transfer
+           return the source bucket's current config."""
+        return 0, None
+
+    @staticmethod
+    def provide_digests(opts, source_spec, source_bucket,
+                        source_map) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[Dict[int, int]]]:
+        """Subclasses that keep the digests recorded when their data was
+           written can return them per vbucket, for --verify."""
+        return 0, None
+
+    @staticmethod
+    def find_vbucket_node(source_bucket, vbucket_id: int) -> Optional[Dict[str, Any]]:
+        """Subclasses return the node of source_bucket that holds the active
+           vbucket_id."""
+        return None
+
+    def vbucket_moved(self, vbucket_id: int):
+        self.moved_vbuckets.append(vbucket_id)
+        self.cur['tot_source_vbucket_moved'] += 1
+
 
 class Sink(EndPoint):
     """Base class for all data sinks."""
 
+    # Whether reconnect can restart the sink after a failed batch, so that
+    # the Pump resends it.
+    reconnectable = False
+
     # TODO: (2) Sink handles filtered restore by data.
 
     def __init__(self, opts, spec, source_bucket, source_node,
@@ -712,9 +1687,16 @@ class Sink(EndPoint):
         return 0
 
     def consume_batch_async(self, batch):
-        """Subclasses should return a SinkBatchFuture."""
+        """Subclasses return an error, or 0 and the SinkBatchFuture of the batch."""
         assert False, "unimplemented"
 
+    @staticmethod
+    def overlap_metadata(opts) -> bool:
+        """Subclasses return True when a bucket's design docs and index
+           definitions can be consumed while its msgs still are, rather than
+           after them."""
+        return False
+
     @staticmethod
     def check_source(opts, source_class, source_spec: str, sink_class, sink_spec: str) -> couchbaseConstants.PUMP_ERROR:
         if source_spec == sink_spec:
@@ -730,39 +1712,91 @@ class Sink(EndPoint):
                     self.op = "add"
         return self.op
 
+    def record_digests(self, digests: Dict[int, int]):
+        """Subclasses can keep the digests per vbucket of the documents they
+           took, with -x checksum=1, for --verify to check them against."""
+        pass
+
+    def reconnect(self) -> couchbaseConstants.PUMP_ERROR:
+        """Subclasses whose worker stops on a failed batch can reconnect and
+           restart it, so that the Pump can resend the batch. They also set
+           reconnectable."""
+        return f'error: cannot reconnect to sink: {self}'
+
+    def runs_on_loop(self) -> bool:
+        """Subclasses that override consume_batch to do their I/O on the
+           async engine's event loop return True, and then start no worker
+           under that engine."""
+        return False
+
+    async def consume_batch(self, batch: Batch) -> couchbaseConstants.PUMP_ERROR:
+        """Consumes a batch for the async engine. By default the batch goes to
+           the worker through consume_batch_async, whose future wakes the
+           event loop once it is done."""
+        # Subclasses implement consume_batch_async, which pylint can't see.
+        # pylint: disable=assignment-from-no-return,unpacking-non-sequence
+        rv, future = self.consume_batch_async(batch)
+        # pylint: enable=assignment-from-no-return,unpacking-non-sequence
+        if rv != 0:
+            return rv
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def wake(rv):
+            if not done.done():
+                done.set_result(rv)
+        future.add_done_callback(lambda rv: loop.call_soon_threadsafe(wake, rv))
+        return await done
+
     def init_worker(self, target):
-        self.worker_go = threading.Event()
-        self.worker_work = None  # May be None or (batch, future) tuple.
-        self.worker = threading.Thread(target=target, args=(self,),
-                                       name="s" + threading.currentThread().getName()[1:])
+        # Batches are handed to the worker in order; the Pump bounds how many
+        # may be outstanding with the inflight_batches extra option.
+        self.worker_target = target
+        if self.runs_on_loop() and async_engine(self.opts):
+            self.worker = None
+            return
+        self.worker_queue: queue.Queue = queue.Queue()
+        run = pump_profile.wrap(self.opts, "sink", (self.source_bucket or {}).get('name', NA),
+                                (self.source_node or {}).get('hostname', NA), target)
+        self.worker = threading.Thread(target=run, args=(self,), name="s" + threading.currentThread().getName()[1:])
         self.worker.daemon = True
         self.worker.start()
 
+    def restart_worker(self) -> couchbaseConstants.PUMP_ERROR:
+        """Starts a new worker once the old one stopped on an error. Batches
+           still queued to the old worker are dropped; the Pump resends them."""
+        self.worker.join(30)
+        if self.worker.is_alive():
+            return f'error: worker did not stop; sink: {self}'
+        self.init_worker(self.worker_target)
+        return 0
+
+    def join_worker(self, timeout: float):
+        """Waits up to timeout seconds for the worker to stop, once the sink
+           is closed."""
+        worker = getattr(self, "worker", None)
+        if worker:
+            worker.join(timeout)
+
     def push_next_batch(self, batch: Optional[Batch], future: Optional[SinkBatchFuture]) -> \
             Tuple[couchbaseConstants.PUMP_ERROR, Optional[SinkBatchFuture]]:
         """Push batch/future to worker."""
-        if not self.worker.is_alive():
+        if not self.worker or not self.worker.is_alive():
             return "error: cannot use a dead worker", None
 
-        self.worker_work = (batch, future)
-        self.worker_go.set()
+        self.worker_queue.put((batch, future))
         return 0, future
 
     def pull_next_batch(self) -> Tuple[Optional[Batch], SinkBatchFuture]:
         """Worker calls this method to get the next batch/future."""
-        self.worker_go.wait()
-        batch, future = self.worker_work
-        self.worker_work = None
-        self.worker_go.clear()
-        return batch, future
+        return self.worker_queue.get()
 
     def future_done(self, future, rv):
         """Worker calls this method to finish a batch/future."""
         if rv != 0:
             logging.error(f'error: async operation: {rv} on sink: {self}')
         if future:
-            future.done_rv = rv
-            future.done.set()
+            future.set_done(rv)
 
 
 # --------------------------------------------------
@@ -793,8 +1827,7 @@ class StdInSource(Source):
     def provide_batch(self):
         batch = Batch(self)
 
-        batch_max_size = self.opts.extra['batch_max_size']
-        batch_max_bytes = self.opts.extra['batch_max_bytes']
+        batch_max_size, batch_max_bytes = self.batch_limits()
 
         vbucket_id = 0x0000ffff
 
@@ -827,7 +1860,7 @@ class StdInSource(Source):
                 if len(end) != 2:
                     return f'error: value end read failed at: {line}', None
 
-                if not self.skip(key, vbucket_id):
+                if not self.skip(key, vbucket_id, cmd, exp):
                     msg = (cmd, vbucket_id, key, flg, exp, 0, b'', val, 0, 0, 0)
                     batch.append(msg, len(val))
             elif parts[0] == 'delete':
@@ -835,7 +1868,7 @@ class StdInSource(Source):
                     return f'error: length of delete line: {line}', None
                 cmd = couchbaseConstants.CMD_TAP_DELETE
                 key = parts[1]
-                if not self.skip(key, vbucket_id):
+                if not self.skip(key, vbucket_id, cmd):
                     msg = (cmd, vbucket_id, key, 0, 0, 0, b'', b'', 0, 0, 0)
                     batch.append(msg, 0)
             else:
@@ -905,8 +1938,6 @@ class StdOutSink(Sink):
             seqno = dtype = nmeta = conf_res = 0
             if msg_tuple_format > 8:
                 seqno, dtype, nmeta, conf_res = msg[8:]
-            if self.skip(key, vbucket_id):
-                continue
             if dtype & couchbaseConstants.DATATYPE_COMPRESSED != 0:
                 try:
                     val = snappy.uncompress(val)
@@ -945,6 +1976,75 @@ class StdOutSink(Sink):
         return 0, future
 
 
+class DigestSink(Sink):
+    """Takes batches without writing them anywhere, for --verify, whose pumps
+       digest the documents read back from an earlier transfer's destination."""
+
+    @staticmethod
+    def can_handle(opts, spec):
+        return spec == "verify:"
+
+    @staticmethod
+    def check(opts, spec, source_map):
+        return 0, None
+
+    @staticmethod
+    def consume_design(opts, sink_spec, sink_map,
+                       source_bucket, source_map, source_design):
+        return 0
+
+    def consume_batch_async(self, batch):
+        future = SinkBatchFuture(self, batch)
+        self.future_done(future, 0)
+        return 0, future
+
+
+class BlackholeSink(Sink):
+    """Drops batches, after handing them to a worker and acknowledging
+       their futures as a real destination does, to measure the pump engine
+       apart from any network or disk."""
+
+    def __init__(self, opts, spec, source_bucket, source_node,
+                 source_map, sink_map, ctl, cur):
+        super(BlackholeSink, self).__init__(opts, spec, source_bucket, source_node,
+                                            source_map, sink_map, ctl, cur)
+        self.init_worker(BlackholeSink.run)
+
+    @staticmethod
+    def can_handle(opts, spec):
+        return spec.startswith("blackhole://")
+
+    @staticmethod
+    def check(opts, spec, source_map):
+        return 0, None
+
+    @staticmethod
+    def consume_design(opts, sink_spec, sink_map,
+                       source_bucket, source_map, source_design):
+        return 0
+
+    def close(self):
+        self.push_next_batch(None, None)
+
+    def consume_batch_async(self, batch):
+        return self.push_next_batch(batch, SinkBatchFuture(self, batch))
+
+    def runs_on_loop(self) -> bool:
+        return True
+
+    async def consume_batch(self, batch):
+        return 0
+
+    @staticmethod
+    def run(self):
+        """Worker thread that acknowledges batches as they arrive."""
+        while not self.ctl['stop']:
+            batch, future = self.pull_next_batch()
+            self.future_done(future, 0)
+            if not batch:
+                return
+
+
 # --------------------------------------------------
 
 CMD_STR = {
@@ -1159,6 +2259,38 @@ def find_sink_bucket_name(opts, source_bucket) -> Tuple[couchbaseConstants.PUMP_
     return 0, sink_bucket
 
 
+def load_bucket_map(path: str) -> Tuple[couchbaseConstants.PUMP_ERROR, Dict[str, str]]:
+    """Reads a bucket_map file, a JSON object of source bucket names to the
+       destination bucket names they are renamed to."""
+    try:
+        with open(path, 'r') as f:
+            renames = json.load(f)
+    except (OSError, ValueError) as e:
+        return f'error: could not read bucket_map file: {path}; exception: {e}', {}
+    if not isinstance(renames, dict) or not all(isinstance(v, str) and v for v in renames.values()):
+        return f'error: bucket_map file: {path} must map source bucket names to destination bucket names', {}
+    return 0, renames
+
+
+def async_engine(opts) -> bool:
+    """Whether pumps run as coroutines on event loops, with -x engine=async."""
+    extra = getattr(opts, "extra", None) or {}
+    return extra.get("engine", "threads") == "async"
+
+
+def bucket_opts(opts, source_bucket_name: Union[str, bytes]):
+    """Returns the opts for transferring one source bucket, which name it
+       and its destination bucket when a bucket_map renames buckets."""
+    renames = getattr(opts, "bucket_renames", None)
+    if renames is None:
+        return opts
+    name = return_string(source_bucket_name)
+    opts = copy.copy(opts)
+    opts.bucket_source = name
+    opts.bucket_destination = renames.get(name, name)
+    return opts
+
+
 def mkdirs(targetpath: str) -> couchbaseConstants.PUMP_ERROR:
     upperdirs = os.path.dirname(targetpath)
     if upperdirs and not os.path.exists(upperdirs):
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""An engine that runs the pumps of a PumpingStation as coroutines on asyncio
+   event loops, with -x engine=async, rather than with a thread per pump.
+   Sources and sinks that can do their I/O on a loop override
+   Source.provide_batch_async, or Source.reads_on_loop, and Sink.consume_batch;
+   the others are run in the loop's executor, or by their own worker."""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple, cast
+
+import couchbaseConstants
+import pump
+import pump_metrics
+
+ENGINES = ["threads", "async"]
+
+UNIT_RESULT = Tuple[couchbaseConstants.PUMP_ERROR, Dict[str, int], List[int]]
+
+
+class AsyncPump(pump.Pump):
+    """A Pump whose run is a coroutine, keeping the batches in flight to the
+       sink as tasks. A batch the sink failed to consume fails the unit, which
+       node_retry re-queues, rather than being resent by the pump."""
+
+    async def run_async(self) -> couchbaseConstants.PUMP_ERROR:
+        tasks: Deque[Tuple[pump.Batch, asyncio.Future]] = deque()
+        try:
+            return await self.pump_batches(tasks)
+        finally:
+            for _, task in tasks:
+                task.cancel()
+
+    async def pump_batches(self, tasks: Deque[Tuple[pump.Batch, asyncio.Future]]) -> couchbaseConstants.PUMP_ERROR:
+        flushed = time.monotonic()
+
+        report = int(self.opts.extra.get("report", 5))
+        report_full = int(self.opts.extra.get("report_full", 2000))
+        inflight = max(1, int(self.opts.extra.get("inflight_batches", 1)))
+
+        self.report_init()
+
+        n = 0
+
+        while not self.ctl['stop']:
+            start = time.monotonic()
+            if self.coalescer:
+                rv_batch, batch = await self.coalescer.provide_batch_async(self.cur)
+            else:
+                rv_batch, batch = await self.source.provide_batch_async()
+            if rv_batch != 0:
+                while tasks and await self.wait_for_task(tasks) == 0:
+                    pass
+                return self.done(rv_batch)
+            pump_metrics.observe(self.cur, 'provide', time.monotonic() - start)
+
+            while tasks and (not batch or len(tasks) >= inflight):
+                rv = await self.wait_for_task(tasks)
+                if rv != 0:
+                    return self.done(rv)
+
+            if not batch:
+                return self.done(0)
+
+            self.cur['tot_source_batch'] += 1
+            self.cur['tot_source_msg'] += batch.size()
+            self.cur['tot_source_byte'] += batch.bytes
+
+            if self.limiter:
+                wait = self.limiter.reserve(batch.size(), batch.bytes)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                pump_metrics.observe(self.cur, 'throttle', wait)
+
+            if self.memory:
+                rv = await self.hold_memory_async(batch.bytes, tasks)
+                if rv != 0:
+                    return self.done(rv)
+
+            # Tasks start in the order they are created, so that the sink
+            # takes batches in order.
+            tasks.append((batch, asyncio.ensure_future(self.sink.consume_batch(batch))))
+
+            if start - flushed >= 1.0:
+                pump_metrics.flush(self.cur, self.metrics)
+                self.flush_checkpoint()
+                flushed = start
+
+            n = n + 1
+            self.report_progress(n, report, report_full)
+
+        return self.done(0)
+
+    async def wait_for_task(self, tasks: Deque[Tuple[pump.Batch, asyncio.Future]]) -> couchbaseConstants.PUMP_ERROR:
+        """Waits for the sink to consume the oldest batch and accounts for it."""
+        batch, task = tasks.popleft()
+        start = time.monotonic()
+        try:
+            rv = await task
+        except Exception as e:
+            logging.exception(f'error: sink failed: {self.sink}')
+            rv = f'error: sink failed: {e}'
+        if rv != 0:
+            return rv
+        pump_metrics.observe(self.cur, 'wait', time.monotonic() - start)
+        self.batch_consumed(batch)
+        return 0
+
+    async def hold_memory_async(self, nbytes: int, tasks: Deque[Tuple[pump.Batch, asyncio.Future]]) -> \
+            couchbaseConstants.PUMP_ERROR:
+        """hold_memory for the async engine, which waits for the batches this
+           pump has in flight rather than for the budget."""
+        start = time.monotonic()
+        while not self.memory.acquire(nbytes, 0):
+            if not tasks:
+                self.memory.charge(nbytes)
+                break
+            rv = await self.wait_for_task(tasks)
+            if rv != 0:
+                return rv
+        self.memory_held += nbytes
+        pump_metrics.observe(self.cur, 'memory', time.monotonic() - start)
+        return 0
+
+
+async def run_unit(station, item) -> UNIT_RESULT:
+    """PumpingStation.run_unit on an event loop."""
+    loop = asyncio.get_running_loop()
+    # Endpoints may open files or connections as they are built.
+    runner = cast(Optional[AsyncPump], await loop.run_in_executor(
+        None, pump.PumpingStation.make_pump, station.opts, station.source_class, station.source_spec,
+        station.sink_class, station.sink_spec, station.ctl, item, AsyncPump))
+    if runner is None:
+        return 0, {}, []
+    rv = await runner.run_async()
+    return runner.unit_result(rv)
+
+
+def start_loops(station):
+    """Starts the async_loops event loops that run a station's units, each
+       with up to its share of async_units, or --threads, at once."""
+    loops = max(1, int(station.opts.extra.get("async_loops", 1)))
+    units = int(station.opts.extra.get("async_units", 0)) or station.opts.threads
+    for i in range(loops):
+        thread = threading.Thread(target=run_loop, name="w" + str(i),
+                                  args=(station, i, max(1, -(-units // loops))))
+        thread.daemon = True
+        thread.start()
+
+
+def run_loop(station, index: int, units: int):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Endpoints that can't do their I/O on the loop block a thread of the
+    # executor for each unit; the others only use one briefly, to connect or
+    # to merge a unit, and the executor starts threads as they are needed.
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(units + 1, thread_name_prefix=f'w{index}'))
+    slots = threading.Semaphore(units)
+    running = set()
+
+    def start_unit(item):
+        task = loop.create_task(run_item(station, index, item, slots))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    def feed():
+        # A unit is only taken off the station's queue once this loop has a
+        # free slot for it, so that other loops can take it instead.
+        while True:
+            slots.acquire()
+            loop.call_soon_threadsafe(start_unit, station.queue.get())
+
+    feeder = threading.Thread(target=feed, name=f'f{index}')
+    feeder.daemon = True
+    feeder.start()
+    loop.run_forever()
+
+
+async def run_item(station, index: int, item, slots: threading.Semaphore):
+    try:
+        result = await run_unit(station, item)
+    except Exception as e:
+        logging.exception(f'error: worker {index} failed')
+        result = (f'error: worker failed: {e}', {}, [])
+    try:
+        # Merging may re-queue the unit, or refresh the source's topology.
+        await asyncio.get_running_loop().run_in_executor(None, station.unit_done, result, item)
+        station.queue.task_done()
+    finally:
+        slots.release()
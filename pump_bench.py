@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+"""Micro benchmarks for the pump transfer engine.
+
+Run as: python3 pump_bench.py [--msgs N] [--batch-sizes N,..] [--threads N,..]
+                              [--memory] [benchmark ...]
+"""
+
+import contextlib
+import io
+import optparse
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cb_bin_client
+import couchbaseConstants
+import pump
+import pump_bfd
+import pump_csv
+import pump_dcp
+import pump_gen
+
+VBUCKETS_NUM = 1024
+
+BLACKHOLE = 'blackhole://'
+
+# (label, msgs, seconds, bytes, peak bytes allocated or None if not traced)
+BENCH_RESULT = Tuple[str, int, float, int, Optional[int]]
+
+
+class BenchOpts(object):
+    """Stands in for the parsed cbtransfer options an EndPoint expects."""
+
+    def __init__(self, extra=None, threads=1):
+        self.extra = {'batch_max_size': 1000,
+                      'batch_max_bytes': 400000,
+                      'report': 0,
+                      'report_full': 0}
+        self.extra.update(extra or {})
+        self.collection = None
+        self.verbose = 0
+        self.threads = threads
+        self.processes = False
+        self.dry_run = False
+        self.process_name = 'bench'
+        self.username = self.password = None
+        self.ssl = False
+        self.mode = 'full'
+
+
+def legacy_group_by_vbucket_id(batch, vbuckets_num, rehash=0) -> Dict[int, List[couchbaseConstants.BATCH_MSG]]:
+    """The per-key hashing loop group_by_vbucket_id used before it hashed a
+       whole batch at once, kept as the baseline to compare against."""
+    g: Dict[int, List[couchbaseConstants.BATCH_MSG]] = defaultdict(list)
+    for msg in batch.msgs:
+        cmd, vbucket_id, key = msg[:3]
+        if vbucket_id == 0x0000ffff or rehash == 1:
+            if batch.source.opts.collection:
+                key = cb_bin_client.skip_collection_id(key)
+            if isinstance(key, str):
+                key = key.encode()
+            vbucket_id = ((zlib.crc32(key) >> 16) & 0x7FFF) % vbuckets_num
+            msg = (cmd, vbucket_id) + msg[2:]  # type: ignore
+        g[vbucket_id].append(msg)
+    return g
+
+
+def write_csv(path: str, msgs: int):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('id,value\n')
+        for i in range(msgs):
+            f.write(f'key::{i:010d},"b\'{{""n"": {i}}}\'"\n')
+
+
+def read_batches(source: pump.Source) -> Tuple[List[pump.Batch], float]:
+    batches = []
+    start = time.perf_counter()
+    while True:
+        rv, batch = source.provide_batch()
+        if rv != 0:
+            sys.exit(f'error: {rv}')
+        if not batch:
+            break
+        batches.append(batch)
+    return batches, time.perf_counter() - start
+
+
+def time_grouping(batches: List[pump.Batch], group: Callable) -> float:
+    start = time.perf_counter()
+    for batch in batches:
+        group(batch, VBUCKETS_NUM)
+    return time.perf_counter() - start
+
+
+def bench_csv_import(bench_opts) -> List[BENCH_RESULT]:
+    """Imports a csv of msgs keys, which has no vbucket ids, so every key is
+       hashed when the batches are grouped for the destination."""
+    msgs = bench_opts.msgs
+    results: List[BENCH_RESULT] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.csv')
+        write_csv(path, msgs)
+        opts = BenchOpts()
+        source = pump_csv.CSVSource(opts, path, {'name': 'bench'}, {'hostname': 'N/A'}, None, None,
+                                    {'stop': False}, defaultdict(int))
+        batches, read_secs = read_batches(source)
+        n = sum(batch.size() for batch in batches)
+
+    legacy_secs = time_grouping(batches, legacy_group_by_vbucket_id)
+    batched_secs = time_grouping(batches, pump.Batch.group_by_vbucket_id)
+    results.append(('csv read', n, read_secs, 0, None))
+    results.append(('group_by_vbucket_id, per key (before)', n, legacy_secs, 0, None))
+    results.append(('group_by_vbucket_id, batched' + (' numpy' if pump.numpy is not None else ''), n, batched_secs,
+                    0, None))
+    results.append(('csv import, per key (before)', n, read_secs + legacy_secs, 0, None))
+    results.append(('csv import, batched', n, read_secs + batched_secs, 0, None))
+    return results
+
+
+class MockDCPSource(pump_dcp.DCPStreamSource):
+    """A DCPStreamSource whose stream is generated in process instead of read
+       off a connection: a feeder thread queues the responses of one vbucket
+       stream as the reader thread would, which the source then parses."""
+
+    @staticmethod
+    def check(opts, spec):
+        return 0, {'spec': spec,
+                   'buckets': [{'name': 'default',
+                                'nodes': [{'hostname': f'N/A-{i!s}', 'version': '0.0.0-0000-enterprise'}
+                                          for i in range(opts.threads)]}]}
+
+    @staticmethod
+    def total_msgs(opts, source_bucket, source_node, source_map):
+        return 0, None
+
+    def reads_on_loop(self):
+        # The responses are queued by the feeder thread, not read off a socket.
+        return False
+
+    def get_dcp_conn(self):
+        if not self.running:
+            self.running = True
+            self.stream_list[0] = (0, 0, 0, 0, 0, 0, 0)
+            feeder = threading.Thread(target=self.feed, name=f'feed-{self.source_node["hostname"]}', daemon=True)
+            feeder.start()
+        return 0
+
+    def feed(self):
+        msgs = int(self.opts.extra['bench_msgs'])
+        value = b'{"n": 0, "body": "' + b'x' * 64 + b'"}'
+        for i in range(msgs):
+            key = f'key::{i:010d}'.encode()
+            extra = struct.pack(couchbaseConstants.DCP_MUTATION_PKT_FMT, i + 1, 1, 0, 0, 0, 0, 0)
+            body = extra + key + value
+            self.response.put((couchbaseConstants.CMD_DCP_MUTATION, i % VBUCKETS_NUM, 0, i + 1, len(key),
+                               len(extra), body, len(body), couchbaseConstants.DATATYPE_JSON,
+                               couchbaseConstants.MIN_RECV_PACKET + len(body)))
+        extra = struct.pack(couchbaseConstants.DCP_END_STREAM_PKT_FMT, 0)
+        self.response.put((couchbaseConstants.CMD_DCP_END_STREAM, 0, 0, 0, 0, len(extra), extra, len(extra), 0,
+                           couchbaseConstants.MIN_RECV_PACKET + len(extra)))
+
+
+def transfer(source_class, source_spec: str, sink_class, sink_spec: str, opts, trace: bool = False) -> \
+        Tuple[int, float, int, Optional[int]]:
+    """Runs the buckets of a source through a PumpingStation with data_only,
+       returning the msgs and bytes the sink took, the seconds it took and,
+       when traced, the peak bytes allocated meanwhile."""
+    rv, source_map = source_class.check(opts, source_spec)
+    if rv != 0:
+        sys.exit(f'error: {rv}')
+    rv, sink_map = sink_class.check(opts, sink_spec, source_map)
+    if rv != 0:
+        sys.exit(f'error: {rv}')
+    station = pump.PumpingStation(opts, source_class, source_spec, sink_class, sink_spec)
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        # The station reports progress on stderr at the end of each bucket.
+        with contextlib.redirect_stderr(io.StringIO()):
+            rv = station.transfer_buckets(list(source_map['buckets']), source_map, sink_map)
+    finally:
+        station.stop_workers()
+    secs = time.perf_counter() - start
+    peak = None
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    if rv != 0:
+        sys.exit(f'error: {rv}')
+    return station.cur['tot_sink_msg'], secs, station.cur['tot_sink_byte'], peak
+
+
+def engine_opts(bench_opts, batch_size: int, threads: int, extra=None) -> BenchOpts:
+    return BenchOpts(dict({'batch_max_size': batch_size, 'data_only': 1, 'node_retry': 0, 'topology_interval': 0,
+                           'max_retry': 10, 'mcd_compatible': 1}, **(extra or {})), threads)
+
+
+def engine_runs(bench_opts, run: Callable[[int, int], Tuple[int, float, int, Optional[int]]],
+                threads_list: Optional[List[int]] = None) -> List[BENCH_RESULT]:
+    results: List[BENCH_RESULT] = []
+    for batch_size in bench_opts.batch_sizes:
+        for threads in threads_list or bench_opts.threads:
+            n, secs, nbytes, peak = run(batch_size, threads)
+            results.append((f'batch {batch_size}, threads {threads}', n, secs, nbytes, peak))
+    return results
+
+
+def bench_gen(bench_opts) -> List[BENCH_RESULT]:
+    """Generated documents into a blackhole sink."""
+    def run(batch_size, threads):
+        spec = f'gen:max-items={bench_opts.msgs // threads},exit-after-creates=1,ratio-sets=1.0,min-value-size=64'
+        return transfer(pump_gen.GenSource, spec, pump.BlackholeSink, BLACKHOLE,
+                        engine_opts(bench_opts, batch_size, threads), bench_opts.memory)
+    return engine_runs(bench_opts, run)
+
+
+def bench_bfd(bench_opts) -> List[BENCH_RESULT]:
+    """A backup directory, of one node per thread, into a blackhole sink. The
+       backup is made from the mock DCP stream beforehand."""
+    def run(batch_size, threads):
+        with tempfile.TemporaryDirectory() as tmp:
+            transfer(MockDCPSource, 'http://bench', pump_bfd.BFDSink, tmp,
+                     engine_opts(bench_opts, 1000, threads, {'bench_msgs': bench_opts.msgs // threads}))
+            return transfer(pump_bfd.BFDSource, tmp, pump.BlackholeSink, BLACKHOLE,
+                            engine_opts(bench_opts, batch_size, threads), bench_opts.memory)
+    return engine_runs(bench_opts, run)
+
+
+def bench_csv(bench_opts) -> List[BENCH_RESULT]:
+    """A csv file into a blackhole sink; a csv is read by a single worker."""
+    def run(batch_size, threads):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.csv')
+            write_csv(path, bench_opts.msgs)
+            return transfer(pump_csv.CSVSource, path, pump.BlackholeSink, BLACKHOLE,
+                            engine_opts(bench_opts, batch_size, threads), bench_opts.memory)
+    return engine_runs(bench_opts, run, [1])
+
+
+def bench_dcp(bench_opts) -> List[BENCH_RESULT]:
+    """A DCP stream per thread, generated in process, into a blackhole sink."""
+    def run(batch_size, threads):
+        opts = engine_opts(bench_opts, batch_size, threads, {'bench_msgs': bench_opts.msgs // threads})
+        return transfer(MockDCPSource, 'http://bench', pump.BlackholeSink, BLACKHOLE, opts, bench_opts.memory)
+    return engine_runs(bench_opts, run)
+
+
+BENCHMARKS: Dict[str, Callable[[Any], List[BENCH_RESULT]]] = {
+    'csv_import': bench_csv_import,
+    'engine_gen': bench_gen,
+    'engine_bfd': bench_bfd,
+    'engine_csv': bench_csv,
+    'engine_dcp': bench_dcp,
+}
+
+
+def int_list(option, opt, value, parser):
+    setattr(parser.values, option.dest, [int(v) for v in value.split(',')])
+
+
+def main(argv: List[str]) -> int:
+    p = optparse.OptionParser(usage="%prog [--msgs N] [--batch-sizes N,..] [--threads N,..] [--memory] "
+                                    "[benchmark ...]")
+    p.add_option("", "--msgs", action="store", type="int", default=1000000,
+                 help="Number of messages per benchmark")
+    p.add_option("", "--batch-sizes", action="callback", type="string", callback=int_list, default=[100, 1000],
+                 help="Comma-separated batch_max_size values the engine benchmarks are run with")
+    p.add_option("", "--threads", action="callback", type="string", callback=int_list, default=[1, 4],
+                 help="Comma-separated numbers of threads the engine benchmarks are run with")
+    p.add_option("", "--memory", action="store_true", default=False,
+                 help="Trace allocations of the engine benchmarks, which slows them down, to report the peak "
+                      "bytes allocated per msg")
+    opts, names = p.parse_args(argv[1:])
+    for name in names or list(BENCHMARKS):
+        if name not in BENCHMARKS:
+            p.error(f'unknown benchmark: {name}; one of: {", ".join(BENCHMARKS)}')
+        print(f'{name}:')
+        for label, n, secs, nbytes, peak in BENCHMARKS[name](opts):
+            rate = n / secs if secs else 0
+            line = f'  {label:<45} {n:>10} msgs {secs:>8.3f}s {rate:>14,.0f} msgs/sec'
+            if nbytes:
+                line += f' {nbytes / secs / 1e6 if secs else 0:>10,.1f} MB/sec'
+            if peak is not None:
+                line += f' {peak / n if n else 0:>10,.1f} peak bytes/msg'
+            print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,22 +1,27 @@
 #!/usr/bin/env python3
 
+import contextlib
 import copy
 import datetime
 import errno
 import fnmatch
 import glob
+import importlib
 import json
 import logging
 import os
 import sqlite3
+import threading
 import time
 import urllib.error
 import urllib.parse
 import urllib.request
+from types import ModuleType
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import couchbaseConstants
 import pump
+import pump_checksum
 
 CBB_VERSION = [2004, 2014, 2015]  # sqlite pragma user version.
 
@@ -25,6 +30,33 @@ INDEX_FILE_NAME = "index.json"
 FTS_FILE_NAME = "fts_index.json"
 FTS_ALIAS_FILE_NAME = "fts_alias.json"
 
+fcntl: Optional[ModuleType]
+try:
+    fcntl = importlib.import_module('fcntl')
+except ImportError:
+    fcntl = None
+
+# Serializes the read-modify-write of the per-node json files, which are
+# shared by every sink writing a vbucket range of the same node.
+JSON_FILE_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def json_file_lock(parent_dir: str):
+    """Holds JSON_FILE_LOCK and, where there is fcntl, an exclusive flock of
+       the node directory of the json files, so that the sinks of other
+       worker processes, with --processes, wait for it as well."""
+    with JSON_FILE_LOCK:
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(parent_dir, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
 
 class BFD:
     """Mixin for backup-file/directory EndPoint helper methods."""
@@ -82,6 +114,16 @@ class BFD:
         except IOError:
             return "0.0.0"
 
+    @staticmethod
+    def read_meta(parent_dir: str) -> Dict[str, Any]:
+        try:
+            json_file = open(os.path.join(parent_dir, "meta.json"), "r")
+            json_data = json.load(json_file)
+            json_file.close()
+            return json_data
+        except (IOError, ValueError):
+            return {}
+
     @staticmethod
     def get_failover_log(parent_dir: str) -> Dict[str, Any]:
         try:
@@ -102,39 +144,40 @@ class BFD:
 
     @staticmethod
     def write_json_file(parent_dir, filename, output_data):
-        filepath = os.path.join(parent_dir, filename)
-        json_data = {}
-        if os.path.isfile(filepath):
-            # load into existed meta data generated from previous batch run
-            try:
-                json_file = open(filepath, "r")
-                json_data = json.load(json_file)
-                json_file.close()
-            except IOError:
-                pass
-
-        for i in range(BFD.NUM_VBUCKET):
-            if output_data.get(i):
-                str_index = str(i)
-                historic_data_exist = json_data.get(str_index)
-                if historic_data_exist:
-                    # Historic data will share same data type as incoming ones.
-                    # It will be sufficient to only check type for historic data
-                    if isinstance(json_data[str_index], int):
-                        # For seqno, we want to keep the highest seqno
-                        if json_data[str_index] < output_data[i]:
-                            json_data[str_index] = output_data[i]
-                    elif isinstance(json_data[str_index], list):
-                        # For each vbucket, we want to get the superset of its references
-                        if len(json_data[str_index]) <= len(output_data[i]):
-                            json_data[str_index] = output_data[i]
-                else:
-                    # Bookkeeping the incoming one.
-                    json_data[str_index] = output_data[i]
+        with json_file_lock(parent_dir):
+            filepath = os.path.join(parent_dir, filename)
+            json_data = {}
+            if os.path.isfile(filepath):
+                # load into existed meta data generated from previous batch run
+                try:
+                    json_file = open(filepath, "r")
+                    json_data = json.load(json_file)
+                    json_file.close()
+                except IOError:
+                    pass
+
+            for i in range(BFD.NUM_VBUCKET):
+                if output_data.get(i):
+                    str_index = str(i)
+                    historic_data_exist = json_data.get(str_index)
+                    if historic_data_exist:
+                        # Historic data will share same data type as incoming ones.
+                        # It will be sufficient to only check type for historic data
+                        if isinstance(json_data[str_index], int):
+                            # For seqno, we want to keep the highest seqno
+                            if json_data[str_index] < output_data[i]:
+                                json_data[str_index] = output_data[i]
+                        elif isinstance(json_data[str_index], list):
+                            # For each vbucket, we want to get the superset of its references
+                            if len(json_data[str_index]) <= len(output_data[i]):
+                                json_data[str_index] = output_data[i]
+                    else:
+                        # Bookkeeping the incoming one.
+                        json_data[str_index] = output_data[i]
 
-        json_file = open(filepath, "w")
-        json.dump(json_data, json_file, ensure_ascii=False)
-        json_file.close()
+            json_file = open(filepath, "w")
+            json.dump(json_data, json_file, ensure_ascii=False)
+            json_file.close()
 
     @staticmethod
     def db_dir(spec: str, bucket_name: str, node_name: str, tmstamp: Optional[str] = None, mode: Optional[str] = None,
@@ -431,6 +474,30 @@ class BFDSource(BFD, pump.Source):
 
         return 0, None
 
+    @staticmethod
+    def provide_digests(opts, source_spec: str, source_bucket: Dict[str, Any],
+                        source_map: Any) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[Dict[int, int]]]:
+        """Adds up the digests recorded in the meta.json of every directory
+           the bucket's documents are read from, which are those of all its
+           nodes and backup sessions."""
+        digests: Dict[int, int] = {}
+        recorded = False
+        for source_node in source_bucket['nodes']:
+            files = glob.glob(BFD.db_dir(source_spec, source_bucket['name'], source_node['hostname']) + "/data-*.cbb")
+            if not files:
+                rv, files = BFDSource.list_files(opts, source_spec, source_bucket['name'], source_node['hostname'],
+                                                 "data-*.cbb")
+                if rv != 0:
+                    return rv, None
+            for db_dir in sorted(set(os.path.dirname(f) for f in files)):
+                json_data = BFD.read_meta(db_dir)
+                if 'digests' in json_data:
+                    recorded = True
+                    pump_checksum.merge(digests, pump_checksum.from_json(json_data['digests']))
+        if not recorded:
+            return 0, None
+        return 0, digests
+
     @staticmethod
     def read_index_file(source_spec: str, source_bucket: Dict[str, Any],
                         file_name: str) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[str]]:
@@ -460,14 +527,17 @@ class BFDSource(BFD, pump.Source):
         except IOError:
             return "seqno"
 
+    def reads_on_loop(self) -> bool:
+        # The backup files are local, so reading them never waits for long.
+        return True
+
     def provide_batch(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
         if self.done:
             return 0, None
 
         batch = pump.Batch(self)
 
-        batch_max_size = self.opts.extra['batch_max_size']
-        batch_max_bytes = self.opts.extra['batch_max_bytes']
+        batch_max_size, batch_max_bytes = self.batch_limits()
 
         s = ["SELECT cmd, vbucket_id, key, flg, exp, cas, meta, val FROM cbb_msg",
              "SELECT cmd, vbucket_id, key, flg, exp, cas, meta, val, seqno, dtype, meta_size FROM cbb_msg",
@@ -525,7 +595,7 @@ class BFDSource(BFD, pump.Source):
                     key = row[2]
                     val = row[7]
 
-                    if self.skip(key, vbucket_id):
+                    if self.skip(key, vbucket_id, row[0], row[4]):
                         continue
 
                     if ver == 2:
@@ -637,6 +707,8 @@ class BFDSink(BFD, pump.Sink):
         super(BFDSink, self).__init__(opts, spec, source_bucket, source_node,
                                       source_map, sink_map, ctl, cur)
         self.mode = "full"
+        # The node directory the worker writes to, once it created a db.
+        self.digest_dir: Optional[str] = None
         self.init_worker(BFDSink.run)
 
     @staticmethod
@@ -680,13 +752,20 @@ class BFDSink(BFD, pump.Sink):
                 if rv != 0:
                     return self.future_done(future, rv)
 
+                self.digest_dir = db_dir
                 meta_file = os.path.join(db_dir, "meta.json")
-                json_file = open(meta_file, "w")
                 to_write = {'pred': dep,
                             'conflict_resolution_type': conf_res_type,
                             'version': version}
-                json.dump(to_write, json_file, ensure_ascii=False)
-                json_file.close()
+                with json_file_lock(db_dir):
+                    # Keep the digests that sinks of other vbucket ranges of
+                    # the node already recorded.
+                    digests = BFD.read_meta(db_dir).get('digests')
+                    if digests:
+                        to_write['digests'] = digests
+                    json_file = open(meta_file, "w")
+                    json.dump(to_write, json_file, ensure_ascii=False)
+                    json_file.close()
 
             if not batch:
                 if db:
@@ -706,8 +785,6 @@ class BFDSink(BFD, pump.Sink):
 
                 for msg in batch.msgs:
                     cmd, vbucket_id, key, flg, exp, cas, meta, val, seqno, dtype, nmeta, conf_res = msg
-                    if self.skip(key, vbucket_id):
-                        continue
                     if cmd not in [couchbaseConstants.CMD_TAP_MUTATION,
                                    couchbaseConstants.CMD_TAP_DELETE,
                                    couchbaseConstants.CMD_DCP_MUTATION,
@@ -739,6 +816,23 @@ class BFDSink(BFD, pump.Sink):
             except Exception as e:
                 return self.future_done(future, f'error: db exception: {e!s}')
 
+    def record_digests(self, digests: Dict[int, int]):
+        """Adds the digests of the documents this sink wrote into those in
+           the meta.json of its node directory."""
+        if not self.digest_dir:
+            return
+        with json_file_lock(self.digest_dir):
+            json_data = BFD.read_meta(self.digest_dir)
+            recorded = pump_checksum.from_json(json_data.get('digests', {}))
+            pump_checksum.merge(recorded, digests)
+            json_data['digests'] = pump_checksum.to_json(recorded)
+            try:
+                json_file = open(os.path.join(self.digest_dir, "meta.json"), "w")
+                json.dump(json_data, json_file, ensure_ascii=False)
+                json_file.close()
+            except IOError as e:
+                logging.warning(f'could not record checksums in: {self.digest_dir}; exception: {e}')
+
     @staticmethod
     def can_handle(opts, spec: str) -> bool:
         spec = os.path.normpath(spec)
@@ -824,7 +918,11 @@ class BFDSink(BFD, pump.Sink):
         if rv != 0:
             return rv, None, None
 
-        path = f'{dir}/data-{num!s:0>4}.cbb'
+        if self.vbucket_range is not None:
+            # Sinks for different vbucket ranges of a node share its directory.
+            path = f'{dir}/data-r{self.vbucket_range_index!s:0>2}-{num!s:0>4}.cbb'
+        else:
+            path = f'{dir}/data-{num!s:0>4}.cbb'
         rv, db = create_db(path, self.opts)
         if rv != 0:
             return rv, None, None
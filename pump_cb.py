@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
 import logging
 import time
 import urllib.error
 import urllib.parse
 import urllib.request
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 import cb_bin_client
 import couchbaseConstants
 import pump
 import pump_mc
+import pump_metrics
 from cluster_manager import ClusterManager, ServiceNotAvailableException
 
 
@@ -34,6 +36,8 @@ class CBSink(pump_mc.MCSink):
                                      source_map, sink_map, ctl, cur)
 
         self.rehash = opts.extra.get("rehash", 0)
+        # The vbuckets find_conn_async has found a connection for.
+        self.loop_vbuckets: Set[int] = set()
 
     def add_start_event(self, conn: Optional[cb_bin_client.MemcachedClient]) -> couchbaseConstants.PUMP_ERROR:
         sasl_user = str(self.source_bucket.get("name", pump.get_username(self.opts.username)))
@@ -80,7 +84,11 @@ class CBSink(pump_mc.MCSink):
         vbuckets = batch.group_by_vbucket_id(vbuckets_num, self.rehash)
         vbucket_skip_list: Dict[int, List[int]] = {}
 
+        if self.node_limiter:
+            self.throttle_nodes(self.node_loads(vbuckets))
+
         # Scatter or send phase.
+        start = time.monotonic()
         for vbucket_id, msgs in vbuckets.items():
             rv, conn = self.find_conn(mconns, vbucket_id, msgs)
             if rv != 0:
@@ -93,6 +101,8 @@ class CBSink(pump_mc.MCSink):
                 if len(skipped) > 0:
                     vbucket_skip_list[vbucket_id] = skipped
 
+        pump_metrics.observe(self.cur, 'send', time.monotonic() - start)
+
         # Yield to let other threads do stuff while server's processing.
         time.sleep(0.01)
 
@@ -100,6 +110,7 @@ class CBSink(pump_mc.MCSink):
         need_refresh = False
 
         # Gather or recv phase.
+        start = time.monotonic()
         for vbucket_id, msgs in vbuckets.items():
             rv, conn = self.find_conn(mconns, vbucket_id, msgs)
             if rv != 0:
@@ -114,11 +125,86 @@ class CBSink(pump_mc.MCSink):
             if refresh:
                 need_refresh = True
 
+        pump_metrics.observe(self.cur, 'recv', time.monotonic() - start)
+
         if need_refresh:
             self.refresh_sink_map()
 
         return 0, retry_batch, retry_batch is not None and not need_refresh
 
+    async def scatter_gather_async(self, mconns: Dict[str, cb_bin_client.MemcachedClient], batch: pump.Batch) -> \
+            Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch], Optional[bool]]:
+        """scatter_gather on the event loop, which needs no yield while the
+           servers process the batch."""
+        sink_map_buckets = self.sink_map['buckets']
+        if len(sink_map_buckets) != 1:
+            return "error: CBSink.run() expected 1 bucket in sink_map", None, None
+
+        vbuckets_num = len(sink_map_buckets[0]['vBucketServerMap']['vBucketMap'])
+        vbuckets = batch.group_by_vbucket_id(vbuckets_num, self.rehash)
+        vbucket_skip_list: Dict[int, List[int]] = {}
+
+        if self.node_limiter:
+            await self.throttle_nodes_async(self.node_loads(vbuckets))
+
+        # Scatter or send phase.
+        start = time.monotonic()
+        for vbucket_id, msgs in vbuckets.items():
+            rv, conn = await self.find_conn_async(mconns, vbucket_id, msgs)
+            if rv != 0:
+                return rv, None, None
+            if conn is not None:
+                rv, skipped = await self.send_msgs_async(conn, msgs, self.operation(), vbucket_id=vbucket_id)
+                if rv != 0:
+                    return rv, None, None
+                if len(skipped) > 0:
+                    vbucket_skip_list[vbucket_id] = skipped
+
+        pump_metrics.observe(self.cur, 'send', time.monotonic() - start)
+
+        retry_batch = None
+        need_refresh = False
+
+        # Gather or recv phase.
+        start = time.monotonic()
+        for vbucket_id, msgs in vbuckets.items():
+            rv, conn = await self.find_conn_async(mconns, vbucket_id, msgs)
+            if rv != 0:
+                return rv, None, None
+            if conn is not None:
+                rv, retry, refresh = await self.recv_msgs_async(conn, msgs, vbucket_skip_list.get(vbucket_id, []),
+                                                                vbucket_id=vbucket_id)
+            if rv != 0:
+                return rv, None, None
+            if retry:
+                retry_batch = batch
+            if refresh:
+                need_refresh = True
+
+        pump_metrics.observe(self.cur, 'recv', time.monotonic() - start)
+
+        if need_refresh:
+            await asyncio.get_running_loop().run_in_executor(None, self.refresh_sink_map)
+            self.loop_vbuckets.clear()
+
+        return 0, retry_batch, retry_batch is not None and not need_refresh
+
+    async def find_conn_async(self, mconns: Dict[str, cb_bin_client.MemcachedClient], vbucket_id: int, msgs) -> \
+            Tuple[couchbaseConstants.PUMP_ERROR, Optional[cb_bin_client.MemcachedClient]]:
+        """find_conn on the event loop. The first lookup of a vbucket may
+           connect, so it is done in the executor."""
+        if vbucket_id in self.loop_vbuckets:
+            return self.find_conn(mconns, vbucket_id, msgs)
+        rv, conn = await asyncio.get_running_loop().run_in_executor(None, self.find_conn, mconns, vbucket_id, msgs)
+        if rv == 0 and conn is not None:
+            conn.s.setblocking(False)  # type: ignore
+            self.loop_vbuckets.add(vbucket_id)
+        return rv, conn
+
+    def close_loop_mconns(self):
+        super(CBSink, self).close_loop_mconns()
+        self.loop_vbuckets.clear()
+
     @staticmethod
     def map_recovery_buckets(sink_map: Dict[str, Any], bucket_name: str, vbucket_list: str):
         """When we do recovery of vbuckets the vbucket map is not up to date, but
@@ -156,6 +242,12 @@ class CBSink(pump_mc.MCSink):
                 spec.startswith("couchbase://") or
                 spec.startswith("https://"))
 
+    @staticmethod
+    def overlap_metadata(opts) -> bool:
+        # Design docs and index definitions go to the cluster's REST services,
+        # independently of the documents sent to the data service.
+        return True
+
     @staticmethod
     def check_source(opts, source_class, source_spec: str, sink_class, sink_spec: str) -> couchbaseConstants.PUMP_ERROR:
         if source_spec.startswith("http://") or source_spec.startswith("couchbase://"):
@@ -269,6 +361,12 @@ class CBSink(pump_mc.MCSink):
         except ValueError as e:
             return f'error: could not parse source design; exception: {e!s}'
 
+        if int(opts.extra.get("defer_index_build", 0)) and isinstance(sd, dict):
+            # Only create the indexes, so they don't build while documents
+            # are still being transferred; BUILD INDEX builds them later.
+            for definition in sd.get('definitions') or []:
+                definition['deferred'] = True
+
         try:
             sink_bucket = sink_map['buckets'][0]
             username = opts.username
@@ -399,6 +497,20 @@ class CBSink(pump_mc.MCSink):
 
         return 0
 
+    def node_loads(self, vbuckets: Dict[int, List[couchbaseConstants.BATCH_MSG]]) -> Dict[str, Tuple[int, int]]:
+        """Returns the (ops, bytes) that grouped msgs put on each destination node."""
+        vbucket_server_map = self.sink_map['buckets'][0]['vBucketServerMap']
+        vbucket_map = vbucket_server_map['vBucketMap']
+        server_list = vbucket_server_map['serverList']
+        loads: Dict[str, Tuple[int, int]] = {}
+        for vbucket_id, msgs in vbuckets.items():
+            if vbucket_id >= len(vbucket_map) or vbucket_map[vbucket_id][0] < 0:
+                continue  # find_conn reports the missing vbucket.
+            node = server_list[vbucket_map[vbucket_id][0]]
+            ops, nbytes = loads.get(node, (0, 0))
+            loads[node] = (ops + len(msgs), nbytes + sum(len(msg[7]) for msg in msgs))
+        return loads
+
     def find_conn(self, mconns: Dict[str, cb_bin_client.MemcachedClient], vbucket_id: int, msgs) -> \
             Tuple[couchbaseConstants.PUMP_ERROR, Optional[cb_bin_client.MemcachedClient]]:
         bucket = self.sink_map['buckets'][0]
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""Per-vbucket progress checkpoints, so an interrupted transfer can resume."""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import couchbaseConstants
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint(object):
+    """The highest seqno that the sink acknowledged per source bucket, node and
+       vbucket, with the vbucket's failover log and snapshot marker, as needed to
+       restart its DCP stream from there. In --processes mode it is served by
+       the station's multiprocessing manager."""
+
+    def __init__(self, state: Optional[Dict[str, Any]] = None):
+        self.lock = threading.Lock()
+        # bucket -> node -> {'seqno': {vbid: seqno},
+        #                    'failoverlog': {vbid: [[uuid, seqno], ...]},
+        #                    'snapshot': {vbid: [start, end]}}
+        # with vbids as str, as they are in JSON.
+        self.buckets: Dict[str, Dict[str, Dict[str, Dict[str, Any]]]] = {}
+        if state:
+            self.buckets = state.get('buckets', {})
+
+    @staticmethod
+    def load(path: str) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional['Checkpoint']]:
+        try:
+            with open(path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            return f'error: could not read checkpoint file: {path}; exception: {e}', None
+        if not isinstance(state, dict) or state.get('version') != CHECKPOINT_VERSION:
+            return f'error: unsupported checkpoint file: {path}', None
+        return 0, Checkpoint(state)
+
+    def update(self, bucket: str, node: str, seqnos: Dict[int, int], failoverlogs: Dict[int, List[Tuple[int, int]]],
+               snapshots: Dict[int, Tuple[int, int]]):
+        """Records the seqnos a pump's sink acknowledged, keeping the highest seen
+           per vbucket."""
+        with self.lock:
+            progress = self.buckets.setdefault(bucket, {}).setdefault(node, {'seqno': {}, 'failoverlog': {},
+                                                                             'snapshot': {}})
+            for vbid, seqno in seqnos.items():
+                vb = str(vbid)
+                if seqno < progress['seqno'].get(vb, 0):
+                    continue
+                progress['seqno'][vb] = seqno
+                if vbid in failoverlogs:
+                    progress['failoverlog'][vb] = [list(entry) for entry in failoverlogs[vbid]]
+                if vbid in snapshots:
+                    progress['snapshot'][vb] = list(snapshots[vbid])
+
+    def resume_state(self, bucket: str) -> Tuple[Dict[str, int], Dict[str, List[Tuple[int, int]]],
+                                                 Dict[str, Tuple[int, int]]]:
+        """Returns the seqno, failover log and snapshot marker per vbucket of a
+           bucket, from whichever source node streamed the vbucket furthest, as
+           vbuckets may have moved between nodes. They are shaped as a DCP
+           source expects them in its cur."""
+        seqnos: Dict[str, int] = {}
+        failoverlogs: Dict[str, List[Tuple[int, int]]] = {}
+        snapshots: Dict[str, Tuple[int, int]] = {}
+        with self.lock:
+            for progress in self.buckets.get(bucket, {}).values():
+                for vb, seqno in progress['seqno'].items():
+                    if seqno < seqnos.get(vb, 0):
+                        continue
+                    seqnos[vb] = seqno
+                    if vb in progress['failoverlog']:
+                        failoverlogs[vb] = [(entry[0], entry[1]) for entry in progress['failoverlog'][vb]]
+                    if vb in progress['snapshot']:
+                        snapshots[vb] = (progress['snapshot'][vb][0], progress['snapshot'][vb][1])
+        return seqnos, failoverlogs, snapshots
+
+    def state(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'version': CHECKPOINT_VERSION, 'time': time.time(), 'buckets': json.loads(json.dumps(self.buckets))}
+
+    def save(self, path: str):
+        """Rewrites the checkpoint file in place, so that it is never seen half
+           written even if the transfer dies while saving."""
+        tmp = f'{path}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.state(), f, sort_keys=True)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning(f'could not write checkpoint file: {path}; exception: {e}')
+
+
+def batch_progress(batch, progress: Dict[int, int]):
+    """Raises progress to the highest seqno of each vbucket in a batch."""
+    for msg in batch.msgs:
+        vbucket_id, seqno = msg[1], msg[8] if len(msg) > 8 else 0
+        if seqno > progress.get(vbucket_id, 0):
+            progress[vbucket_id] = seqno
+
+
+def flush(cur, checkpoint, bucket: str, node: str, progress: Dict[int, int]):
+    """Records a pump's progress into the station-wide checkpoint, along with
+       the failover logs and snapshot markers its source kept in cur, and
+       starts it over."""
+    if checkpoint is None or not progress:
+        return
+    pair_index = (bucket, node)
+    failoverlogs = {}
+    snapshots = {}
+    for vbid, seqno in progress.items():
+        log = entry(cur.get('failoverlog'), pair_index, vbid)
+        if log:
+            failoverlogs[vbid] = sorted(log, key=lambda tup: tup[1], reverse=True)
+        # The source may have read ahead into later snapshots; resuming from a
+        # seqno outside the snapshot it belongs to would be rejected, while an
+        # empty snapshot at the seqno is always accepted.
+        snapshot = entry(cur.get('snapshot'), pair_index, vbid)
+        if snapshot and snapshot[0] <= seqno <= snapshot[1]:
+            snapshots[vbid] = tuple(snapshot)
+        else:
+            snapshots[vbid] = (seqno, seqno)
+    checkpoint.update(bucket, node, dict(progress), failoverlogs, snapshots)
+    progress.clear()
+
+
+def entry(values, pair_index: Tuple[str, str], vbid: int) -> Any:
+    """Looks up a vbucket in a cur['failoverlog'] or cur['snapshot'] dict,
+       which a DCP source keys by int while resumed ones are keyed by str."""
+    if not values or pair_index not in values:
+        return None
+    by_vbucket = values[pair_index]
+    if vbid in by_vbucket:
+        return by_vbucket[vbid]
+    return by_vbucket.get(str(vbid))
+
+
+def resume(cur, checkpoint, bucket: str, node: str):
+    """Seeds a pump's cur with the progress recorded for its source bucket,
+       from which a DCP source restarts the streams of its node."""
+    if checkpoint is None:
+        return
+    seqnos, failoverlogs, snapshots = checkpoint.resume_state(bucket)
+    if not seqnos:
+        return
+    pair_index = (bucket, node)
+    for key, values in (('seqno', seqnos), ('failoverlog', failoverlogs), ('snapshot', snapshots)):
+        if not cur[key]:
+            cur[key] = {}
+        merged = dict(cur[key].get(pair_index) or {})
+        merged.update(values)
+        cur[key][pair_index] = merged
+
+
+class CheckpointWriter(threading.Thread):
+    """Periodically saves the checkpoint file while a transfer runs."""
+
+    def __init__(self, interval: float, save: Callable[[], None]):
+        super(CheckpointWriter, self).__init__(name="checkpoint", daemon=True)
+        self.interval = max(0.1, interval)
+        self.save = save
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.save()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.save()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Order-independent per-vbucket digests of the documents a transfer moved,
+   to validate it end to end."""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import snappy  # pylint: disable=import-error
+
+import couchbaseConstants
+
+CHECKSUM_VERSION = 1
+
+# Digests of the documents of a vbucket are summed, modulo 2**64, so that
+# they don't depend on the order documents arrive in, and so that the digests
+# of vbucket ranges or backup sessions add up to that of the whole.
+DIGEST_MASK = (1 << 64) - 1
+
+MUTATIONS = (couchbaseConstants.CMD_TAP_MUTATION, couchbaseConstants.CMD_DCP_MUTATION)
+
+
+def msg_digest(key: Any, cas: int, meta: Any, val: Any, dtype: int) -> int:
+    """Digest of a document's key, cas, revision and uncompressed value."""
+    if isinstance(key, str):
+        key = key.encode()
+    if isinstance(meta, int):
+        meta = meta.to_bytes(8, 'big')
+    elif isinstance(meta, str):
+        meta = meta.encode()
+    meta = meta or b''
+    if isinstance(val, str):
+        val = val.encode()
+    if dtype & couchbaseConstants.DATATYPE_COMPRESSED:
+        try:
+            val = snappy.uncompress(val)
+        except Exception:
+            pass
+    h = hashlib.blake2b(digest_size=8)
+    h.update(struct.pack('>IQI', len(key), cas & DIGEST_MASK, len(meta)))
+    h.update(key)
+    h.update(meta)
+    h.update(val or b'')
+    return int.from_bytes(h.digest(), 'big')
+
+
+def batch_digests(batch, digests: Dict[int, int]):
+    """Adds the documents of a batch into the digests of their vbuckets.
+       Deletions are left out, as tombstones may be purged."""
+    for msg in batch.msgs:
+        cmd, vbucket_id, key, _, _, cas, meta, val = msg[:8]
+        if cmd not in MUTATIONS:
+            continue
+        dtype = msg[9] if len(msg) > 9 else 0
+        digests[vbucket_id] = (digests.get(vbucket_id, 0) + msg_digest(key, cas, meta, val, dtype)) & DIGEST_MASK
+
+
+def merge(into: Dict[Any, int], digests: Dict[Any, int]):
+    for vbucket_id, digest in digests.items():
+        into[vbucket_id] = (into.get(vbucket_id, 0) + digest) & DIGEST_MASK
+
+
+def to_json(digests: Dict[int, int]) -> Dict[str, str]:
+    return {str(vbucket_id): f'{digest:016x}' for vbucket_id, digest in sorted(digests.items()) if digest}
+
+
+def from_json(digests: Dict[str, str]) -> Dict[int, int]:
+    return {int(vbucket_id): int(digest, 16) for vbucket_id, digest in digests.items()}
+
+
+def compare(expected: Dict[int, int], actual: Dict[int, int]) -> List[Tuple[int, int, int]]:
+    """Returns the (vbucket_id, expected, actual) digests that differ."""
+    return [(vbucket_id, expected.get(vbucket_id, 0), actual.get(vbucket_id, 0))
+            for vbucket_id in sorted(set(expected) | set(actual))
+            if expected.get(vbucket_id, 0) != actual.get(vbucket_id, 0)]
+
+
+class Digests(object):
+    """Station-wide digests per bucket and vbucket that pumps flush into. In
+       --processes mode it is served by the station's multiprocessing manager."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, Dict[int, int]] = {}
+
+    def add(self, bucket: str, digests: Dict[int, int]):
+        with self.lock:
+            merge(self.buckets.setdefault(bucket, {}), digests)
+
+    def bucket(self, bucket: str) -> Dict[int, int]:
+        with self.lock:
+            return dict(self.buckets.get(bucket, {}))
+
+    def state(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'version': CHECKSUM_VERSION,
+                    'buckets': {bucket: to_json(digests) for bucket, digests in self.buckets.items()}}
+
+
+def flush(digests, bucket: str, pending: Dict[int, int]):
+    """Adds a pump's digests into the station-wide ones and starts them over."""
+    if digests is None or not pending:
+        return
+    digests.add(bucket, dict(pending))
+    pending.clear()
+
+
+def load_file(path: str) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[Dict[str, Dict[int, int]]]]:
+    """Reads the digests per bucket that a transfer wrote to its checksum_file."""
+    try:
+        with open(path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        return f'error: could not read checksum file: {path}; exception: {e}', None
+    if not isinstance(state, dict) or state.get('version') != CHECKSUM_VERSION:
+        return f'error: unsupported checksum file: {path}', None
+    return 0, {bucket: from_json(digests) for bucket, digests in state.get('buckets', {}).items()}
+
+
+def save_file(path: str, state: Dict[str, Any]):
+    tmp = f'{path}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(state, f, sort_keys=True, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f'could not write checksum file: {path}; exception: {e}')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""Coalescing of the versions of a key that a source yields within a window
+   of batches, so that only the latest one is sent to the sink."""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import couchbaseConstants
+
+# The msgs, and value bytes, that coalescing saved are counted in a pump's
+# cur under these keys.
+COALESCE_MSG = 'tot_coalesce_msg'
+COALESCE_BYTE = 'tot_coalesce_byte'
+
+
+class Coalescer(object):
+    """Reads up to window batches from a source and merges them into one
+       batch, keeping only the highest seqno version of each key of each
+       vbucket. A kept msg stays where it was read, so msgs of a vbucket are
+       still in seqno order, and the highest seqno of each vbucket is still
+       sent for checkpoints. Versions without a seqno are ordered as read."""
+
+    def __init__(self, source, window: int, new_batch: Callable[[Any], Any]):
+        self.source = source
+        self.window = window
+        self.new_batch = new_batch
+
+    @staticmethod
+    def from_opts(opts, source, new_batch: Callable[[Any], Any]) -> Optional['Coalescer']:
+        """Returns a coalescer of the coalesce_window set in opts.extra, or
+           None if none is. Coalesced batches are made with new_batch."""
+        window = int(opts.extra.get("coalesce_window", 0))
+        if window <= 0:
+            return None
+        return Coalescer(source, window, new_batch)
+
+    def provide_batch(self, cur) -> Tuple[couchbaseConstants.PUMP_ERROR, Any]:
+        """Provides the coalesced batch of the next window, or None once the
+           source is exhausted. On an error the batches read so far are
+           dropped; they weren't acknowledged by the sink, so a retry of the
+           unit reads them again."""
+        batches: List[Any] = []
+        while len(batches) < self.window:
+            rv, batch = self.source.provide_batch()
+            if rv != 0:
+                return rv, None
+            if not batch:
+                break
+            batches.append(batch)
+        if not batches:
+            return 0, None
+        return 0, coalesce(batches, self.new_batch, cur)
+
+    async def provide_batch_async(self, cur) -> Tuple[couchbaseConstants.PUMP_ERROR, Any]:
+        """provide_batch for the async engine."""
+        batches: List[Any] = []
+        while len(batches) < self.window:
+            rv, batch = await self.source.provide_batch_async()
+            if rv != 0:
+                return rv, None
+            if not batch:
+                break
+            batches.append(batch)
+        if not batches:
+            return 0, None
+        return 0, coalesce(batches, self.new_batch, cur)
+
+
+def coalesce(batches: List[Any], new_batch: Callable[[Any], Any], cur) -> Any:
+    """Merges batches into one that has only the latest version of each key,
+       counting the msgs and bytes left out in cur."""
+    msgs = [msg for batch in batches for msg in batch.msgs]
+    latest: Dict[Tuple[int, Union[str, bytes]], int] = {}
+    for i, msg in enumerate(msgs):
+        k = (msg[1], msg[2])
+        j = latest.get(k)
+        if j is None or seqno(msg) >= seqno(msgs[j]):
+            latest[k] = i
+    if len(latest) == len(msgs) and len(batches) == 1:
+        return batches[0]
+
+    kept = set(latest.values())
+    # A msg is counted with the bytes its source appended it with.
+    sizes = [num_bytes for batch in batches for num_bytes in batch.msg_bytes]
+    saved = sum(num_bytes for i, num_bytes in enumerate(sizes) if i not in kept)
+    dropped = len(msgs) - len(kept)
+
+    out = new_batch(batches[0].source)
+    out.msgs = [msg for i, msg in enumerate(msgs) if i in kept]
+    out.msg_bytes = [num_bytes for i, num_bytes in enumerate(sizes) if i in kept]
+    out.bytes = sum(out.msg_bytes)
+    # The msgs left out no longer count towards the estimated total.
+    out.adjust_size = sum(batch.adjust_size for batch in batches) - dropped
+    cur[COALESCE_MSG] += dropped
+    cur[COALESCE_BYTE] += saved
+    return out
+
+
+def seqno(msg: couchbaseConstants.BATCH_MSG) -> int:
+    return msg[8] if len(msg) > 8 else 0  # type: ignore
@@ -64,6 +64,10 @@ class CSVSource(pump.Source):
         self.file.close()
         self.file = None
 
+    def reads_on_loop(self) -> bool:
+        # Rows are read from a local file, without waiting on the network.
+        return True
+
     def provide_batch(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
         if self.done:
             return 0, None
@@ -84,8 +88,7 @@ class CSVSource(pump.Source):
 
         batch = pump.Batch(self)
 
-        batch_max_size = self.opts.extra['batch_max_size']
-        batch_max_bytes = self.opts.extra['batch_max_bytes']
+        batch_max_size, batch_max_bytes = self.batch_limits()
 
         cmd = couchbaseConstants.CMD_TAP_MUTATION
         vbucket_id = 0x0000ffff
@@ -103,7 +106,7 @@ class CSVSource(pump.Source):
                         doc[field] = vals[i]
                     else:
                         doc[field] = number_try_parse(vals[i])
-                if doc['id']:
+                if doc['id'] and not self.skip(doc['id'], vbucket_id, cmd):
                     msg: couchbaseConstants.BATCH_MSG = (cmd, vbucket_id, doc['id'].encode(), 0, 0, 0, b'',
                                                          literal_eval(doc['value']), 0, 0, 0, 0)
                     batch.append(msg, len(doc))
@@ -206,8 +209,6 @@ class CSVSink(pump.Sink):
         msg_tuple_format = 0
         for msg in batch.msgs:
             cmd, vbucket_id, key, flg, exp, cas, meta, val_bytes = msg[:8]
-            if self.skip(key, vbucket_id):
-                continue
             if not msg_tuple_format:
                 msg_tuple_format = len(msg)
             seqno = dtype = nmeta = 0
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
 import logging
 import queue
@@ -7,8 +8,10 @@ import random
 import select
 import socket
 import struct
+import sys
 import threading
 import time
+from collections import defaultdict
 from typing import Any, Dict, List, Optional, Tuple
 
 import snappy
@@ -18,13 +21,81 @@ import couchbaseConstants
 import pump
 import pump_cb
 import pump_mc
+import pump_memory
+import pump_profile
 from cluster_manager import ClusterManager, ServiceNotAvailableException
 
+# Unpack the header of a response packet, and the extras of the DCP msgs
+# that carry documents.
+RES_PKT = struct.Struct(couchbaseConstants.RES_PKT_FMT)
+DCP_MUTATION_PKT = struct.Struct(couchbaseConstants.DCP_MUTATION_PKT_FMT)
+DCP_DELETE_PKT = struct.Struct(couchbaseConstants.DCP_DELETE_PKT_FMT)
+
 
 def bool_to_str(value):
     return str(bool(int(value))).lower()
 
 
+class RecvBuffer(object):
+    """A preallocated buffer that a socket is read into with recv_into, and
+       that response packets are parsed out of in place. Parsed bytes are
+       only moved when the free space behind them runs short, and then only
+       the partial packet left over is, so that frames stay contiguous."""
+
+    def __init__(self, size: int, recv_min_bytes: int):
+        self.recv_min_bytes = max(1, recv_min_bytes)
+        self.buf = bytearray(max(size, 2 * self.recv_min_bytes, couchbaseConstants.MIN_RECV_PACKET))
+        self.view = memoryview(self.buf)
+        self.start = 0  # The first byte not parsed yet.
+        self.end = 0  # The first byte not read yet.
+
+    def recv_into(self, sock: socket.socket) -> int:
+        """Reads as much as fits from sock, returning the bytes read."""
+        if len(self.buf) - self.end < self.recv_min_bytes:
+            self.compact()
+        return sock.recv_into(self.view[self.end:])
+
+    def filled(self, nbytes: int):
+        self.end += nbytes
+
+    def compact(self, need: int = 0):
+        """Moves the unparsed bytes to the front, growing the buffer if need
+           bytes, or the minimum receive size on top of them, won't fit."""
+        pending = self.end - self.start
+        size = max(len(self.buf), need, pending + self.recv_min_bytes)
+        if size > len(self.buf):
+            self.view.release()
+            buf = bytearray(size)
+            buf[:pending] = self.buf[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(self.buf)
+        elif pending:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def next_packet(self) -> Optional[Tuple[int, int, int, int, int, int, int, int, bytes]]:
+        """Returns the header fields and body of the next whole packet, or
+           None if it hasn't been read entirely yet."""
+        available = self.end - self.start
+        if available < couchbaseConstants.MIN_RECV_PACKET:
+            return None
+        magic, opcode, keylen, extlen, datatype, status, bodylen, opaque, cas = RES_PKT.unpack_from(self.buf,
+                                                                                                    self.start)
+        size = couchbaseConstants.MIN_RECV_PACKET + bodylen
+        if available < size:
+            if size > len(self.buf):
+                self.compact(size)
+            return None
+        body_start = self.start + couchbaseConstants.MIN_RECV_PACKET
+        # The body is copied once, as the queued response outlives the buffer.
+        body = bytes(self.view[body_start:body_start + bodylen])
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return opcode, keylen, extlen, datatype, status, bodylen, opaque, cas, body
+
+
 class DCPStreamSource(pump.Source, threading.Thread):
     """Can read from cluster/server/bucket via DCP streaming."""
     HIGH_SEQNO = "high_seqno"
@@ -35,6 +106,12 @@ class DCPStreamSource(pump.Source, threading.Thread):
     HIGH_SEQNO_BYTE = 8
     UUID_BYTE = 8
 
+    # Seconds without a response, while streams are open, after which the
+    # streams are taken to be done.
+    IDLE_TIMEOUT = 30
+
+    resumable = True
+
     def __init__(self, opts, spec: str, source_bucket, source_node: Dict[str, Any],
                  source_map, sink_map, ctl: Dict[str, Any], cur: Dict[str, Any]):
         if spec.startswith("https://"):
@@ -54,17 +131,38 @@ class DCPStreamSource(pump.Source, threading.Thread):
         self.version_supported: bool = self.source_node['version'].split(".") >= ["3", "0", "0"] or \
             (self.source_node['version'].split(".") == ['0', '0', '0-0000-enterprise'])
         self.recv_min_bytes: int = int(opts.extra.get("recv_min_bytes", 4096))
+        self.recv_buffer_bytes: int = int(opts.extra.get("recv_buffer_bytes", 262144))
         self.batch_max_bytes: int = int(opts.extra.get("batch_max_bytes", 400000))
         self.flow_control = int(opts.extra.get("flow_control", 1))
         self.vbucket_list = getattr(opts, "vbucket_list", None)
         self.r = random.Random()
         self.queue_size = int(opts.extra.get("dcp_consumer_queue_length", 1000))
         self.response: queue.Queue = queue.Queue(self.queue_size)
+        # Holds the responses queued by the reader thread against the memory
+        # budget, with -x memory_budget.
+        self.lease = pump_memory.lease(ctl)
         self.running = False
+        # Set once the reader thread stops, which also queues a None to wake
+        # provide_dcp_batch_actual.
+        self.reader_done = threading.Event()
+        # Set while the reader thread waits for the memory budget, rather than
+        # for the server, and when it last stopped waiting, so that the
+        # consumer doesn't take the streams to be idle meanwhile.
+        self.throttled = threading.Event()
+        self.throttled_until = 0.0
+        # The buffer the responses are read into on the async engine's event
+        # loop, when they are read there rather than by the reader thread.
+        self.loop_buffer: Optional[RecvBuffer] = None
         self.stream_list: Dict[Any, Any] = {}
         self.unack_size = 0
         self.node_vbucket_map: Optional[List[int]] = None
         self.uncompress = opts.extra.get("uncompress", 0)
+        # With -x dcp_connections_per_node, the shards that stream the
+        # vbuckets of this source over their own connections.
+        self.shards: Optional[DCPShards] = None
+        # Whether to connect to the nodes' alternate addresses, which
+        # make_pump sets.
+        self.alt_add = False
 
     @staticmethod
     def can_handle(opts, spec: str) -> bool:
@@ -211,16 +309,23 @@ class DCPStreamSource(pump.Source, threading.Thread):
         return 0
 
     def build_node_vbucket_map(self) -> Optional[List[int]]:
-        if "vBucketServerMap" in self.source_bucket:
-            server_list = self.source_bucket["vBucketServerMap"]["serverList"]
-            vbucket_map = self.source_bucket["vBucketServerMap"]["vBucketMap"]
+        node_vbucket_map = DCPStreamSource.node_active_vbuckets(self.source_bucket, self.source_node)
+        if node_vbucket_map is not None and self.vbucket_range is not None:
+            node_vbucket_map = [vbid for vbid in node_vbucket_map if vbid in self.vbucket_range]
+        return node_vbucket_map
+
+    @staticmethod
+    def node_active_vbuckets(source_bucket: Dict[str, Any], source_node: Dict[str, Any]) -> Optional[List[int]]:
+        if "vBucketServerMap" in source_bucket:
+            server_list = source_bucket["vBucketServerMap"]["serverList"]
+            vbucket_map = source_bucket["vBucketServerMap"]["vBucketMap"]
         else:
             return None
 
         node_vbucket_map = []
 
-        host, _ = couchbaseConstants.parse_host_port(self.source_node.get('hostname', 'N/A'))
-        nodename = f'{host}:{self.source_node["ports"]["direct"]!s}'
+        host, _ = couchbaseConstants.parse_host_port(source_node.get('hostname', 'N/A'))
+        nodename = f'{host}:{source_node["ports"]["direct"]!s}'
         nodeindex = -1
         for index, node in enumerate(server_list):
             if nodename == node:
@@ -231,6 +336,48 @@ class DCPStreamSource(pump.Source, threading.Thread):
                 node_vbucket_map.append(vbucket_id)
         return node_vbucket_map
 
+    @staticmethod
+    def split_vbuckets(opts, source_bucket: Dict[str, Any], source_node: Dict[str, Any],
+                       ranges: int) -> List[Optional[List[int]]]:
+        if ranges <= 1:
+            return [None]
+        vbuckets = DCPStreamSource.node_active_vbuckets(source_bucket, source_node)
+        if not vbuckets:
+            return [None]
+        ranges = min(ranges, len(vbuckets))
+        size, extra = divmod(len(vbuckets), ranges)
+        split: List[Optional[List[int]]] = []
+        start = 0
+        for i in range(ranges):
+            end = start + size + (1 if i < extra else 0)
+            split.append(vbuckets[start:end])
+            start = end
+        return split
+
+    @staticmethod
+    def refresh_bucket(opts, spec: str, bucket_name: str) -> Tuple[couchbaseConstants.PUMP_ERROR,
+                                                                   Optional[Dict[str, Any]]]:
+        err, source_map = pump.rest_couchbase(opts, spec)
+        if err or source_map is None:
+            return err or f'error: no bucket config from: {spec}', None
+        for bucket in source_map.get('buckets', []):
+            if bucket.get('name') == bucket_name:
+                return 0, bucket
+        return f'error: no source bucket: {bucket_name}', None
+
+    @staticmethod
+    def find_vbucket_node(source_bucket: Dict[str, Any], vbucket_id: int) -> Optional[Dict[str, Any]]:
+        for node in source_bucket.get('nodes', []):
+            if vbucket_id in (DCPStreamSource.node_active_vbuckets(source_bucket, node) or []):
+                return node
+        return None
+
+    def set_vbucket_range(self, index: int, vbuckets: Optional[List[int]]):
+        super().set_vbucket_range(index, vbuckets)
+        if vbuckets is not None:
+            # Every range opens its own DCP connection, which needs a unique name.
+            self.dcp_name = f'{self.opts.process_name}-r{index}'
+
     def provide_batch(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
         if not self.version_supported:
             return "error: cannot back up 2.x or older clusters with 3.x tools", None
@@ -240,6 +387,9 @@ class DCPStreamSource(pump.Source, threading.Thread):
         max_retry = self.opts.extra['max_retry']
         if not self.node_vbucket_map:
             self.node_vbucket_map = self.build_node_vbucket_map()
+            self.shards = DCPShards.from_opts(self)
+        if self.shards:
+            return self.shards.provide_batch()
 
         while True:
             if self.dcp_done:
@@ -281,12 +431,75 @@ class DCPStreamSource(pump.Source, threading.Thread):
 
         return data_type, value
 
-    def provide_dcp_batch_actual(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
+    def reads_on_loop(self) -> bool:
+        # The event loop can't drive TLS sockets, nor watch sockets at all on
+        # Windows, and shards read their connections on threads of their own.
+        return (not getattr(self.opts, "ssl", False) and
+                not sys.platform.lower().startswith('win') and
+                int(self.opts.extra.get("dcp_connections_per_node", 1)) <= 1)
+
+    async def provide_batch_async(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
+        """provide_batch for the async engine, which reads the responses off
+           the connection on the event loop instead of on a reader thread. A
+           batch then ends with the responses read so far."""
+        loop = asyncio.get_running_loop()
+        if not self.reads_on_loop():
+            return await loop.run_in_executor(None, self.provide_batch)
+        if not self.version_supported:
+            return self.provide_batch()
+
+        cur_sleep = 0.2
+        cur_retry = 0
+        max_retry = self.opts.extra['max_retry']
+        if not self.node_vbucket_map:
+            self.node_vbucket_map = self.build_node_vbucket_map()
+
+        while True:
+            if self.dcp_done:
+                if self.dcp_conn:
+                    self.add_stop_event(self.dcp_conn)
+                    self.dcp_conn.close()
+                    self.dcp_conn = None
+                return 0, None
+
+            if not self.dcp_conn:
+                self.loop_buffer = RecvBuffer(self.recv_buffer_bytes, self.recv_min_bytes)
+                # The connection is set up, and the streams requested, with
+                # blocking round trips.
+                rv = await loop.run_in_executor(None, self.get_dcp_conn)
+                if rv != 0:
+                    self.dcp_done = True
+                    return rv, None
+
+            rv, batch = self.provide_dcp_batch_actual(wait=False)
+            if rv == 0:
+                if batch:
+                    return 0, batch
+                if not self.dcp_done:
+                    await self.read_packets_async()
+                continue
+
+            if self.dcp_conn:
+                self.dcp_conn.close()
+                self.dcp_conn = None
+
+            if cur_retry > max_retry:
+                self.dcp_done = True
+                return rv, batch
+
+            logging.warning(f'backoff: {cur_retry}, sleeping: {cur_sleep}, on error: {rv}')
+            await asyncio.sleep(cur_sleep)
+            cur_sleep = min(cur_sleep * 2, 20)  # Max backoff sleep 20 seconds.
+            cur_retry = cur_retry + 1
+
+    def provide_dcp_batch_actual(self, wait: bool = True) -> \
+            Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
+        """Parses the queued responses into a batch. Without wait, the batch
+           ends once the queue is empty rather than waiting for the reader."""
         batch = pump.Batch(self)
 
-        batch_max_size = self.opts.extra['batch_max_size']
-        batch_max_bytes = self.opts.extra['batch_max_bytes']
-        delta_ack_size = batch_max_bytes * 10 / 4  # ack every 25% of buffer size
+        batch_max_size, batch_max_bytes = self.batch_limits()
+        delta_ack_size = self.batch_max_bytes * 10 / 4  # ack every 25% of buffer size
         last_processed = 0
         total_bytes_read = 0
 
@@ -296,28 +509,45 @@ class DCPStreamSource(pump.Source, threading.Thread):
         vb_uuid: int = 0
         ss_start_seqno: int = 0
         ss_end_seqno: int = 0
-        no_response_count: int = 0
+        idle_deadline = time.monotonic() + DCPStreamSource.IDLE_TIMEOUT
         try:
             while (not self.dcp_done and
                    batch.size() < batch_max_size and
                    batch.bytes < batch_max_bytes):
 
                 if self.response.empty():
-                    if len(self.stream_list) > 0:
-                        logging.debug(f'no response while there {len(self.stream_list)} active streams')
-                        time.sleep(.25)
-                        no_response_count = no_response_count + 1
-                        # if not had a response after a minimum of 30 seconds then state we are done
-                        if no_response_count == 120:
-                            logging.warning(f'no response for 30 seconds while there {len(self.stream_list)}'
-                                            ' active streams'
-                                            )
-                            self.dcp_done = True
-                    else:
+                    if len(self.stream_list) == 0:
                         self.dcp_done = True
+                        continue
+                    if self.reader_done.is_set():
+                        logging.warning(f'stopped reading responses while there {len(self.stream_list)}'
+                                        ' active streams')
+                        self.dcp_done = True
+                        continue
+                    logging.debug(f'no response while there {len(self.stream_list)} active streams')
+
+                try:
+                    if wait:
+                        response = self.response.get(timeout=max(0.0, idle_deadline - time.monotonic()))
+                    else:
+                        response = self.response.get_nowait()
+                except queue.Empty:
+                    if not wait:
+                        break
+                    if self.throttled.is_set():
+                        idle_deadline = time.monotonic() + DCPStreamSource.IDLE_TIMEOUT
+                        continue
+                    if self.throttled_until + DCPStreamSource.IDLE_TIMEOUT > time.monotonic():
+                        idle_deadline = self.throttled_until + DCPStreamSource.IDLE_TIMEOUT
+                        continue
+                    logging.warning(f'no response for {DCPStreamSource.IDLE_TIMEOUT} seconds while there'
+                                    f' {len(self.stream_list)} active streams')
+                    self.dcp_done = True
                     continue
+                if response is None:
+                    continue  # The reader stopped; seen above once the queue is drained.
 
-                no_response_count = 0
+                idle_deadline = time.monotonic() + DCPStreamSource.IDLE_TIMEOUT
                 unprocessed_size = total_bytes_read - last_processed
                 if unprocessed_size > delta_ack_size:
                     rv = self.ack_buffer_size(unprocessed_size)
@@ -327,7 +557,9 @@ class DCPStreamSource(pump.Source, threading.Thread):
                         last_processed = total_bytes_read
 
                 cmd, errcode, opaque, cas, keylen, extlen, data, datalen, dtype, bytes_read = \
-                    self.response.get()  # type: int, int, int, int, int, int, bytes, int, int, int
+                    response  # type: int, int, int, int, int, int, bytes, int, int, int
+                if self.lease:
+                    self.lease.give(bytes_read)
                 total_bytes_read += bytes_read
                 rv = 0
                 metalen = flags = flg = exp = 0
@@ -360,8 +592,9 @@ class DCPStreamSource(pump.Source, threading.Thread):
                     elif errcode == couchbaseConstants.ERR_KEY_EEXISTS:
                         logging.warning(f'a stream exists on the connection for vbucket: {opaque}')
                     elif errcode == couchbaseConstants.ERR_NOT_MY_VBUCKET:
-                        logging.warning(f'Vbucket is not active anymore, skip it:{vbid!s}')
+                        logging.warning(f'Vbucket is not active anymore, skip it:{opaque!s}')
                         del self.stream_list[opaque]
+                        self.vbucket_moved(opaque)
                     elif errcode == couchbaseConstants.ERR_ERANGE:
                         logging.warning(f'Start or end sequence numbers specified incorrectly,({start_seqno},'
                                         f' {end_seqno})')
@@ -391,8 +624,7 @@ class DCPStreamSource(pump.Source, threading.Thread):
                         del self.stream_list[opaque]
                 elif cmd == couchbaseConstants.CMD_DCP_MUTATION:
                     vbucket_id = errcode
-                    seqno, rev_seqno, flg, exp, locktime, metalen, nru = \
-                        struct.unpack(couchbaseConstants.DCP_MUTATION_PKT_FMT, data[0:extlen])
+                    seqno, rev_seqno, flg, exp, locktime, metalen, nru = DCP_MUTATION_PKT.unpack_from(data)
                     key_start = extlen
                     val_start = key_start + keylen
                     val_len = datalen - keylen - metalen - extlen
@@ -424,7 +656,7 @@ class DCPStreamSource(pump.Source, threading.Thread):
                                     conf_res = 0
                             extra_index += extlen
 
-                    if not self.skip(key, vbucket_id):
+                    if not self.skip(key, vbucket_id, cmd, exp):
                         dtype, val = self.maybe_uncompress_value(dtype, val)
                         msg = (cmd, vbucket_id, key, flg, exp, cas, rev_seqno.to_bytes(8, 'big'), val, seqno, dtype,
                                metalen, conf_res)
@@ -432,14 +664,14 @@ class DCPStreamSource(pump.Source, threading.Thread):
                         self.num_msg += 1
                 elif cmd in [couchbaseConstants.CMD_DCP_DELETE, couchbaseConstants.CMD_DCP_EXPIRATION]:
                     vbucket_id = errcode
-                    seqno, rev_seqno, metalen = struct.unpack(couchbaseConstants.DCP_DELETE_PKT_FMT, data[0:extlen])
+                    seqno, rev_seqno, metalen = DCP_DELETE_PKT.unpack_from(data)
                     key_start = extlen
                     val_start = key_start + keylen
                     key = data[extlen:val_start]
                     # If the delete has the Xattr data type get the Xattrs from the body
                     if dtype & couchbaseConstants.DATATYPE_HAS_XATTR:
                         val = data[val_start:]
-                    if not self.skip(key, vbucket_id):
+                    if not self.skip(key, vbucket_id, cmd, exp):
                         dtype, val = self.maybe_uncompress_value(dtype, val)
                         msg = (cmd, vbucket_id, key, flg, exp, cas, rev_seqno.to_bytes(8, 'big'), val, seqno, dtype,
                                metalen, 0)
@@ -454,6 +686,11 @@ class DCPStreamSource(pump.Source, threading.Thread):
                     break
                 elif cmd == couchbaseConstants.CMD_DCP_END_STREAM:
                     del self.stream_list[opaque]
+                    if extlen >= struct.calcsize(couchbaseConstants.DCP_END_STREAM_PKT_FMT):
+                        end_flags, = struct.unpack(couchbaseConstants.DCP_END_STREAM_PKT_FMT, data[0:extlen])
+                        if end_flags == couchbaseConstants.FLAG_DCP_END_STREAM_STATE_CHANGED:
+                            logging.warning(f'Vbucket is not active anymore, stream ended: {opaque!s}')
+                            self.vbucket_moved(opaque)
                     if not len(self.stream_list):
                         self.dcp_done = True
                 elif cmd == couchbaseConstants.CMD_DCP_SNAPSHOT_MARKER:
@@ -511,6 +748,10 @@ class DCPStreamSource(pump.Source, threading.Thread):
                 self.dcp_done = True
 
         if batch.size() <= 0:
+            if not wait and total_bytes_read > last_processed:
+                # More responses are read before the next batch, so ack the
+                # ones that were parsed without making up a batch.
+                self.ack_buffer_size(total_bytes_read - last_processed)
             return 0, None
         self.ack_buffer_size(total_bytes_read - last_processed)
         return 0, batch
@@ -600,12 +841,21 @@ class DCPStreamSource(pump.Source, threading.Thread):
                 return "error: DCP connection error"
 
             self.running = True
-            self.start()
+            if self.loop_buffer is None:
+                self.start()
 
             self.add_start_event(self.dcp_conn)
             self.setup_dcp_streams()
         return 0
 
+    def close(self):
+        if self.shards:
+            self.shards.close()
+        # Give back the budget held by responses that will no longer be read,
+        # which stops the reader thread.
+        if self.lease:
+            self.lease.close()
+
     def ack_buffer_size(self, buf_size: int) -> couchbaseConstants.PUMP_ERROR:
         if self.flow_control:
             try:
@@ -622,41 +872,51 @@ class DCPStreamSource(pump.Source, threading.Thread):
         return 0
 
     def run(self):
+        with pump_profile.profiled(self.opts, "dcp", self.source_bucket['name'],
+                                   self.source_node.get('hostname', pump.NA)):
+            self.read_responses()
+
+    def read_responses(self):
+        try:
+            self.read_packets()
+        finally:
+            self.reader_done.set()
+            try:
+                self.response.put_nowait(None)
+            except queue.Full:
+                pass  # The consumer sees reader_done once it drains the queue.
+
+    def read_packets(self):
         if not self.dcp_conn:
             logging.error("socket to memcached server is not created yet.")
             return
 
-        bytes_read = b''
+        buf = RecvBuffer(self.recv_buffer_bytes, self.recv_min_bytes)
         rd_timeout = 1
         desc = [self.dcp_conn.s]
-        while self.running:
+        # Responses are read from the start, as the streams are requested
+        # while the reader runs, until the consumer has seen all streams end.
+        while self.running and not self.dcp_done:
             try:
-                if self.dcp_done:
-                    time.sleep(1)
-                    continue
                 readers, _, _ = select.select(desc, [], [], rd_timeout)
                 rd_timeout = .25
-                if len(self.stream_list) == 0:
-                    time.sleep(1)
-                    continue
 
                 for reader in readers:
-                    data = reader.recv(self.recv_min_bytes)
-                    logging.debug(f'Read {len(data)} bytes off the wire')
-                    if len(data) == 0:
+                    nbytes = buf.recv_into(reader)
+                    logging.debug(f'Read {nbytes} bytes off the wire')
+                    if nbytes == 0:
                         raise EOFError("Got empty data (remote died?).")
-                    bytes_read += data
-                while len(bytes_read) >= couchbaseConstants.MIN_RECV_PACKET:
-                    magic, opcode, keylen, extlen, datatype, status, bodylen, opaque, cas = \
-                        struct.unpack(couchbaseConstants.RES_PKT_FMT,
-                                      bytes_read[0:couchbaseConstants.MIN_RECV_PACKET])
-
-                    if len(bytes_read) < (couchbaseConstants.MIN_RECV_PACKET + bodylen):
+                    buf.filled(nbytes)
+                while True:
+                    packet = buf.next_packet()
+                    if packet is None:
                         break
 
                     rd_timeout = 0
-                    body = bytes_read[couchbaseConstants.MIN_RECV_PACKET:couchbaseConstants.MIN_RECV_PACKET + bodylen]
-                    bytes_read = bytes_read[couchbaseConstants.MIN_RECV_PACKET + bodylen:]
+                    opcode, keylen, extlen, datatype, status, bodylen, opaque, cas, body = packet
+                    if self.lease and not self.take_budget(couchbaseConstants.MIN_RECV_PACKET + bodylen):
+                        self.running = False
+                        break
                     self.response.put((opcode, status, opaque, cas, keylen, extlen, body, bodylen, datatype,
                                        couchbaseConstants.MIN_RECV_PACKET + bodylen))
             except socket.error:
@@ -664,6 +924,73 @@ class DCPStreamSource(pump.Source, threading.Thread):
             except Exception:
                 pass
 
+    async def read_packets_async(self):
+        """read_packets on the event loop: queues the responses that have been
+           read, waiting up to IDLE_TIMEOUT for more if none are. The socket
+           stays blocking for the acks sent while parsing, so it is only read
+           once the loop finds it readable. As on the reader thread, a failed
+           read sets reader_done and a closed lease stops the streams."""
+        if not self.dcp_conn or not self.loop_buffer:
+            return
+        loop = asyncio.get_running_loop()
+        buf = self.loop_buffer
+        responses: List[Tuple[int, int, int, int, int, int, bytes, int, int, int]] = []
+        nbytes = 0
+        while True:
+            while len(responses) < self.queue_size:
+                packet = buf.next_packet()
+                if packet is None:
+                    break
+                opcode, keylen, extlen, datatype, status, bodylen, opaque, cas, body = packet
+                size = couchbaseConstants.MIN_RECV_PACKET + bodylen
+                responses.append((opcode, status, opaque, cas, keylen, extlen, body, bodylen, datatype, size))
+                nbytes += size
+            if responses:
+                break
+
+            readable = loop.create_future()
+            fd = self.dcp_conn.s.fileno()
+            loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, DCPStreamSource.IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning(f'no response for {DCPStreamSource.IDLE_TIMEOUT} seconds while there'
+                                f' {len(self.stream_list)} active streams')
+                self.dcp_done = True
+                return
+            finally:
+                loop.remove_reader(fd)
+            try:
+                nread = buf.recv_into(self.dcp_conn.s)
+            except socket.error:
+                self.reader_done.set()
+                return
+            logging.debug(f'Read {nread} bytes off the wire')
+            if nread == 0:
+                self.reader_done.set()
+                return
+            buf.filled(nread)
+
+        while self.lease and not self.lease.take(nbytes, wait=False):
+            if self.lease.closed or self.lease.stopped():
+                self.dcp_done = True
+                return
+            await asyncio.sleep(pump_memory.WAIT_INTERVAL)
+        for response in responses:
+            self.response.put_nowait(response)
+
+    def take_budget(self, n: int) -> bool:
+        """Takes n bytes of the lease for a response about to be queued,
+           marking the reader as throttled while it waits for them."""
+        if self.lease.take(n, wait=False):  # type: ignore
+            return True
+        self.throttled.set()
+        try:
+            return self.lease.take(n)  # type: ignore
+        finally:
+            self.throttled_until = time.monotonic()
+            self.throttled.clear()
+
     def setup_dcp_streams(self):
         # send request to retrieve vblist and uuid for the node
         stats = self.mem_conn.stats(b'vbucket-seqno')
@@ -701,12 +1028,13 @@ class DCPStreamSource(pump.Source, threading.Thread):
                 # skip vbuckets that are not in this run
                 continue
 
-            if self.cur['seqno'] and self.cur['seqno'][pair_index]:
-                start_seqno = self.cur['seqno'][pair_index][vbid]
+            if self.cur['seqno'] and self.cur['seqno'].get(pair_index):
+                # A resumed checkpoint only has the vbuckets that made progress.
+                start_seqno = self.cur['seqno'][pair_index].get(vbid, 0)
             else:
                 start_seqno = 0
             uuid = 0
-            if self.cur['failoverlog'] and self.cur['failoverlog'][pair_index]:
+            if self.cur['failoverlog'] and self.cur['failoverlog'].get(pair_index):
                 if vbid in self.cur['failoverlog'][pair_index] and \
                    self.cur['failoverlog'][pair_index][vbid]:
                     # Use the latest failover log
@@ -715,8 +1043,8 @@ class DCPStreamSource(pump.Source, threading.Thread):
                     uuid, _ = self.cur['failoverlog'][pair_index][vbid][0]
             ss_start_seqno = start_seqno
             ss_end_seqno = start_seqno
-            if (self.cur['snapshot'] and self.cur['snapshot'][pair_index] and vbid in self.cur['snapshot'][pair_index]
-                    and self.cur['snapshot'][pair_index][vbid]):
+            if (self.cur['snapshot'] and self.cur['snapshot'].get(pair_index)
+                    and vbid in self.cur['snapshot'][pair_index] and self.cur['snapshot'][pair_index][vbid]):
                 ss_start_seqno, ss_end_seqno = self.cur['snapshot'][pair_index][vbid]
                 if start_seqno == ss_end_seqno:
                     ss_start_seqno = start_seqno
@@ -784,3 +1112,128 @@ class DCPStreamSource(pump.Source, threading.Thread):
             # backfill all items on disk
             total_msgs += (resident_ratio / 100.0) * stats_vals["curr_items"]
         return 0, int(total_msgs)
+
+
+# The keys of a source's cur that its shards share.
+SHARED_CUR_KEYS = ['seqno', 'failoverlog', 'snapshot']
+
+
+class DCPShards(object):
+    """Streams the vbuckets of a DCPStreamSource over dcp_connections_per_node
+       connections, each a DCPStreamSource of its own with its own flow
+       control buffer and reader thread. A thread per shard builds its
+       batches, which are merged into one queue for the source's pump. Each
+       shard counts into a cur of its own, whose counters are added to the
+       source's cur by the pump's thread."""
+
+    def __init__(self, source: DCPStreamSource, vbuckets: List[List[int]]):
+        self.source = source
+        self.queue: queue.Queue = queue.Queue(2 * len(vbuckets))
+        self.closed = threading.Event()
+        self.active = len(vbuckets)
+
+        # Shards share the per vbucket maps of the source's cur, each filling
+        # in its own vbuckets, so the per node maps are made before they start.
+        pair_index = (source.source_bucket['name'], source.source_node['hostname'])
+        for key in SHARED_CUR_KEYS:
+            if not source.cur[key]:
+                source.cur[key] = {}
+            source.cur[key].setdefault(pair_index, {})
+
+        self.shards: List[DCPStreamSource] = []
+        # The counters of each shard already added to the source's cur.
+        self.merged: List[Dict[str, int]] = []
+        for i, shard_vbuckets in enumerate(vbuckets):
+            cur: Dict[str, Any] = defaultdict(int)
+            for key in SHARED_CUR_KEYS:
+                cur[key] = source.cur[key]
+            shard = DCPStreamSource(source.opts, source.spec, source.source_bucket, source.source_node,
+                                    source.source_map, source.sink_map, source.ctl, cur)
+            # Every connection of a node needs a unique name.
+            shard.dcp_name = f'{source.dcp_name}-c{i}'
+            shard.node_vbucket_map = shard_vbuckets
+            shard.alt_add = source.alt_add
+            shard.batch_sizer = source.batch_sizer
+            shard.moved_vbuckets = source.moved_vbuckets
+            self.shards.append(shard)
+            self.merged.append({})
+
+        self.threads = [threading.Thread(target=self.run_shard, args=(shard,),
+                                         name=f'{threading.current_thread().name}-c{i}', daemon=True)
+                        for i, shard in enumerate(self.shards)]
+        for thread in self.threads:
+            thread.start()
+
+    @staticmethod
+    def from_opts(source: DCPStreamSource) -> Optional['DCPShards']:
+        """Returns the shards of a source, or None if its vbuckets are
+           streamed over a single connection."""
+        connections = int(source.opts.extra.get("dcp_connections_per_node", 1))
+        vbuckets = source.node_vbucket_map
+        if connections <= 1 or not vbuckets or len(vbuckets) <= 1:
+            return None
+        connections = min(connections, len(vbuckets))
+        size, extra = divmod(len(vbuckets), connections)
+        split = []
+        start = 0
+        for i in range(connections):
+            end = start + size + (1 if i < extra else 0)
+            split.append(vbuckets[start:end])
+            start = end
+        return DCPShards(source, split)
+
+    def run_shard(self, shard: DCPStreamSource):
+        with pump_profile.profiled(shard.opts, "dcp", shard.source_bucket['name'],
+                                   shard.source_node.get('hostname', pump.NA)):
+            while not self.closed.is_set():
+                try:
+                    rv, batch = shard.provide_batch()
+                except Exception as e:
+                    logging.exception(f'error: DCP shard failed: {shard.dcp_name}')
+                    rv, batch = f'error: DCP shard failed: {e}', None
+                if not self.put((rv, batch)) or rv != 0 or batch is None:
+                    return
+
+    def put(self, item: Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]) -> bool:
+        """Queues a shard's batch, unless the shards are closed first."""
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=pump_memory.WAIT_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def provide_batch(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
+        """Provides the next batch of any shard, or None once all of them are
+           done. An error of a shard stops the others, as the unit is retried
+           as a whole."""
+        while self.active > 0:
+            rv, batch = self.queue.get()
+            self.merge_counters()
+            if rv != 0:
+                self.active = 0
+                self.close()
+                return rv, None
+            if batch is None:
+                self.active -= 1
+                continue
+            return 0, batch
+        self.source.dcp_done = True
+        return 0, None
+
+    def merge_counters(self):
+        """Adds what the shards counted since the last merge to the source's
+           cur. Only the shard's thread writes a shard's counters."""
+        for shard, merged in zip(self.shards, self.merged):
+            for key, n in list(shard.cur.items()):
+                if isinstance(n, int) and n != merged.get(key, 0):
+                    self.source.cur[key] = self.source.cur.get(key, 0) + n - merged.get(key, 0)
+                    merged[key] = n
+
+    def close(self):
+        self.closed.set()
+        for shard in self.shards:
+            shard.dcp_done = True
+            shard.close()
+        self.merge_counters()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""The filter that decides which msgs a source transfers, compiled once from
+   the filter options so that testing a msg is cheap."""
+
+import re
+import time
+import zlib
+from typing import Any, FrozenSet, Optional, Pattern, Set, Tuple, Union
+
+import couchbaseConstants
+from cb_bin_client import decode_collection_id
+
+DELETES = (couchbaseConstants.CMD_TAP_DELETE, couchbaseConstants.CMD_DCP_DELETE,
+           couchbaseConstants.CMD_DCP_EXPIRATION)
+
+# Skipped msgs are counted in a source's cur under these keys, by reason.
+SKIP_KEY = 'tot_source_skip_key'
+SKIP_VBUCKET = 'tot_source_skip_vbucket'
+SKIP_COLLECTION = 'tot_source_skip_collection'
+SKIP_DELETED = 'tot_source_skip_deleted'
+SKIP_EXPIRED = 'tot_source_skip_expired'
+
+# Expiry times up to 30 days are relative to when a document was written,
+# larger ones are absolute unix times.
+RELATIVE_EXPIRY_MAX = 30 * 24 * 60 * 60
+
+# The vbucket_id of msgs whose source doesn't know it, which is hashed from
+# the key later on. The filter hashes it with the vbuckets of the sink's
+# bucket, when the sink is a cluster.
+UNKNOWN_VBUCKET = 0x0000ffff
+
+
+def parse_ids(ids: str, base: int = 10) -> FrozenSet[int]:
+    """Parses comma-separated ids and inclusive ranges, such as 0-99,512."""
+    parsed: Set[int] = set()
+    for part in ids.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        start = int(first, base)
+        end = int(last, base) if last else start
+        if end < start:
+            raise ValueError(f'empty range: {part}')
+        parsed.update(range(start, end + 1))
+    return frozenset(parsed)
+
+
+def sink_vbuckets_num(sink_map) -> int:
+    """The number of vbuckets of the bucket in a cluster sink's map, or 0 if
+       the sink has none."""
+    try:
+        return len(sink_map['buckets'][0]['vBucketServerMap']['vBucketMap'])
+    except (KeyError, IndexError, TypeError):
+        return 0
+
+
+class MsgFilter(object):
+    """Tests the key, vbucket, collection, kind and expiry of a msg against
+       the filter options, working on key bytes so that keys aren't decoded."""
+
+    def __init__(self, key_re: Optional[bytes] = None, key_prefixes: Tuple[bytes, ...] = (),
+                 vbucket_ids: Optional[FrozenSet[int]] = None, collection_ids: Optional[FrozenSet[int]] = None,
+                 keys_have_collection: bool = False, skip_deleted: bool = False, skip_expired: bool = False,
+                 vbuckets_num: int = 0):
+        self.key_re: Optional[Pattern[bytes]] = re.compile(key_re) if key_re else None
+        self.key_prefixes = key_prefixes
+        self.vbucket_ids = vbucket_ids
+        self.collection_ids = collection_ids
+        self.keys_have_collection = keys_have_collection
+        self.skip_deleted = skip_deleted
+        self.skip_expired = skip_expired
+        self.vbuckets_num = vbuckets_num
+        self.now = int(time.time())
+
+    @staticmethod
+    def from_opts(opts, vbuckets_num: int = 0) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional['MsgFilter']]:
+        """Compiles the filter options, returning None if none is set. The
+           keys of msgs without a vbucket_id are hashed to one of vbuckets_num
+           vbuckets, or let through if that is 0."""
+        k = getattr(opts, "key", None)
+        key_re = None
+        if k:
+            key_re = k.encode()
+            try:
+                re.compile(key_re)
+            except BaseException:
+                return f'error: could not parse key regexp: {k}', None
+
+        key_prefixes = tuple(prefix.encode() for prefix in getattr(opts, "key_prefix", None) or [])
+
+        vbucket_ids = None
+        ids = getattr(opts, "vbucket_ids", None)
+        if ids:
+            try:
+                vbucket_ids = parse_ids(ids)
+            except ValueError:
+                return f'error: could not parse vbucket ids: {ids}', None
+        only_vbucket_id = getattr(opts, "id", None)
+        if only_vbucket_id is not None:
+            vbucket_ids = (vbucket_ids & {only_vbucket_id} if vbucket_ids is not None
+                           else frozenset([only_vbucket_id]))
+
+        collection_ids = None
+        ids = getattr(opts, "collection_ids", None)
+        if ids:
+            try:
+                collection_ids = parse_ids(ids, 16)
+            except ValueError:
+                return f'error: could not parse collection ids: {ids}', None
+
+        skip_deleted = bool(getattr(opts, "skip_deleted", False))
+        skip_expired = bool(getattr(opts, "skip_expired", False))
+        if (key_re is None and not key_prefixes and vbucket_ids is None and collection_ids is None and
+                not skip_deleted and not skip_expired):
+            return 0, None
+        return 0, MsgFilter(key_re, key_prefixes, vbucket_ids, collection_ids,
+                            bool(getattr(opts, "collection", None)), skip_deleted, skip_expired, vbuckets_num)
+
+    def skip(self, key: Union[str, bytes], vbucket_id: int, cmd: Optional[int] = None,
+             exp: int = 0) -> Optional[str]:
+        """Returns the cur key counting why a msg is skipped, or None if it
+           is transferred."""
+        if self.vbucket_ids is not None and vbucket_id != UNKNOWN_VBUCKET and vbucket_id not in self.vbucket_ids:
+            return SKIP_VBUCKET
+        if cmd is not None:
+            if self.skip_deleted and cmd in DELETES:
+                return SKIP_DELETED
+            if self.skip_expired and RELATIVE_EXPIRY_MAX < exp <= self.now and cmd not in DELETES:
+                return SKIP_EXPIRED
+        if isinstance(key, str):
+            key = key.encode()
+        if self.keys_have_collection:
+            cid, key = decode_collection_id(key)
+        else:
+            cid = 0
+        if self.collection_ids is not None and cid not in self.collection_ids:
+            return SKIP_COLLECTION
+        if (self.vbucket_ids is not None and vbucket_id == UNKNOWN_VBUCKET and self.vbuckets_num and
+                ((zlib.crc32(key) >> 16) & 0x7FFF) % self.vbuckets_num not in self.vbucket_ids):
+            return SKIP_VBUCKET
+        if self.key_prefixes and not key.startswith(self.key_prefixes):
+            return SKIP_KEY
+        if self.key_re and not self.key_re.search(key):
+            return SKIP_KEY
+        return None
+
+
+def skip_counts(cur: Any) -> str:
+    """The skipped msgs counted in a cur, for a log line, or '' if none were."""
+    counts = [(key[len('tot_source_skip_'):], cur.get(key, 0))
+              for key in (SKIP_KEY, SKIP_VBUCKET, SKIP_COLLECTION, SKIP_DELETED, SKIP_EXPIRED)]
+    return ', '.join(f'{reason}: {n}' for reason, n in counts if n)
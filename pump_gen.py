@@ -89,6 +89,10 @@ class GenSource(pump.Source):
         """No design from a GenSource."""
         return 0, None
 
+    def reads_on_loop(self) -> bool:
+        # Msgs are made up in process, without waiting on anything.
+        return True
+
     def provide_batch(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
         """Provides a batch of messages, with GET/SET ratios and keys
            controlled by a mcsoda-inspired approach, but simpler."""
@@ -123,8 +127,7 @@ class GenSource(pump.Source):
 
         batch = pump.Batch(self)
 
-        batch_max_size = self.opts.extra['batch_max_size']
-        batch_max_bytes = self.opts.extra['batch_max_bytes']
+        batch_max_size, batch_max_bytes = self.batch_limits()
 
         vbucket_id = 0x0000ffff
         cas, exp, flg = 0, 0, 0
@@ -44,7 +44,7 @@ class JSONSource(pump.Source):
         cas, exp, flg = 0, 0, 0x02000006
         try:
             doc = json.loads(docvalue)
-            if '_id' not in doc:
+            if '_id' not in doc and not self.skip(dockey, vbucket_id, cmd, exp):
                 msg = (cmd, vbucket_id, dockey, flg, exp, cas, b'', docvalue, 0, 0, 0, 0)
                 batch.append(msg, len(docvalue))
         except ValueError as error:
@@ -99,6 +99,10 @@ class JSONSource(pump.Source):
 
         return 0, design_files
 
+    def reads_on_loop(self) -> bool:
+        # Documents are read from local files, without waiting on the network.
+        return True
+
     def provide_batch(self) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch]]:
         if self.done:
             return 0, None
@@ -109,7 +113,7 @@ class JSONSource(pump.Source):
 
         batch = pump.Batch(self)
         f = self.spec.replace(JSON_SCHEME, "")
-        batch_max_size = self.opts.extra['batch_max_size']
+        batch_max_size, _ = self.batch_limits()
 
         # Each iteration should return a batch or mark the loading a finished
         if os.path.isfile(f) and f.endswith(".zip"):
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import asyncio
 import json
 import logging
 import re
@@ -14,6 +15,8 @@ import snappy  # pylint: disable=import-error
 import cb_bin_client
 import couchbaseConstants
 import pump
+import pump_metrics
+import pump_ratelimit
 from cb_util import tag_user_data
 
 try:
@@ -45,6 +48,9 @@ OP_MAP_WITH_META = {
 
 ATR_EXP = re.compile(r'_txn:atr-\d+-#([a-f1-9]+)$')
 
+# Seconds to wait for a response on a connection, as cb_bin_client does.
+SOCKET_TIMEOUT = 10
+
 
 def to_bytes(bytes_or_str):
     if isinstance(bytes_or_str, str):
@@ -65,6 +71,8 @@ class MCSink(pump.Sink):
     """Dumb client sink using binary memcached protocol.
        Used when moxi or memcached is destination."""
 
+    reconnectable = True
+
     def __init__(self, opts, spec, source_bucket, source_node,
                  source_map, sink_map, ctl, cur):
         super(MCSink, self).__init__(opts, spec, source_bucket, source_node,
@@ -75,14 +83,23 @@ class MCSink(pump.Sink):
             self.op_map = OP_MAP_WITH_META
         self.conflict_resolve = opts.extra.get("conflict_resolve", 1)
         self.lww_restore = 0
+        # Connections used on the event loop by consume_batch, which sends
+        # one batch at a time under loop_lock, with -x engine=async.
+        self.loop_mconns: Dict[str, cb_bin_client.MemcachedClient] = {}
+        self.loop_lock: Optional[asyncio.Lock] = None
         self.init_worker(MCSink.run)
         self.uncompress = opts.extra.get("uncompress", 0)
         self.txn_warning_issued = False
+        # The station's limiter, when per destination node ceilings are set.
+        self.node_limiter = ctl.get('limiter') if pump_ratelimit.node_limited(opts) else None
         if self.get_conflict_resolution_type() == "lww":
             self.lww_restore = 1
 
     def close(self):
-        self.push_next_batch(None, None)
+        if self.worker is None:
+            self.close_loop_mconns()
+        else:
+            self.push_next_batch(None, None)
 
     @staticmethod
     def check_base(opts, spec: str) -> couchbaseConstants.PUMP_ERROR:
@@ -131,6 +148,97 @@ class MCSink(pump.Sink):
 
         self.close_mconns(mconns)
 
+    def runs_on_loop(self) -> bool:
+        # The event loop can't drive TLS sockets, which stay with the worker.
+        return not getattr(self.opts, "ssl", False)
+
+    async def consume_batch(self, batch: pump.Batch) -> couchbaseConstants.PUMP_ERROR:
+        """Stores a batch on the event loop, as run() does on the worker."""
+        if self.worker is not None:
+            return await super(MCSink, self).consume_batch(batch)
+        if self.loop_lock is None:
+            self.loop_lock = asyncio.Lock()
+        backoff_cap: int = self.opts.extra.get("backoff_cap", 10)
+        async with self.loop_lock:
+            backoff = 0.1
+            # The msgs of batch that need to be retried.
+            retry: Optional[pump.Batch] = batch
+            while retry:  # Loop in case retry is required.
+                rv, retry, need_backoff = await self.scatter_gather_async(self.loop_mconns, retry)
+                if rv != 0:
+                    self.close_loop_mconns()
+                    return rv
+
+                if retry:
+                    self.cur["tot_sink_retry_batch"] = \
+                        self.cur.get("tot_sink_retry_batch", 0) + 1
+
+                if need_backoff:
+                    backoff = min(backoff * 2.0, backoff_cap)
+                    logging.warning(f'backing off, secs: {backoff}')
+                    await asyncio.sleep(backoff)
+        return 0
+
+    async def scatter_gather_async(self, mconns: Dict[str, cb_bin_client.MemcachedClient], batch: pump.Batch) -> \
+            Tuple[couchbaseConstants.PUMP_ERROR, Optional[pump.Batch], Optional[bool]]:
+        """scatter_gather on the event loop."""
+        loop = asyncio.get_running_loop()
+        conn: Optional[cb_bin_client.MemcachedClient] = mconns.get("conn")
+        if not conn:
+            rv, conn = await loop.run_in_executor(None, self.connect)
+            if rv != 0:
+                return rv, None, None
+            conn.s.setblocking(False)  # type: ignore
+            mconns["conn"] = conn  # type: ignore
+
+        if self.node_limiter:
+            await self.throttle_nodes_async({self.spec: (batch.size(), batch.bytes)})
+
+        start = time.monotonic()
+        rv, skipped = await self.send_msgs_async(conn, batch.msgs, self.operation())  # type: ignore
+        if rv != 0:
+            return rv, None, None
+        pump_metrics.observe(self.cur, 'send', time.monotonic() - start)
+
+        start = time.monotonic()
+        rv, retry, refresh = await self.recv_msgs_async(conn, batch.msgs, skipped)  # type: ignore
+        pump_metrics.observe(self.cur, 'recv', time.monotonic() - start)
+        if refresh:
+            await loop.run_in_executor(None, self.refresh_sink_map)
+        if retry:
+            return rv, batch, True
+
+        return rv, None, None
+
+    def close_loop_mconns(self):
+        for conn in self.loop_mconns.values():
+            # The stop event is sent and received as on the worker.
+            conn.s.settimeout(SOCKET_TIMEOUT)
+        self.close_mconns(self.loop_mconns)
+        self.loop_mconns = {}
+
+    def reconnect(self) -> couchbaseConstants.PUMP_ERROR:
+        """Restarts the worker, which connects afresh, once the vbucket map is
+           refreshed in case a destination node failed over."""
+        rv = self.refresh_sink_map()
+        if rv != 0:
+            return rv
+        return self.restart_worker()
+
+    def throttle_nodes(self, nodes: Dict[str, Tuple[int, int]]):
+        """Waits until the (ops, bytes) about to be sent to each destination
+           node fit under the per node ceilings."""
+        wait = self.node_limiter.reserve_nodes(nodes)  # type: ignore
+        if wait > 0:
+            time.sleep(wait)
+        pump_metrics.observe(self.cur, 'throttle_node', wait)
+
+    async def throttle_nodes_async(self, nodes: Dict[str, Tuple[int, int]]):
+        wait = self.node_limiter.reserve_nodes(nodes)  # type: ignore
+        if wait > 0:
+            await asyncio.sleep(wait)
+        pump_metrics.observe(self.cur, 'throttle_node', wait)
+
     def get_conflict_resolution_type(self) -> str:
         bucket = self.sink_map["buckets"][0]
         conf_res_type = "seqno"
@@ -154,13 +262,20 @@ class MCSink(pump.Sink):
 
         # TODO: (1) MCSink - run() handle --data parameter.
 
+        if self.node_limiter:
+            self.throttle_nodes({self.spec: (batch.size(), batch.bytes)})
+
         # Scatter or send phase.
+        start = time.monotonic()
         rv, skipped = self.send_msgs(conn, batch.msgs, self.operation())  # type: ignore
         if rv != 0:
             return rv, None, None
+        pump_metrics.observe(self.cur, 'send', time.monotonic() - start)
 
         # Gather or recv phase.
+        start = time.monotonic()
         rv, retry, refresh = self.recv_msgs(conn, batch.msgs, skipped)  # type: ignore
+        pump_metrics.observe(self.cur, 'recv', time.monotonic() - start)
         if refresh:
             self.refresh_sink_map()
         if retry:
@@ -170,6 +285,38 @@ class MCSink(pump.Sink):
 
     def send_msgs(self, conn: cb_bin_client.MemcachedClient, msgs: List[couchbaseConstants.BATCH_MSG], operation: str,
                   vbucket_id: Optional[int] = None) -> Tuple[couchbaseConstants.PUMP_ERROR, List[int]]:
+        rv, skipped, m = self.encode_msgs(msgs, operation, vbucket_id)
+        if rv != 0:
+            return rv, skipped
+
+        if m:
+            try:
+                conn.s.sendall(self.join_str_and_bytes(m))  # type: ignore
+            except socket.error as e:
+                return f'error: conn.sendall() exception: {e}', skipped
+
+        return 0, skipped
+
+    async def send_msgs_async(self, conn: cb_bin_client.MemcachedClient, msgs: List[couchbaseConstants.BATCH_MSG],
+                              operation: str, vbucket_id: Optional[int] = None) -> \
+            Tuple[couchbaseConstants.PUMP_ERROR, List[int]]:
+        """send_msgs on the event loop."""
+        rv, skipped, m = self.encode_msgs(msgs, operation, vbucket_id)
+        if rv != 0:
+            return rv, skipped
+
+        if m:
+            try:
+                await asyncio.get_running_loop().sock_sendall(conn.s, self.join_str_and_bytes(m))
+            except socket.error as e:
+                return f'error: conn.sendall() exception: {e}', skipped
+
+        return 0, skipped
+
+    def encode_msgs(self, msgs: List[couchbaseConstants.BATCH_MSG], operation: str,
+                    vbucket_id: Optional[int] = None) -> Tuple[couchbaseConstants.PUMP_ERROR, List[int], List[bytes]]:
+        """Returns the requests that store msgs, and the indexes of the msgs
+           that are skipped."""
         m: List[bytes] = []
         skipped: List[int] = []
 
@@ -184,25 +331,22 @@ class MCSink(pump.Sink):
             if vbucket_id is not None:
                 vbucket_id_msg = vbucket_id
 
-            if self.skip(key, vbucket_id_msg):
-                continue
-
             if cmd == couchbaseConstants.CMD_SUBDOC_MULTIPATH_MUTATION:
                 err, req = self.format_multipath_mutation(key, val, vbucket_id_msg, cas, i)
                 if err:
-                    return err, skipped
+                    return err, skipped, m
                 self.append_req(m, req)
                 continue
             if cmd == couchbaseConstants.CMD_SUBDOC_MULTIPATH_LOOKUP:
                 err, req = self.format_multipath_lookup(key, val, vbucket_id_msg, cas, i)
                 if err:
-                    return err, skipped
+                    return err, skipped, m
                 self.append_req(m, req)
                 continue
 
             rv, translated_cmd = self.translate_cmd(cmd, operation, meta)
             if translated_cmd is None:
-                return rv, skipped
+                return rv, skipped, m
             if dtype & couchbaseConstants.DATATYPE_COMPRESSED and self.uncompress and val:
                 try:
                     val = snappy.uncompress(val)
@@ -235,17 +379,11 @@ class MCSink(pump.Sink):
                                        exp, cas, meta, i, dtype, nmeta,
                                        conf_res)  # type: ignore
             if rv != 0:
-                return rv, skipped
+                return rv, skipped, m
 
             self.append_req(m, req)
 
-        if m:
-            try:
-                conn.s.sendall(self.join_str_and_bytes(m))  # type: ignore
-            except socket.error as e:
-                return f'error: conn.sendall() exception: {e}', skipped
-
-        return 0, skipped
+        return 0, skipped, m
 
     @staticmethod
     def filter_out_txn(key: bytes, val: bytes, cas: int, exp: int, revid: bytes,
@@ -439,9 +577,6 @@ class MCSink(pump.Sink):
             if vbucket_id is not None:
                 vbucket_id_msg = vbucket_id
 
-            if self.skip(key, vbucket_id_msg):
-                continue
-
             try:
                 r_cmd, r_status, r_ext, r_key, r_val, r_cas, r_opaque = \
                     self.read_conn(conn)  # type: ignore
@@ -460,6 +595,7 @@ class MCSink(pump.Sink):
                 elif (r_status == couchbaseConstants.ERR_ETMPFAIL or
                       r_status == couchbaseConstants.ERR_EBUSY or
                       r_status == couchbaseConstants.ERR_ENOMEM):
+                    self.cur["tot_sink_tmpfail"] = self.cur.get("tot_sink_tmpfail", 0) + 1
                     retry = True  # Retry the whole batch again next time.
                     continue      # But, finish recv'ing current batch.
                 elif r_status == couchbaseConstants.ERR_NOT_MY_VBUCKET:
@@ -496,6 +632,42 @@ class MCSink(pump.Sink):
                 return f'error: MCSink exception: {e!s}', None, None
         return 0, retry, refresh
 
+    async def recv_msgs_async(self, conn: cb_bin_client.MemcachedClient, msgs: List[couchbaseConstants.BATCH_MSG],
+                              skipped: List[int], vbucket_id: Optional[int] = None) -> \
+            Tuple[couchbaseConstants.PUMP_ERROR, Optional[bool], Optional[bool]]:
+        """recv_msgs on the event loop. The responses to msgs are read into the
+           conn's buffer first, from which recv_msgs then takes them."""
+        rv = await self.fill_conn_async(conn, len(msgs) - len(skipped))
+        if rv != 0:
+            return rv, None, None
+        return self.recv_msgs(conn, msgs, skipped, vbucket_id=vbucket_id)
+
+    async def fill_conn_async(self, conn: cb_bin_client.MemcachedClient, n: int) -> couchbaseConstants.PUMP_ERROR:
+        """Reads until the conn's buffer holds n whole responses."""
+        loop = asyncio.get_running_loop()
+        buf: bytes = getattr(conn, 'buf', b'')
+        offset = 0
+        while n > 0:
+            while n > 0 and len(buf) - offset >= couchbaseConstants.MIN_RECV_PACKET:
+                bodylen, = struct.unpack_from(">I", buf, offset + 8)
+                if len(buf) - offset < couchbaseConstants.MIN_RECV_PACKET + bodylen:
+                    break
+                offset += couchbaseConstants.MIN_RECV_PACKET + bodylen
+                n -= 1
+            if n == 0:
+                break
+            try:
+                data = await asyncio.wait_for(loop.sock_recv(conn.s, 65536), SOCKET_TIMEOUT)
+            except asyncio.TimeoutError:
+                return "error: recv socket.timeout"
+            except socket.error as e:
+                return f'error: recv exception: {e!s}'
+            if not data:
+                return f'error: connection closed: {conn.host}:{conn.port}'
+            buf += data
+        conn.buf = buf  # type: ignore
+        return 0
+
     def translate_cmd(self, cmd: int, op: str, meta: bytes) -> Tuple[couchbaseConstants.PUMP_ERROR, Optional[int]]:
         if len(meta) == 0:
             # The source gave no meta, so use regular commands.
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""A byte budget bounding the data that all the pumps of a transfer buffer."""
+
+import threading
+from typing import Callable, Optional, Tuple
+
+# Buffers take their share of the budget in chunks of at least this many
+# bytes, so that buffering each msg isn't a round trip to a multiprocessing
+# manager in --processes mode.
+LEASE_CHUNK = 256 * 1024
+
+# How often, in seconds, a buffer waiting for the budget checks whether it
+# should give up.
+WAIT_INTERVAL = 0.25
+
+
+class MemoryBudget(object):
+    """Counting semaphore of bytes, shared by the DCP readers, source
+       prefetchers and sink queues of a PumpingStation before they buffer
+       data. A single request larger than the whole budget is granted once
+       nothing else is held, so that it can't wait forever. Bytes that
+       leases hold unused count as free, so that a buffer never waits on the
+       spare chunk of another; buffered data can then exceed the limit by
+       those spare chunks. In --processes
+       mode it is served by the station's multiprocessing manager, whose
+       threads per connection let acquire block."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        # Bytes taken by leases but unused, as of their last acquire or release.
+        self.idle = 0
+        self.cond = threading.Condition()
+
+    @staticmethod
+    def from_opts(opts) -> Optional['MemoryBudget']:
+        """Returns a budget of the memory_budget set in opts.extra, or None if none is."""
+        limit = int(opts.extra.get("memory_budget", 0))
+        if limit <= 0:
+            return None
+        return MemoryBudget(limit)
+
+    def acquire(self, n: int, timeout: Optional[float] = None, idle: int = 0) -> bool:
+        """Takes n bytes, waiting up to timeout seconds for them to be free,
+           and adds idle to the unused bytes of leases once they are taken.
+           Returns whether they were taken."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.used == 0 or self.used - self.idle + n <= self.limit, timeout):
+                return False
+            self.take(n)
+            self.idle = max(0, self.idle + idle)
+            return True
+
+    def charge(self, n: int):
+        """Takes n bytes without waiting, even if that exceeds the budget."""
+        with self.cond:
+            self.take(n)
+
+    def take(self, n: int):
+        self.used += n
+        if self.used > self.peak:
+            self.peak = self.used
+
+    def release(self, n: int, idle: int = 0):
+        with self.cond:
+            self.used = max(0, self.used - n)
+            self.idle = max(0, self.idle + idle)
+            self.cond.notify_all()
+
+    def usage(self) -> Tuple[int, int, int]:
+        """Returns the bytes in use, the most ever in use, and the limit."""
+        with self.cond:
+            return self.used, self.peak, self.limit
+
+
+class Lease(object):
+    """The share of the budget held by one buffer, which is filled by one
+       thread and drained by another. Bytes are taken from the budget in
+       chunks and given back once a chunk's worth is unused, or all at once
+       when the buffer drains, so that idle leases hold none of the budget.
+       The unused bytes are reported to the budget whenever it is called
+       anyway, rather than on every take and give. Closing the lease gives
+       back everything it holds, including bytes still buffered, and makes
+       later takes fail, so that the filling thread stops."""
+
+    def __init__(self, budget, stopped: Callable[[], bool], chunk: int = LEASE_CHUNK):
+        self.budget = budget
+        self.stopped = stopped
+        self.chunk = chunk
+        self.lock = threading.Lock()
+        # Bytes taken from the budget, how many of them are unused, and how
+        # many the budget was last told are unused.
+        self.held = 0
+        self.credit = 0
+        self.reported = 0
+        self.closed = False
+
+    def take(self, n: int, wait: bool = True) -> bool:
+        """Takes n bytes for data about to be buffered, waiting for the budget
+           if needed. Rather than wait for a whole chunk, the lease gives back
+           its unused bytes and waits for just n. Returns False, without
+           taking them, once the lease is closed or stopped says so, or
+           without wait if the budget has no n bytes to spare."""
+        with self.lock:
+            if self.closed:
+                return False
+            if self.credit >= n:
+                self.credit -= n
+                return True
+            want = max(n - self.credit, self.chunk)
+            idle = self.credit + want - n - self.reported
+        if not self.budget.acquire(want, 0, idle):
+            with self.lock:
+                spare, self.credit = self.credit, 0
+                self.held -= spare
+                idle, self.reported = -self.reported, 0
+            self.budget.release(spare, idle)
+            want, idle = n, 0
+            while not self.budget.acquire(want, WAIT_INTERVAL if wait else 0):
+                if not wait or self.closed or self.stopped():
+                    return False
+        with self.lock:
+            if self.closed:
+                self.budget.release(want, -idle)
+                return False
+            self.reported += idle
+            self.held += want
+            self.credit += want - n
+            return True
+
+    def give(self, n: int):
+        """Gives back n bytes of data taken out of the buffer."""
+        with self.lock:
+            if self.closed:
+                return
+            self.credit += n
+            if self.credit >= self.held:
+                # Nothing is buffered; give back everything.
+                excess = self.held
+            elif self.credit < 2 * self.chunk:
+                return
+            else:
+                excess = self.credit - self.chunk
+            self.credit -= excess
+            self.held -= excess
+            idle, self.reported = self.credit - self.reported, self.credit
+        self.budget.release(excess, idle)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            held, self.held, self.credit = self.held, 0, 0
+            idle, self.reported = -self.reported, 0
+        if held:
+            self.budget.release(held, idle)
+
+
+def lease(ctl) -> Optional[Lease]:
+    """Returns a lease of the budget in a pump's ctl, or None if there is none."""
+    budget = ctl.get('memory') if ctl is not None else None
+    if budget is None:
+        return None
+    return Lease(budget, lambda: ctl['stop'])
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""Per-stage latency histograms for pumps, and their export to a metrics file."""
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Each power of two is split into this many buckets, which bounds the error of
+# a reported percentile to about 19%.
+BUCKETS_PER_OCTAVE = 4
+# Latencies are bucketed in microseconds.
+UNITS_PER_SECOND = 1000000
+
+STAGES = ['provide', 'throttle', 'memory', 'send', 'recv', 'wait']
+STAGE_PREFIX = 'latency_'
+
+PROMETHEUS_SUFFIXES = ('.prom', '.txt')
+
+
+class Histogram(object):
+    """Log-linear histogram of latencies, recorded in seconds."""
+
+    def __init__(self, state: Optional[Dict[str, Any]] = None):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        if state:
+            self.merge(state)
+
+    def record(self, seconds: float):
+        units = seconds * UNITS_PER_SECOND
+        index = int(math.log2(units) * BUCKETS_PER_OCTAVE) + 1 if units >= 1 else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, state: Dict[str, Any]):
+        """Adds in another histogram, given as its state()."""
+        for index, n in state['buckets'].items():
+            index = int(index)
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self.count += state['count']
+        self.sum += state['sum']
+        self.max = max(self.max, state['max'])
+
+    def state(self) -> Dict[str, Any]:
+        """Plain data form of the histogram, which can be pickled or sent
+           to a multiprocessing manager."""
+        return {'buckets': dict(self.buckets), 'count': self.count, 'sum': self.sum, 'max': self.max}
+
+    def percentile(self, p: float) -> float:
+        """Returns the upper bound of the bucket holding the p-th percentile,
+           in seconds, but never more than the max seen."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * p / 100.0))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                upper = 2 ** (index / BUCKETS_PER_OCTAVE) / UNITS_PER_SECOND
+                return min(upper, self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        return {'count': self.count,
+                'sum': self.sum,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+
+def observe(cur, stage: str, seconds: float):
+    """Records the latency of a stage into the histogram kept in a pump's cur."""
+    key = STAGE_PREFIX + stage
+    hist = cur.get(key)
+    if not isinstance(hist, Histogram):
+        hist = cur[key] = Histogram()
+    hist.record(seconds)
+
+
+def flush(cur, metrics):
+    """Merges the histograms collected in a pump's cur into the station-wide
+       metrics and starts them over."""
+    if metrics is None:
+        return
+    states = {}
+    for key, hist in list(cur.items()):
+        if isinstance(hist, Histogram) and hist.count:
+            states[key[len(STAGE_PREFIX):]] = hist.state()
+            cur[key] = Histogram()
+    if states:
+        metrics.merge(states)
+
+
+class Metrics(object):
+    """Station-wide histograms that pumps flush into. In --processes mode it
+       is served by the station's multiprocessing manager."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Histogram] = {}
+
+    def merge(self, states: Dict[str, Dict[str, Any]]):
+        with self.lock:
+            for stage, state in states.items():
+                if stage not in self.stages:
+                    self.stages[stage] = Histogram()
+                self.stages[stage].merge(state)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            return {stage: hist.state() for stage, hist in self.stages.items()}
+
+
+def summarize(snapshot: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    return {stage: Histogram(state).summary() for stage, state in sorted(snapshot.items())}
+
+
+def summary_lines(snapshot: Dict[str, Dict[str, Any]]) -> List[str]:
+    lines = []
+    for stage, s in summarize(snapshot).items():
+        lines.append(f'  latency {stage:<8}: count: {s["count"]}, p50: {s["p50"] * 1000:.3f}ms, '
+                     f'p99: {s["p99"] * 1000:.3f}ms, max: {s["max"] * 1000:.3f}ms')
+    return lines
+
+
+def format_json(snapshot: Dict[str, Dict[str, Any]], counters: Dict[str, int]) -> str:
+    return json.dumps({'time': time.time(),
+                       'stages': summarize(snapshot),
+                       'counters': counters}, sort_keys=True, indent=2)
+
+
+def format_prometheus(snapshot: Dict[str, Dict[str, Any]], counters: Dict[str, int]) -> str:
+    name = 'cbtransfer_stage_latency_seconds'
+    lines = [f'# HELP {name} Latency of each pump stage.',
+             f'# TYPE {name} summary']
+    summaries = summarize(snapshot)
+    for stage, s in summaries.items():
+        lines.append(f'{name}{{stage="{stage}",quantile="0.5"}} {s["p50"]}')
+        lines.append(f'{name}{{stage="{stage}",quantile="0.99"}} {s["p99"]}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {s["sum"]}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {s["count"]}')
+    lines.append('# HELP cbtransfer_stage_latency_max_seconds Maximum latency of each pump stage.')
+    lines.append('# TYPE cbtransfer_stage_latency_max_seconds gauge')
+    for stage, s in summaries.items():
+        lines.append(f'cbtransfer_stage_latency_max_seconds{{stage="{stage}"}} {s["max"]}')
+    for key, value in sorted(counters.items()):
+        lines.append(f'# TYPE cbtransfer_{key} gauge')
+        lines.append(f'cbtransfer_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics_file(path: str, snapshot: Dict[str, Dict[str, Any]], counters: Dict[str, int]):
+    """Rewrites the metrics file in place, so a scraper never sees it half written.
+       Files ending in .prom or .txt get Prometheus text format, others JSON."""
+    if path.endswith(PROMETHEUS_SUFFIXES):
+        text = format_prometheus(snapshot, counters)
+    else:
+        text = format_json(snapshot, counters)
+    tmp = f'{path}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f'could not write metrics file: {path}; exception: {e}')
+
+
+class MetricsExporter(threading.Thread):
+    """Periodically rewrites the metrics file while a transfer runs."""
+
+    def __init__(self, path: str, interval: float, snapshot: Callable[[], Dict[str, Dict[str, Any]]],
+                 counters: Callable[[], Dict[str, int]]):
+        super(MetricsExporter, self).__init__(name="metrics", daemon=True)
+        self.path = path
+        self.interval = max(0.1, interval)
+        self.snapshot = snapshot
+        self.counters = counters
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        write_metrics_file(self.path, self.snapshot(), self.counters())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.write()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""Profiling of the threads that transfer each source bucket and node, with
+   -x profile=<dir>: a cProfile per thread and, with profile_interval, a
+   sampling profiler of collapsed stacks for flamegraphs."""
+
+import contextlib
+import cProfile
+import itertools
+import logging
+import os
+import sys
+import threading
+import urllib.parse
+from collections import defaultdict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Numbers the profiles a process dumps, as a thread may run several units of
+# the same source node.
+PROFILE_SEQ = itertools.count(1)
+
+# Seconds a unit waits for its sink worker to stop and write its profile.
+JOIN_TIMEOUT = 10
+
+LABEL = Tuple[str, str]  # (bucket, node)
+
+
+def profile_dir(opts) -> str:
+    extra = getattr(opts, "extra", None) or {}
+    return extra.get("profile", "")
+
+
+def endpoint_dir(base: str, label: LABEL) -> str:
+    """The directory the profiles of a source bucket and node go to, named
+       the way backup directories are."""
+    bucket, node = label
+    path = os.path.join(base, f'bucket-{urllib.parse.quote_plus(bucket)}', f'node-{urllib.parse.quote_plus(node)}')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def endpoint_label(bucket: Any, node: Any) -> LABEL:
+    if isinstance(bucket, bytes):
+        bucket = bucket.decode()
+    if isinstance(node, bytes):
+        node = node.decode()
+    return str(bucket), str(node)
+
+
+@contextlib.contextmanager
+def profiled(opts, kind: str, bucket: Any, node: Any):
+    """Profiles the current thread, as one of the given kind of threads of a
+       source bucket and node, while in the with block."""
+    base = profile_dir(opts)
+    if not base:
+        yield
+        return
+    label = endpoint_label(bucket, node)
+    sampler = start_sampler(opts)
+    if sampler:
+        sampler.enter(label, kind)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        name = f'{kind}-{threading.current_thread().name}-{os.getpid()}-{next(PROFILE_SEQ)}.prof'
+        try:
+            profile.dump_stats(os.path.join(endpoint_dir(base, label), name))
+        except OSError as e:
+            logging.warning(f'could not write profile: {name}; exception: {e}')
+        if sampler:
+            sampler.leave(label)
+
+
+def wrap(opts, kind: str, bucket: Any, node: Any, target: Callable[..., Any]) -> Callable[..., Any]:
+    """Returns a thread target that runs target profiled, when profiling."""
+    if not profile_dir(opts):
+        return target
+
+    def run(*args, **kwargs):
+        with profiled(opts, kind, bucket, node):
+            return target(*args, **kwargs)
+    return run
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of the profiled threads of a process every interval
+       seconds, counting them per source bucket and node in the collapsed
+       format that flamegraph tools read."""
+
+    def __init__(self, base: str, interval: float):
+        super(StackSampler, self).__init__(name="sampler", daemon=True)
+        self.base = base
+        self.interval = max(0.001, interval)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # The label and kind of each profiled thread, by thread ident.
+        self.threads: Dict[int, Tuple[LABEL, str]] = {}
+        self.counts: Dict[LABEL, Dict[str, int]] = {}
+        self.stopped = threading.Event()
+
+    def enter(self, label: LABEL, kind: str):
+        with self.lock:
+            self.threads[threading.get_ident()] = (label, kind)
+            # The stacks file is written even if no sample is taken.
+            self.counts.setdefault(label, defaultdict(int))
+
+    def leave(self, label: LABEL):
+        with self.lock:
+            self.threads.pop(threading.get_ident(), None)
+        self.flush(label)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, (label, kind) in self.threads.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.counts[label][collapse(kind, frame)] += 1
+
+    def flush(self, label: Optional[LABEL] = None):
+        """Rewrites the stacks file of a label, or of all of them, with the
+           counts so far. Each process writes its own."""
+        with self.lock:
+            counts = {lbl: dict(stacks) for lbl, stacks in self.counts.items() if label is None or lbl == label}
+        for lbl, stacks in counts.items():
+            path = os.path.join(endpoint_dir(self.base, lbl), f'stacks-{self.pid}.collapsed')
+            try:
+                with open(path, 'w') as f:
+                    for stack, n in sorted(stacks.items()):
+                        f.write(f'{stack} {n}\n')
+            except OSError as e:
+                logging.warning(f'could not write stacks: {path}; exception: {e}')
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.flush()
+
+
+def collapse(kind: str, frame) -> str:
+    """A stack as ';'-separated frames, outermost first, under its kind of
+       thread."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    names.append(kind)
+    return ';'.join(reversed(names))
+
+
+_sampler: Optional[StackSampler] = None
+_sampler_lock = threading.Lock()
+
+
+def start_sampler(opts) -> Optional[StackSampler]:
+    """Starts the sampler of this process on first use, when profile_interval
+       is set; pool processes of --processes mode each start their own."""
+    global _sampler
+    interval = float(opts.extra.get("profile_interval", 0))
+    if interval <= 0:
+        return None
+    with _sampler_lock:
+        if _sampler is None or _sampler.pid != os.getpid():
+            _sampler = StackSampler(profile_dir(opts), interval)
+            _sampler.start()
+        return _sampler
+
+
+def stop_sampler():
+    global _sampler
+    with _sampler_lock:
+        sampler, _sampler = _sampler, None
+    if sampler and sampler.pid == os.getpid():
+        sampler.stop()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""Token bucket rate limiting of the ops and bytes pumps send to a destination."""
+
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucket(object):
+    """Refills rate tokens per second, up to one second's worth. A reservation
+       may take the bucket into debt, which the caller pays off by waiting, so
+       batches larger than the burst are still let through at the set rate."""
+
+    def __init__(self, rate: float):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+
+    def reserve(self, n: float, now: float) -> float:
+        """Takes n tokens and returns the seconds to wait before using them."""
+        self.tokens = min(self.rate, self.tokens + max(0.0, now - self.last) * self.rate)
+        self.last = max(self.last, now)
+        self.tokens -= n
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter(object):
+    """Ops/sec and bytes/sec ceilings shared by all the pumps of a
+       PumpingStation, overall and per destination node. A ceiling of 0 is
+       unlimited. Callers sleep for the returned wait themselves, so that in
+       --processes mode the limiter can be served by a multiprocessing manager
+       without blocking it."""
+
+    def __init__(self, ops_per_sec: float = 0, bytes_per_sec: float = 0, node_ops_per_sec: float = 0,
+                 node_bytes_per_sec: float = 0):
+        self.lock = threading.Lock()
+        self.ops = TokenBucket(ops_per_sec) if ops_per_sec > 0 else None
+        self.bytes = TokenBucket(bytes_per_sec) if bytes_per_sec > 0 else None
+        self.node_ops_per_sec = node_ops_per_sec
+        self.node_bytes_per_sec = node_bytes_per_sec
+        self.nodes: Dict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+
+    @staticmethod
+    def from_opts(opts) -> Optional['RateLimiter']:
+        """Returns a limiter for the ceilings set in opts.extra, or None if none are."""
+        args = limits_from_opts(opts)
+        if not any(args):
+            return None
+        return RateLimiter(*args)
+
+    def reserve(self, ops: int, nbytes: int) -> float:
+        """Reserves a batch against the overall ceilings; returns the seconds to wait."""
+        now = time.monotonic()
+        wait = 0.0
+        with self.lock:
+            if self.ops:
+                wait = max(wait, self.ops.reserve(ops, now))
+            if self.bytes:
+                wait = max(wait, self.bytes.reserve(nbytes, now))
+        return wait
+
+    def reserve_nodes(self, nodes: Dict[str, Tuple[int, int]]) -> float:
+        """Reserves the (ops, bytes) bound for each destination node against the
+           per node ceilings; returns the seconds to wait."""
+        now = time.monotonic()
+        wait = 0.0
+        with self.lock:
+            for node, (ops, nbytes) in nodes.items():
+                if node not in self.nodes:
+                    self.nodes[node] = (TokenBucket(self.node_ops_per_sec) if self.node_ops_per_sec > 0 else None,
+                                        TokenBucket(self.node_bytes_per_sec) if self.node_bytes_per_sec > 0 else None)
+                ops_bucket, bytes_bucket = self.nodes[node]
+                if ops_bucket:
+                    wait = max(wait, ops_bucket.reserve(ops, now))
+                if bytes_bucket:
+                    wait = max(wait, bytes_bucket.reserve(nbytes, now))
+        return wait
+
+
+def limits_from_opts(opts) -> Tuple[float, float, float, float]:
+    return (float(opts.extra.get("ops_per_sec", 0)),
+            float(opts.extra.get("bytes_per_sec", 0)),
+            float(opts.extra.get("node_ops_per_sec", 0)),
+            float(opts.extra.get("node_bytes_per_sec", 0)))
+
+
+def node_limited(opts) -> bool:
+    _, _, node_ops, node_bytes = limits_from_opts(opts)
+    return node_ops > 0 or node_bytes > 0
@@ -15,6 +15,7 @@ import couchstore  # pylint: disable=import-error
 
 import couchbaseConstants
 import pump
+import pump_memory
 from cb_bin_client import decode_collection_id, encode_collection_id
 
 SFD_SCHEME = "couchstore-files://"
@@ -39,6 +40,9 @@ class SFDSource(pump.Source):
                                         source_map, sink_map, ctl, cur)
         self.done = False
         self.queue = None
+        # Holds the batches prefetched by the loader thread against the memory
+        # budget, with -x memory_budget.
+        self.lease = pump_memory.lease(ctl)
         print('Starting sfd source:  ', spec)
 
     @staticmethod
@@ -159,6 +163,8 @@ class SFDSource(pump.Source):
 
         rv, batch = self.queue.get()
         self.queue.task_done()
+        if self.lease and batch:
+            self.lease.give(batch.bytes)
         if rv != 0 or batch is None:
             self.done = True
         return rv, batch
@@ -187,16 +193,25 @@ class SFDSource(pump.Source):
             self.queue.put((f'error: missing vbuckets in source_bucket: {self.source_bucket["name"]}', None))
             return
 
-        batch_max_size = self.opts.extra['batch_max_size']
-        batch_max_bytes = self.opts.extra['batch_max_bytes']
+        batch_max_size, batch_max_bytes = self.batch_limits()
 
         store = None
         vbucket_id = None
 
         # Level of indirection since we can't use python 3 nonlocal statement.
         abatch: List[pump.Batch] = [pump.Batch(self)]
+        stopped = [False]
+
+        def put_batch() -> bool:
+            if self.lease and not self.lease.take(abatch[0].bytes):
+                stopped[0] = True
+                return False
+            self.queue.put((0, abatch[0]))
+            return True
 
         def change_callback(doc_info):
+            if stopped[0]:
+                return
             if doc_info:
                 # Handle the new key name spacing for collections and co
                 cid, key = decode_collection_id(doc_info.id.encode())
@@ -205,14 +220,14 @@ class SFDSource(pump.Source):
                     logging.debug('Skipping as not default collection')
                     return
 
-                if self.skip(key, vbucket_id):
-                    return
-
                 if doc_info.deleted:
                     cmd = couchbaseConstants.CMD_DCP_DELETE
                 else:
                     cmd = couchbaseConstants.CMD_DCP_MUTATION
 
+                if self.skip(key, vbucket_id, cmd):
+                    return
+
                 # Deletes/tombstones may contain a body if they contain xattrs; a 'KeyError' from 'couchstore' indicates
                 # when this is not the case.
                 try:
@@ -241,13 +256,15 @@ class SFDSource(pump.Source):
 
             if (abatch[0].size() >= batch_max_size or
                     abatch[0].bytes >= batch_max_bytes):
-                self.queue.put((0, abatch[0]))
-                abatch[0] = pump.Batch(self)
+                if put_batch():
+                    abatch[0] = pump.Batch(self)
 
         for f in latest_couch_files(f'{d}/{self.source_bucket["name"]}'):
             vbucket_id = int(re.match(SFD_RE, os.path.basename(f)).group(1))
             if vbucket_id not in vbuckets:
                 continue
+            if stopped[0]:
+                return
 
             try:
                 store = couchstore.CouchStore(f, 'r')
@@ -258,10 +275,16 @@ class SFDSource(pump.Source):
                 # safely ignore them and move to next file.
                 pass
 
-        if abatch[0].size():
-            self.queue.put((0, abatch[0]))
+        if abatch[0].size() and not put_batch():
+            return
         self.queue.put((0, None))
 
+    def close(self):
+        # Give back the budget held by prefetched batches that will no longer
+        # be read, which stops the loader thread.
+        if self.lease:
+            self.lease.close()
+
 
 class SFDSink(pump.Sink):
     """Sink for couchstore in couchbase server/file/directory layout."""
@@ -298,8 +321,6 @@ class SFDSink(pump.Sink):
 
                 for i, msg in enumerate(msgs):
                     cmd, _vbucket_id, key, flg, exp, cas, meta, val, seqno, dtype, nmeta, conf_res = msg
-                    if self.skip(key, vbucket_id):
-                        continue
 
                     # TODO: add default collection to all keys in CC this should change to have the correct collection
                     key = encode_collection_id(0) + key
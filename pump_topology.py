@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+"""Following a source bucket's topology while its documents are transferred."""
+
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import couchbaseConstants
+
+
+def topology_changed(old: Dict[str, Any], new: Dict[str, Any]) -> bool:
+    """Whether a bucket config moved vbuckets or nodes; the config rev is
+       compared when the cluster gives one."""
+    if old.get('rev') is not None and new.get('rev') is not None:
+        return old['rev'] != new['rev']
+    return (old.get('vBucketServerMap') != new.get('vBucketServerMap') or
+            [n.get('hostname') for n in old.get('nodes', [])] != [n.get('hostname') for n in new.get('nodes', [])])
+
+
+class TopologyWatcher(threading.Thread):
+    """Periodically fetches the config of a source bucket, so that vbuckets
+       which move to another node mid-transfer can be followed there."""
+
+    def __init__(self, interval: float, bucket: Dict[str, Any],
+                 fetch: Callable[[], Tuple[couchbaseConstants.PUMP_ERROR, Optional[Dict[str, Any]]]]):
+        super(TopologyWatcher, self).__init__(name="topology", daemon=True)
+        self.interval = max(0.1, interval)
+        self.fetch = fetch
+        self.lock = threading.Lock()
+        self.bucket = bucket
+        self.changes = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def poll(self) -> Dict[str, Any]:
+        """Fetches the bucket config now, and returns the latest one known."""
+        rv, bucket = self.fetch()
+        if rv != 0 or not bucket:
+            logging.warning(f'could not refresh source bucket config: {rv}')
+            return self.latest()
+        with self.lock:
+            if topology_changed(self.bucket, bucket):
+                self.changes += 1
+                logging.info(f'source bucket: {bucket.get("name")} config changed; rev: {self.bucket.get("rev")}'
+                             f' -> {bucket.get("rev")}')
+            self.bucket = bucket
+            return bucket
+
+    def latest(self) -> Dict[str, Any]:
+        with self.lock:
+            return self.bucket
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -11,6 +11,7 @@ import threading
 from typing import Optional
 
 import pump
+import pump_async
 import pump_bfd
 import pump_cb
 import pump_csv
@@ -70,7 +71,17 @@ class Transfer:
         logging.info(f' sink   : {sink}')
         logging.info(f' opts   : {opts.safe}')
 
-        source_class, sink_class = self.find_handlers(opts, source, sink)
+        if getattr(opts, "verify", False):
+            # Read the destination of an earlier transfer back instead of
+            # writing to it, digesting its documents to check them against
+            # the digests that transfer recorded.
+            source, sink = sink, "verify:"
+            if opts.bucket_destination:
+                opts.bucket_source, opts.bucket_destination = opts.bucket_destination, opts.bucket_source
+            opts.extra["data_only"] = 1
+            source_class, sink_class = PumpingStation.find_handler(opts, source, SOURCES), pump.DigestSink
+        else:
+            source_class, sink_class = self.find_handlers(opts, source, sink)
         if not source_class:
             return f'error: unknown type of source: {source}'
         if not sink_class:
@@ -126,6 +137,11 @@ class Transfer:
         opts.extra = opt_parse_extra(opts.extra, self.opt_extra_defaults())
         opts.safe = opt_parse_helper(opts)
 
+        if opts.extra["engine"] not in pump_async.ENGINES:
+            return f'\nError: -x engine has to be one of: {", ".join(pump_async.ENGINES)}', None, None, None
+        if pump.async_engine(opts) and getattr(opts, "processes", False):
+            return "\nError: -x engine=async cannot be used with --processes", None, None, None
+
         return None, opts, rest[0], rest[1]
 
     def opt_parser(self):
@@ -146,6 +162,11 @@ This allows you to transfer to a bucket with a different name
 as your source bucket. If you do not provide defaults to the
 same name as the bucket-source""")
         self.opt_parser_options_common(p)
+        p.add_option("", "--verify",
+                     action="store_true", default=False,
+                     help="""Read back the destination of an earlier transfer made with
+                             -x checksum=1, instead of transferring to it, and report
+                             the vbuckets whose documents differ from what was sent""")
         p.add_option("", "--single-node",
                      action="store_true", default=False,
                      help="""Transfer from a single server node in a source cluster,
@@ -174,6 +195,24 @@ from a source cluster into the caching layer at the destination""")
         p.add_option("-k", "--key",
                      action="store", type="string", default=None,
                      help="""Transfer only items with keys that match a regexp""")
+        p.add_option("", "--key-prefix",
+                     action="append", type="string", default=None,
+                     help="""Transfer only items with keys that start with this prefix;
+                             can be given several times""")
+        p.add_option("", "--vbucket-ids",
+                     action="store", type="string", default=None,
+                     help="""Transfer only items of these vbucketIDs, given as
+                             comma-separated IDs and ranges such as 0-99,512""")
+        p.add_option("", "--collection-ids",
+                     action="store", type="string", default=None,
+                     help="""Transfer only items of these collections, given as
+                             comma-separated hexadecimal collection IDs""")
+        p.add_option("", "--skip-deleted",
+                     action="store_true", default=False,
+                     help="""Do not transfer deletions""")
+        p.add_option("", "--skip-expired",
+                     action="store_true", default=False,
+                     help="""Do not transfer items whose expiry time has passed""")
         p.add_option("", "--vbucket-list",
                      action="store", type="string", default=None,
                      help=optparse.SUPPRESS_HELP)
@@ -203,6 +242,15 @@ from a source cluster into the caching layer at the destination""")
         p.add_option("-t", "--threads",
                      action="store", type="int", default=4,
                      help="""Number of concurrent workers threads performing the transfer""")
+        p.add_option("", "--processes",
+                     action="store_true", default=False,
+                     help="""Run the concurrent workers as separate processes instead
+                             of threads, to use more than one CPU core""")
+        p.add_option("", "--resume",
+                     action="store", type="string", default=None,
+                     help="""Resume an interrupted transfer from this checkpoint file,
+                             restarting the streams of a Couchbase source at the
+                             recorded sequence numbers""")
         p.add_option("-v", "--verbose",
                      action="count", default=0,
                      help="verbose logging; more -v's provide more verbosity. Max is -vvv")
@@ -222,9 +270,15 @@ from a source cluster into the caching layer at the destination""")
             "batch_max_bytes": (400000, "Transfer this # of bytes per batch"),
             "cbb_max_mb": (100000, "Split backup file on destination cluster if it exceeds MiB"),
             "max_retry": (10, "Max number of sequential retries if transfer fails"),
+            "batch_retry": (3, "Number of times a batch that the destination failed to take is resent after "
+                               "reconnecting, before the transfer of its source node fails"),
+            "node_retry": (0, "Number of times the transfer of a Couchbase source node is restarted after it failed, "
+                              "from the last documents the destination took"),
             "report": (5, "Number batches transferred before updating progress bar in console"),
             "report_full": (2000, "Number batches transferred before emitting progress information in console"),
-            "recv_min_bytes": (4096, "Amount of bytes for every TCP/IP call transferred"),
+            "recv_min_bytes": (4096, "Free space the DCP receive buffer keeps for every TCP/IP call"),
+            "recv_buffer_bytes": (262144, "Size of the buffer each DCP connection is read into, which grows to hold "
+                                          "the largest packet"),
             "try_xwm": (1, "Transfer documents with metadata. 0 should only be used if you transfer from 1.8.x to 1.8.x"),
             "nmv_retry": (1, "0 or 1, where 1 retries transfer after a NOT_MY_VBUCKET message"),
             "rehash": (0, "For value 1, rehash the partition id's of each item; \
@@ -239,6 +293,53 @@ such as when transferring data from an OSX server to a non-OSX cluster"),
             "backoff_cap": (10, "Max backoff time during rebalance period"),
             "flow_control": (1, "For value 0, disable flow control to improve throughput"),
             "dcp_consumer_queue_length": (1000, "A DCP client needs a queue for incoming documents/messages. A large length is more efficient, but memory proportional to length*avg. doc size. Below length 150, performance degrades significantly."),
+            "batch_auto": (0, "For value 1, tune batch_max_size and batch_max_bytes during the transfer, "
+                              "starting from their given values"),
+            "engine": ("threads", "For async, run the workers as coroutines on event loops rather than as "
+                                  "threads, doing the network I/O of Couchbase and memcached destinations, "
+                                  "and of Couchbase sources without TLS, on the loops"),
+            "async_loops": (1, "With engine=async, the number of event loops the workers are spread over"),
+            "async_units": (0, "With engine=async, the number of source nodes, or vbucket ranges of nodes, "
+                               "transferred at once; 0 uses --threads"),
+            "coalesce_window": (0, "Number of batches read from the source before sending only the latest "
+                                   "version of each of their keys to the destination, as one batch; 0 disables "
+                                   "coalescing"),
+            "inflight_batches": (1, "Number of batches a destination may have outstanding while the source keeps reading"),
+            "memory_budget": (0, "Limit the bytes of documents buffered by all workers together, waiting for "
+                                 "the destination to take some before reading more; 0 is unlimited"),
+            "metrics_file": ("", "Periodically write per-stage latency metrics to this file, in Prometheus text "
+                                 "format if it ends in .prom or .txt and as JSON otherwise"),
+            "metrics_interval": (10, "Seconds between rewrites of the metrics_file"),
+            "profile": ("", "Write a cProfile of each worker, destination and DCP reader thread to this "
+                            "directory, per bucket and source node"),
+            "profile_interval": (0, "With profile, also sample the stacks of those threads every this many "
+                                    "seconds, writing collapsed stacks for flamegraphs; 0 disables sampling"),
+            "vbucket_ranges": (1, "Number of vbucket ranges each source node is split into, each transferred by its "
+                                  "own worker. 0 splits nodes evenly across the threads"),
+            "dcp_connections_per_node": (1, "Number of DCP connections the vbuckets of each source node, or vbucket "
+                                            "range, are streamed over, each with its own reader, merged into one "
+                                            "worker"),
+            "ops_per_sec": (0, "Limit the documents per second sent to the destination by all workers together; "
+                               "0 is unlimited"),
+            "bytes_per_sec": (0, "Limit the value bytes per second sent to the destination by all workers together; "
+                                 "0 is unlimited"),
+            "node_ops_per_sec": (0, "Limit the documents per second sent to each destination node; 0 is unlimited"),
+            "node_bytes_per_sec": (0, "Limit the value bytes per second sent to each destination node; 0 is unlimited"),
+            "bucket_concurrency": (1, "Number of buckets transferred at once, whose nodes share the --threads "
+                                      "workers"),
+            "bucket_map": ("", "JSON file mapping source bucket names to the destination bucket names they are "
+                               "transferred to"),
+            "defer_index_build": (0, "For value 1, create the GSI indexes of a cluster destination without "
+                                     "building them"),
+            "checksum": (0, "For value 1, compute a digest per vbucket of the documents transferred, which is "
+                            "recorded with a backup and in the checksum_file, for --verify to check"),
+            "checksum_file": ("", "Save the digests computed with checksum=1 to this file; with --verify, read "
+                                  "the digests to check against from it"),
+            "checkpoint_file": ("", "Periodically save the progress of each vbucket to this file, from which an "
+                                    "interrupted transfer can be continued with --resume"),
+            "checkpoint_interval": (10, "Seconds between saves of the checkpoint_file"),
+            "topology_interval": (0, "Seconds between checks of the source cluster's vbucket map, to follow vbuckets "
+                                     "that move between nodes during the transfer. 0 disables following them"),
         }
 
         if add_hidden:
@@ -415,8 +516,13 @@ def opt_parse_extra(extra, extra_defaults):
     for k, v in extra_in.items():
         if k and not extra_defaults.get(k):
             sys.exit("error: unknown extra option: " + k)
-    return dict([(k, float(extra_in.get(k, extra_defaults[k][0])))
-                 for k in extra_defaults.keys()])
+
+    def parse(k):
+        # String options, such as file paths, default to a str value.
+        if isinstance(extra_defaults[k][0], str):
+            return extra_in.get(k, extra_defaults[k][0])
+        return float(extra_in.get(k, extra_defaults[k][0]))
+    return dict([(k, parse(k)) for k in extra_defaults.keys()])
 
 
 def opt_extra_help(parser, extra_defaults):
@@ -437,7 +543,8 @@ SINKS = [pump_bfd.BFDSink,
          pump_mc.MCSink,
          pump_cb.CBSink,
          pump_csv.CSVSink,
-         pump.StdOutSink]
+         pump.StdOutSink,
+         pump.BlackholeSink]
 
 try:
     import pump_sfd
@@ -1,13 +1,22 @@
 import ast
+import asyncio
 import csv
+import io
 import json
+import multiprocessing
 import os
+import queue
+import socket
 import sqlite3
 import struct
+import sys
 import tempfile
+import threading
 import time
 import unittest
+import unittest.mock
 import zipfile
+import zlib
 from collections import defaultdict
 
 import snappy
@@ -15,15 +24,28 @@ from mock_binary_server import MockMemcachedServer
 from mock_server import MockRESTServer
 
 import couchbaseConstants as cbcs
-from cb_bin_client import MemcachedClient
-from pump import Batch, filter_bucket_nodes
-from pump_bfd import BFD, CBB_VERSION, DDOC_FILE_NAME, FTS_FILE_NAME, INDEX_FILE_NAME, BFDSource
+import pump
+import pump_checkpoint
+import pump_checksum
+import pump_coalesce
+import pump_filter
+import pump_memory
+import pump_profile
+import pump_topology
+from cb_bin_client import MemcachedClient, encode_collection_id
+from pump import (Batch, BatchSizer, Pump, PumpingStation, Sink, SinkBatchFuture, Source, filter_bucket_nodes,
+                  hash_vbucket_ids)
+from pump_bfd import BFD, CBB_VERSION, DDOC_FILE_NAME, FTS_FILE_NAME, INDEX_FILE_NAME, BFDSink, BFDSource
 from pump_bfd2 import BFDSinkEx
+from pump_cb import CBSink
 from pump_csv import CSVSink, CSVSource
-from pump_dcp import DCPStreamSource
+from pump_dcp import DCPShards, DCPStreamSource, RecvBuffer
 from pump_gen import GenSource
 from pump_json import JSONSource
 from pump_mc import MCSink
+from pump_metrics import Histogram, Metrics, MetricsExporter, flush, observe, write_metrics_file
+from pump_ratelimit import RateLimiter, TokenBucket
+from pump_transfer import opt_parse_extra
 
 
 # ----------------- support classes -----------------
@@ -509,9 +531,10 @@ class DCPHelperClass:
                   fmt=cbcs.REQ_PKT_FMT, magic=cbcs.REQ_MAGIC_BYTE):
         self.msgs.append((cmd, key, val, opaque, extra_header, cas, dtype, vbucket_id, extra_meta, fmt, magic))
 
-    def get(self):
+    def get(self, block=True, timeout=None):
         if len(self.responses) == 0:
-            return None
+            # As if the timeout passed, without waiting for it.
+            raise queue.Empty()
         val = self.responses[0]
         self.responses = self.responses[1:]
         return val
@@ -600,6 +623,56 @@ class TestDCPSource(unittest.TestCase):
         self.assertEqual(batch, None)
         self.assertTrue(self.source.dcp_done)
 
+    def test_provide_dcp_batch_actual_reader_stopped(self):
+        self.source = DCPStreamSource(self.opts, 'http://localhost:9112', None, {'version': '0.0.0-0000-enterprise'},
+                                      None, None, None, None)
+        self.source.stream_list = ['stream_1']
+        extra = struct.pack(cbcs.DCP_MUTATION_PKT_FMT, 1, 1, 0, 0, 0, 0, 0)
+        data = extra + b'KEY:1' + b'VAL'
+        self.source.response.put((cbcs.CMD_DCP_MUTATION, 0, 0, 0, len(b'KEY:1'), len(extra), data, len(data), 0,
+                                  1000))
+        # The reader stops without a socket, signalling the consumer.
+        self.source.read_responses()
+        self.source.dcp_conn = DCPHelperClass()
+        start = time.monotonic()
+        error, batch = self.source.provide_dcp_batch_actual()
+        self.assertLess(time.monotonic() - start, DCPStreamSource.IDLE_TIMEOUT)
+        self.assertEqual(error, 0)
+        self.assertEqual(batch.size(), 1)
+        self.assertTrue(self.source.dcp_done)
+
+    def test_not_idle_while_throttled(self):
+        budget = pump_memory.MemoryBudget(1000)
+        # Another buffer holds the whole budget for longer than the idle timeout.
+        self.assertTrue(budget.acquire(1000))
+        threading.Timer(0.6, budget.release, args=(1000,)).start()
+        opts = Ditto({'extra': {'batch_max_size': 1, 'batch_max_bytes': 40000}, 'process_name': 'test'})
+        self.source = DCPStreamSource(opts, 'http://localhost:9112', None, {'version': '0.0.0-0000-enterprise'},
+                                      None, None, {'stop': False, 'memory': budget}, None)
+        ours, theirs = socket.socketpair()
+        self.source.dcp_conn = DCPHelperClass()
+        self.source.dcp_conn.s = ours
+        self.source.stream_list = {0: (0, 0, 0, 1, 0, 0, 0)}
+        self.source.running = True
+        extra = struct.pack(cbcs.DCP_MUTATION_PKT_FMT, 1, 1, 0, 0, 0, 0, 0)
+        body = extra + b'KEY:1' + b'VAL'
+        theirs.sendall(struct.pack(cbcs.RES_PKT_FMT, cbcs.RES_MAGIC_BYTE, cbcs.CMD_DCP_MUTATION, len(b'KEY:1'),
+                                   len(extra), 0, 0, len(body), 0, 0) + body)
+        reader = threading.Thread(target=self.source.read_responses, daemon=True)
+        reader.start()
+        try:
+            with unittest.mock.patch.object(DCPStreamSource, 'IDLE_TIMEOUT', 0.2):
+                error, batch = self.source.provide_dcp_batch_actual()
+            self.assertEqual(error, 0)
+            self.assertEqual([msg[2] for msg in batch.msgs], [b'KEY:1'])
+            self.assertFalse(self.source.dcp_done)
+        finally:
+            self.source.running = False
+            self.source.close()
+            reader.join(5)
+            ours.close()
+            theirs.close()
+
     def test_provide_batch_uncompress(self):
         helper_class = DCPHelperClass()
         self.opts = Ditto({'extra': {'batch_max_size': 100, 'batch_max_bytes': 40000, 'uncompress': 1.0},
@@ -861,6 +934,114 @@ class TestDCPSource(unittest.TestCase):
         for m in batch.msgs:
             self.assertIn(m, expected_out)
 
+    def test_split_vbuckets(self):
+        bucket = {'vBucketServerMap': {'serverList': ['10.0.0.1:11210', '10.0.0.2:11210'],
+                                       'vBucketMap': [[i % 2, -1] for i in range(10)]}}
+        node = {'hostname': '10.0.0.2:8091', 'ports': {'direct': 11210}}
+        self.assertEqual(DCPStreamSource.split_vbuckets(self.opts, bucket, node, 1), [None])
+        self.assertEqual(DCPStreamSource.split_vbuckets(self.opts, bucket, node, 2), [[1, 3, 5], [7, 9]])
+        # Never more ranges than active vbuckets.
+        self.assertEqual(len(DCPStreamSource.split_vbuckets(self.opts, bucket, node, 16)), 5)
+
+    def test_vbucket_range(self):
+        bucket = {'vBucketServerMap': {'serverList': ['10.0.0.1:11210'],
+                                       'vBucketMap': [[0, -1] for _ in range(8)]}}
+        node = {'hostname': '10.0.0.1:8091', 'ports': {'direct': 11210}, 'version': '0.0.0-0000-enterprise'}
+        self.source = DCPStreamSource(self.opts, '', bucket, node, None, None, None, None)
+        self.assertEqual(self.source.build_node_vbucket_map(), list(range(8)))
+        self.source.set_vbucket_range(1, [4, 5, 6, 7])
+        self.assertEqual(self.source.build_node_vbucket_map(), [4, 5, 6, 7])
+        self.assertEqual(self.source.dcp_name, 'test-r1')
+
+
+class TestDCPShards(unittest.TestCase):
+    def make_source(self, connections):
+        opts = Ditto({'extra': {'batch_max_size': 100, 'batch_max_bytes': 40000,
+                                'dcp_connections_per_node': connections}, 'process_name': 'test'})
+        source = DCPStreamSource(opts, 'http://localhost:9112', {'name': 'default'},
+                                 {'version': '0.0.0-0000-enterprise', 'hostname': 'a:8091'}, None, None, None,
+                                 defaultdict(int))
+        source.node_vbucket_map = [0, 1, 2]
+        return source
+
+    def test_from_opts(self):
+        self.assertIsNone(DCPShards.from_opts(self.make_source(1)))
+
+    def test_provide_batch(self):
+        def provide_batch(shard):
+            # Each shard provides one batch of a msg per vbucket.
+            if shard.dcp_done:
+                return 0, None
+            shard.dcp_done = True
+            for _ in range(1000):
+                shard.cur[pump_filter.SKIP_KEY] = shard.cur.get(pump_filter.SKIP_KEY, 0) + 1
+            batch = Batch(shard)
+            for vbid in shard.node_vbucket_map:
+                batch.append((cbcs.CMD_DCP_MUTATION, vbid, b'KEY', 0, 0, 0, b'', b'VAL', 1, 0, 0, 0), 3)
+            return 0, batch
+
+        source = self.make_source(2)
+        with unittest.mock.patch.object(DCPStreamSource, 'provide_batch', provide_batch):
+            shards = DCPShards.from_opts(source)
+            self.assertEqual([shard.node_vbucket_map for shard in shards.shards], [[0, 1], [2]])
+            self.assertEqual([shard.dcp_name for shard in shards.shards], ['test-c0', 'test-c1'])
+            self.assertIs(shards.shards[1].cur['snapshot'], source.cur['snapshot'])
+            vbids = []
+            rv, batch = shards.provide_batch()
+            while batch is not None:
+                vbids += [msg[1] for msg in batch.msgs]
+                rv, batch = shards.provide_batch()
+        self.assertEqual(rv, 0)
+        self.assertEqual(sorted(vbids), [0, 1, 2])
+        self.assertTrue(source.dcp_done)
+        # Each shard counts on its own, and none of the counts are lost.
+        self.assertEqual(source.cur[pump_filter.SKIP_KEY], 2000)
+
+    def test_provide_batch_error(self):
+        def provide_batch(shard):
+            if shard.dcp_name.endswith('-c1'):
+                return 'error: boom', None
+            return 0, Batch(shard)  # Never done until closed.
+
+        source = self.make_source(2)
+        with unittest.mock.patch.object(DCPStreamSource, 'provide_batch', provide_batch):
+            shards = DCPShards.from_opts(source)
+            rv, batch = shards.provide_batch()
+            while rv == 0:
+                rv, batch = shards.provide_batch()
+            self.assertEqual(rv, 'error: boom')
+            for thread in shards.threads:
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+
+
+class TestRecvBuffer(unittest.TestCase):
+    def test_next_packet(self):
+        bodies = [b'a' * 10, b'', b'b' * 100, b'c' * 7]
+        data = b''.join(struct.pack(cbcs.RES_PKT_FMT, cbcs.RES_MAGIC_BYTE, cbcs.CMD_DCP_MUTATION, 0, 0, 0, i,
+                                    len(body), i, 0) + body for i, body in enumerate(bodies))
+        ours, theirs = socket.socketpair()
+        buf = RecvBuffer(32, 8)
+        packets = []
+        try:
+            # Packets arrive split, and larger than the buffer.
+            sent = 0
+            while len(packets) < len(bodies):
+                if sent < len(data):
+                    theirs.sendall(data[sent:sent + 20])
+                    sent += 20
+                buf.filled(buf.recv_into(ours))
+                packet = buf.next_packet()
+                while packet is not None:
+                    packets.append(packet)
+                    packet = buf.next_packet()
+        finally:
+            ours.close()
+            theirs.close()
+        self.assertEqual([(p[4], p[5], p[6], p[8]) for p in packets],
+                         [(i, len(body), i, body) for i, body in enumerate(bodies)])
+        self.assertEqual(buf.start, buf.end)
+
 
 class TestCSVSink(unittest.TestCase):
     def setUp(self):
@@ -1103,6 +1284,23 @@ class TestBFDSinkEx(unittest.TestCase):
 
             self.assertEqual(count, len(msgs))
 
+    @unittest.skipIf('fork' not in multiprocessing.get_all_start_methods(), 'needs fork')
+    def test_write_json_file_processes(self):
+        def write(tmpdirname, first):
+            # Each process records the seqnos of its own vbuckets, over and over.
+            for seqno in range(1, 31):
+                BFD.write_json_file(tmpdirname, 'seqno.json', {vbid: seqno for vbid in range(first, first + 4)})
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            context = multiprocessing.get_context('fork')
+            processes = [context.Process(target=write, args=(tmpdirname, first)) for first in range(0, 16, 4)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            with open(os.path.join(tmpdirname, 'seqno.json')) as f:
+                self.assertEqual(json.load(f), {str(vbid): 30 for vbid in range(16)})
+
 
 class FakeSocket:
     def __init__(self):
@@ -1477,3 +1675,1207 @@ class TestPumpFunctions(unittest.TestCase):
         for (i, test_case) in enumerate(test_cases):
             with self.subTest(i=i):
                 self.assertListEqual(filter_bucket_nodes(test_case[0], test_case[1]), test_case[2])
+
+
+class ListSource(Source):
+    def __init__(self, opts, batches, on_provide=None):
+        super(ListSource, self).__init__(opts, 'list:', {'name': 'default'}, {'hostname': 'N/A'}, None, None, None,
+                                         None)
+        self.batches = batches
+        self.on_provide = on_provide
+        self.provided = 0
+
+    def provide_batch(self):
+        if self.on_provide:
+            self.on_provide(self.provided)
+        if not self.batches:
+            return 0, None
+        self.provided += 1
+        msgs = self.batches.pop(0)
+        batch = Batch(self)
+        for msg in msgs:
+            batch.append(msg, len(msg[7]))
+        return 0, batch
+
+
+class GatedSink(Sink):
+    def __init__(self, opts, ctl, cur, gate):
+        super(GatedSink, self).__init__(opts, 'gated:', {'name': 'default'}, {'hostname': 'N/A'}, None, None, ctl,
+                                        cur)
+        self.gate = gate
+        self.consumed = []
+        self.init_worker(GatedSink.run)
+
+    @staticmethod
+    def run(self):
+        self.gate.wait(5)
+        while True:
+            batch, future = self.pull_next_batch()
+            if not batch:
+                return self.future_done(future, 0)
+            self.consumed.append(batch.size())
+            self.future_done(future, 0)
+
+    def close(self):
+        self.push_next_batch(None, None)
+
+    def consume_batch_async(self, batch):
+        return self.push_next_batch(batch, SinkBatchFuture(self, batch))
+
+
+def make_msgs(count, prefix='KEY'):
+    return [(cbcs.CMD_DCP_MUTATION, 0, f'{prefix}:{i}'.encode(), 0, 0, 0, b'', b'VALUE', i + 1, 0, 0, 0)
+            for i in range(count)]
+
+
+class TestPump(unittest.TestCase):
+    def run_pump(self, extra, batches, gate=None, on_provide=None):
+        opts = Ditto({'extra': extra, 'verbose': 0})
+        ctl = {'stop': False, 'rv': 0, 'run_msg': 0, 'tot_msg': 0}
+        cur = defaultdict(int)
+        source = ListSource(opts, batches, on_provide)
+        sink = GatedSink(opts, ctl, cur, gate or threading.Event())
+        if not gate:
+            sink.gate.set()
+        rv = Pump(opts, source, sink, None, None, ctl, cur).run()
+        return rv, source, sink, ctl, cur
+
+    def test_run_counts(self):
+        rv, _, sink, ctl, cur = self.run_pump({'report': 0, 'report_full': 0},
+                                              [make_msgs(3), make_msgs(2), make_msgs(4)])
+        self.assertEqual(rv, 0)
+        self.assertEqual(sink.consumed, [3, 2, 4])
+        self.assertEqual(cur['tot_sink_batch'], 3)
+        self.assertEqual(cur['tot_sink_msg'], 9)
+        self.assertEqual(cur['tot_source_byte'], cur['tot_sink_byte'])
+        self.assertEqual(ctl['run_msg'], 9)
+
+    def test_inflight_window(self):
+        gate = threading.Event()
+        provided_while_blocked = []
+
+        def on_provide(provided):
+            # The sink is blocked until the source got ahead by the whole window.
+            if not gate.is_set():
+                provided_while_blocked.append(provided)
+                if provided == 3:
+                    gate.set()
+
+        rv, source, sink, _, cur = self.run_pump({'report': 0, 'report_full': 0, 'inflight_batches': 3},
+                                                 [make_msgs(1, str(i)) for i in range(6)], gate, on_provide)
+        self.assertEqual(rv, 0)
+        self.assertEqual(provided_while_blocked, [0, 1, 2, 3])
+        self.assertEqual(sink.consumed, [1] * 6)
+        self.assertEqual(cur['tot_sink_batch'], 6)
+
+    def test_coalesce_window(self):
+        def msg(vbucket_id, key, seqno):
+            return (cbcs.CMD_DCP_MUTATION, vbucket_id, key, 0, 0, 0, b'', b'VALUE', seqno, 0, 0, 0)
+
+        rv, _, sink, ctl, cur = self.run_pump(
+            {'report': 0, 'report_full': 0, 'coalesce_window': 2},
+            [[msg(0, b'a', 1), msg(0, b'b', 2), msg(0, b'a', 3)],
+             [msg(0, b'b', 4), msg(1, b'a', 5), msg(0, b'c', 6)],
+             [msg(0, b'c', 7)]])
+        self.assertEqual(rv, 0)
+        self.assertEqual(sink.consumed, [4, 1])
+        self.assertEqual(cur['tot_sink_msg'], 5)
+        self.assertEqual(cur['tot_coalesce_msg'], 2)
+        self.assertEqual(cur['tot_coalesce_byte'], 10)
+        self.assertEqual(cur['tot_source_byte'], cur['tot_sink_byte'])
+        self.assertEqual(ctl['tot_msg'], 0)
+        self.assertEqual(ctl['adjust_msg'], -2)
+
+    def test_coalesce_keeps_highest_seqno(self):
+        source = ListSource(Ditto({'extra': {}}), [])
+        batches = []
+        for msgs in [[(cbcs.CMD_DCP_MUTATION, 0, b'a', 0, 0, 0, b'', b'new', 9),
+                      (cbcs.CMD_DCP_DELETE, 0, b'b', 0, 0, 0, b'', b'', 3)],
+                     [(cbcs.CMD_DCP_MUTATION, 0, b'a', 0, 0, 0, b'', b'old', 4),
+                      (cbcs.CMD_DCP_MUTATION, 0, b'b', 0, 0, 0, b'', b'again', 8)]]:
+            batch = Batch(source)
+            for m in msgs:
+                batch.append(m, len(m[7]))
+            batches.append(batch)
+        cur = defaultdict(int)
+        batch = pump_coalesce.coalesce(batches, Batch, cur)
+        self.assertEqual([(m[2], m[7]) for m in batch.msgs], [(b'a', b'new'), (b'b', b'again')])
+        self.assertEqual(batch.bytes, 8)
+        self.assertEqual(cur['tot_coalesce_msg'], 2)
+
+    def run_coalesced_csv(self, estimate):
+        with tempfile.TemporaryDirectory() as d:
+            spec = os.path.join(d, 'docs.csv')
+            with open(spec, 'w') as f:
+                f.write("id,value\na,b'0123456789'\nb,b'x'\na,b'9876543210'\nc,b'y'\nd,b'z'\n")
+            opts = Ditto({'extra': {'report': 1, 'report_full': 0, 'coalesce_window': 2,
+                                    'batch_max_size': 2, 'batch_max_bytes': 400000}, 'verbose': 0})
+            ctl = {'stop': False, 'rv': 0, 'run_msg': 0, 'tot_msg': estimate}
+            cur = defaultdict(int)
+            source = CSVSource(opts, spec, {'name': 'docs.csv'}, {'hostname': 'N/A'}, None, None, ctl, cur)
+            sink = GatedSink(opts, ctl, cur, threading.Event())
+            sink.gate.set()
+            with unittest.mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                rv = Pump(opts, source, sink, None, None, ctl, cur).run()
+        return rv, cur, stderr.getvalue()
+
+    def test_coalesce_counts_source_bytes(self):
+        rv, cur, _ = self.run_coalesced_csv(0)
+        self.assertEqual(rv, 0)
+        self.assertEqual(cur['tot_sink_msg'], 4)
+        # The csv source counts each msg by its fields, not its value bytes.
+        self.assertEqual(cur['tot_coalesce_byte'], 2)
+        self.assertEqual(cur['tot_source_byte'], 8)
+        self.assertEqual(cur['tot_sink_byte'], 8)
+
+    def test_coalesce_progress(self):
+        # Without an estimate there is no bar to adjust.
+        _, _, output = self.run_coalesced_csv(0)
+        self.assertEqual(output, '..')
+        # The estimate less the coalesced msgs is never below the msgs sent.
+        _, _, output = self.run_coalesced_csv(2)
+        self.assertIn('100.0% (3/estimated 3 msgs)', output)
+
+
+class CountSource(Source):
+    def __init__(self, opts, spec, source_bucket, source_node, source_map, sink_map, ctl, cur):
+        super(CountSource, self).__init__(opts, spec, source_bucket, source_node, source_map, sink_map, ctl, cur)
+        self.remaining = opts.extra['count']
+
+    def provide_batch(self):
+        batch = Batch(self)
+        for msg in make_msgs(self.remaining, self.source_node['hostname']):
+            batch.append(msg, len(msg[7]))
+        self.remaining = 0
+        return 0, batch if batch.size() else None
+
+
+class CountSink(Sink):
+    def consume_batch_async(self, batch):
+        future = SinkBatchFuture(self, batch)
+        self.future_done(future, 0)
+        return 0, future
+
+
+class FailingSource(CountSource):
+    def provide_batch(self):
+        raise ValueError('boom')
+
+
+class TestPumpingStation(unittest.TestCase):
+    def run_units(self, processes, source_class=CountSource):
+        opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0}, 'verbose': 0, 'threads': 2,
+                      'processes': processes})
+        station = PumpingStation(opts, source_class, 'count:', CountSink, 'count:')
+        station.ctl['run_msg'] = 0
+        station.ctl['tot_msg'] = 0
+        try:
+            station.start_workers(3)
+            for host in ['a', 'b', 'c']:
+                station.put_unit(({'name': 'default'}, {'hostname': host}, {}, {},
+                                  {'source': False, 'sink': False}, (0, None)))
+            station.wait_for_units()
+            self.assertEqual(station.units_outstanding, 0)
+            if source_class is not CountSource:
+                return station.ctl['rv']
+            self.assertEqual(station.ctl['rv'], 0)
+            self.assertEqual(station.ctl['run_msg'], 15)
+            self.assertEqual(station.cur['tot_sink_msg'], 15)
+            self.assertEqual(station.cur['tot_sink_batch'], 3)
+            self.assertEqual(station.metrics.snapshot()['provide']['count'], 6)
+            self.assertEqual(station.metrics.snapshot()['wait']['count'], 3)
+        finally:
+            station.stop_workers()
+
+    def test_threads(self):
+        self.run_units(False)
+
+    def test_processes(self):
+        self.run_units(True)
+
+    def test_failed_units_complete(self):
+        self.assertEqual(self.run_units(False, FailingSource), 'error: worker failed: boom')
+        self.assertEqual(self.run_units(True, FailingSource), 'error: worker process failed: boom')
+
+
+class TestVbucketHashing(unittest.TestCase):
+    def setUp(self):
+        self.source = Ditto({'opts': Ditto({'collection': None})})
+        self.keys = [f'key::{i}'.encode() for i in range(100)]
+        self.expected = [((zlib.crc32(key) >> 16) & 0x7FFF) % 1024 for key in self.keys]
+
+    def test_hash_vbucket_ids(self):
+        self.assertEqual(hash_vbucket_ids(self.keys, 1024), self.expected)
+        self.assertEqual(hash_vbucket_ids([key.decode() for key in self.keys], 1024), self.expected)
+
+    def test_hash_vbucket_ids_without_numpy(self):
+        saved, pump.numpy = pump.numpy, None
+        try:
+            self.assertEqual(hash_vbucket_ids(self.keys, 1024), self.expected)
+        finally:
+            pump.numpy = saved
+
+    def test_group_by_vbucket_id(self):
+        batch = Batch(self.source)
+        for i, key in enumerate(self.keys):
+            # Every other msg already has a vbucket id.
+            batch.append((cbcs.CMD_DCP_MUTATION, 0x0000ffff if i % 2 else 5, key, 0, 0, 0, b'', b'', 0, 0, 0, 0), 0)
+        expected = defaultdict(list)
+        for i, msg in enumerate(batch.msgs):
+            expected[self.expected[i] if i % 2 else 5].append(msg)
+        self.assertEqual(batch.group_by_vbucket_id(1024), expected)
+        self.assertEqual(batch.vbucket_ids(1024, rehash=1), self.expected)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        hist = Histogram()
+        for ms in range(1, 101):
+            hist.record(ms / 1000.0)
+        self.assertEqual(hist.count, 100)
+        self.assertEqual(hist.max, 0.1)
+        # Percentiles are bucket upper bounds, at most ~19% above the truth.
+        self.assertTrue(0.05 <= hist.percentile(50) <= 0.05 * 1.2)
+        self.assertTrue(0.099 <= hist.percentile(99) <= 0.1)
+        merged = Histogram(hist.state())
+        merged.merge(hist.state())
+        self.assertEqual(merged.count, 200)
+        self.assertEqual(merged.percentile(50), hist.percentile(50))
+
+    def test_flush(self):
+        cur = defaultdict(int)
+        metrics = Metrics()
+        observe(cur, 'provide', 0.001)
+        observe(cur, 'provide', 0.002)
+        flush(cur, metrics)
+        observe(cur, 'provide', 0.003)
+        flush(cur, metrics)
+        self.assertEqual(metrics.snapshot()['provide']['count'], 3)
+        self.assertEqual(cur['latency_provide'].count, 0)
+
+    def test_write_metrics_file(self):
+        metrics = Metrics()
+        metrics.merge({'wait': {'buckets': {10: 2}, 'count': 2, 'sum': 0.01, 'max': 0.006}})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.json')
+            write_metrics_file(path, metrics.snapshot(), {'run_msg': 7})
+            with open(path) as f:
+                data = json.load(f)
+            self.assertEqual(data['stages']['wait']['count'], 2)
+            self.assertEqual(data['counters']['run_msg'], 7)
+
+            path = os.path.join(tmp, 'metrics.prom')
+            write_metrics_file(path, metrics.snapshot(), {'run_msg': 7})
+            with open(path) as f:
+                text = f.read()
+            self.assertIn('cbtransfer_stage_latency_seconds_count{stage="wait"} 2', text)
+            self.assertIn('cbtransfer_run_msg 7', text)
+
+    def test_exporter(self):
+        metrics = Metrics()
+        metrics.merge({'send': {'buckets': {3: 1}, 'count': 1, 'sum': 0.001, 'max': 0.001}})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.json')
+            exporter = MetricsExporter(path, 0.1, metrics.snapshot, lambda: {'run_msg': 1})
+            exporter.start()
+            exporter.stop()
+            with open(path) as f:
+                self.assertEqual(json.load(f)['stages']['send']['count'], 1)
+
+    def test_opt_parse_extra_str(self):
+        defaults = {'metrics_file': ('', 'file'), 'report': (5, 'report')}
+        self.assertEqual(opt_parse_extra('metrics_file=/tmp/m.prom,report=2', defaults),
+                         {'metrics_file': '/tmp/m.prom', 'report': 2.0})
+        self.assertEqual(opt_parse_extra(None, defaults), {'metrics_file': '', 'report': 5.0})
+
+
+class TestBatchSizer(unittest.TestCase):
+    def setUp(self):
+        self.opts = Ditto({'extra': {'batch_max_size': 100, 'batch_max_bytes': 10000}})
+        self.batch = Batch(None)
+        for msg in make_msgs(10):
+            self.batch.append(msg, len(msg[7]))
+
+    def feed(self, sizer, retries=0, secs=1.0):
+        sizer.window_start -= secs
+        for _ in range(BatchSizer.WINDOW):
+            sizer.consumed(self.batch, retries)
+
+    def test_additive_increase(self):
+        sizer = BatchSizer(self.opts, 'test')
+        self.feed(sizer)
+        self.feed(sizer)
+        self.assertEqual(sizer.limits(), (120, 12000))
+
+    def test_multiplicative_decrease_on_retries(self):
+        sizer = BatchSizer(self.opts, 'test')
+        self.feed(sizer, retries=3)
+        self.assertEqual(sizer.limits(), (50, 5000))
+        # Retries only count when they increase.
+        self.feed(sizer, retries=3)
+        self.assertEqual(sizer.limits(), (60, 6000))
+        for _ in range(10):
+            self.feed(sizer, retries=sizer.retries + 1)
+        self.assertEqual(sizer.limits(), (10, 1000))
+
+    def test_decrease_on_throughput_drop(self):
+        sizer = BatchSizer(self.opts, 'test')
+        self.feed(sizer)
+        sizer.last_throughput = float('inf')
+        self.feed(sizer, secs=1.0)
+        self.assertEqual(sizer.limits(), (82, 8250))
+
+    def test_source_batch_limits(self):
+        source = CountSource(Ditto({'extra': {'count': 1, 'batch_max_size': 100, 'batch_max_bytes': 10000,
+                                              'batch_auto': 1}}), '', {}, {}, None, None, None, None)
+        self.assertEqual(source.batch_limits(), (100, 10000))
+        runner = Pump(source.opts, source, None, None, None, {}, defaultdict(int))
+        self.assertIs(source.batch_sizer, runner.batch_sizer)
+        runner.batch_sizer.size = 7
+        self.assertEqual(source.batch_limits(), (7, 10000))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(10)
+        now = bucket.last
+        # A full second's burst goes through at once, the rest at the rate.
+        self.assertEqual(bucket.reserve(10, now), 0.0)
+        self.assertAlmostEqual(bucket.reserve(10, now), 1.0)
+        self.assertAlmostEqual(bucket.reserve(5, now + 1.0), 0.5)
+        self.assertEqual(bucket.reserve(5, now + 10.0), 0.0)
+
+    def test_reserve(self):
+        limiter = RateLimiter(ops_per_sec=100, bytes_per_sec=1000)
+        self.assertEqual(limiter.reserve(100, 1000), 0.0)
+        self.assertAlmostEqual(limiter.reserve(10, 2000), 2.0, places=2)
+
+    def test_reserve_nodes(self):
+        limiter = RateLimiter(node_ops_per_sec=10)
+        self.assertEqual(limiter.reserve(1000, 1000), 0.0)
+        self.assertEqual(limiter.reserve_nodes({'a:11210': (10, 0), 'b:11210': (10, 0)}), 0.0)
+        self.assertAlmostEqual(limiter.reserve_nodes({'a:11210': (10, 0)}), 1.0, places=2)
+        self.assertEqual(limiter.reserve_nodes({'c:11210': (10, 0)}), 0.0)
+
+    def test_from_opts(self):
+        self.assertIsNone(RateLimiter.from_opts(Ditto({'extra': {'ops_per_sec': 0, 'bytes_per_sec': 0}})))
+        self.assertIsNotNone(RateLimiter.from_opts(Ditto({'extra': {'node_bytes_per_sec': 100}})))
+
+    def test_pump_throttled(self):
+        opts = Ditto({'extra': {'report': 0, 'report_full': 0}, 'verbose': 0})
+        ctl = {'stop': False, 'rv': 0, 'run_msg': 0, 'tot_msg': 0, 'limiter': RateLimiter(ops_per_sec=40)}
+        cur = defaultdict(int)
+        sink = GatedSink(opts, ctl, cur, threading.Event())
+        sink.gate.set()
+        start = time.monotonic()
+        rv = Pump(opts, ListSource(opts, [make_msgs(40), make_msgs(10)]), sink, None, None, ctl, cur).run()
+        self.assertEqual(rv, 0)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(cur['latency_throttle'].count, 2)
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_update_keeps_highest(self):
+        checkpoint = pump_checkpoint.Checkpoint()
+        checkpoint.update('default', 'a', {0: 10, 1: 5}, {0: [(123, 0)]}, {0: (8, 12), 1: (5, 5)})
+        checkpoint.update('default', 'a', {0: 7, 1: 6}, {}, {0: (7, 7), 1: (6, 6)})
+        # Vbucket 1 moved to node b.
+        checkpoint.update('default', 'b', {1: 9}, {1: [(456, 0)]}, {1: (9, 9)})
+        seqnos, failoverlogs, snapshots = checkpoint.resume_state('default')
+        self.assertEqual(seqnos, {'0': 10, '1': 9})
+        self.assertEqual(failoverlogs, {'0': [(123, 0)], '1': [(456, 0)]})
+        self.assertEqual(snapshots, {'0': (8, 12), '1': (9, 9)})
+        self.assertEqual(checkpoint.resume_state('other'), ({}, {}, {}))
+
+    def test_save_and_load(self):
+        checkpoint = pump_checkpoint.Checkpoint()
+        checkpoint.update('default', 'a', {3: 10}, {3: [(9, 0)]}, {3: (10, 10)})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'checkpoint.json')
+            checkpoint.save(path)
+            rv, loaded = pump_checkpoint.Checkpoint.load(path)
+            self.assertEqual(rv, 0)
+            self.assertEqual(loaded.resume_state('default'), checkpoint.resume_state('default'))
+
+            with open(path, 'w') as f:
+                f.write('{"version": 0}')
+            self.assertEqual(pump_checkpoint.Checkpoint.load(path)[0], f'error: unsupported checkpoint file: {path}')
+            self.assertTrue(pump_checkpoint.Checkpoint.load(os.path.join(tmp, 'missing'))[0].startswith('error:'))
+
+    def test_flush_and_resume(self):
+        pair_index = ('default', 'a')
+        # As a DCP source keeps them, keyed by int vbucket id.
+        cur = defaultdict(int, {'failoverlog': {pair_index: {0: [(1, 0), (2, 50)]}},
+                                'snapshot': {pair_index: {0: (40, 60), 1: (90, 100)}}})
+        batch = Batch(None)
+        batch.append((cbcs.CMD_DCP_MUTATION, 0, b'k0', 0, 0, 0, b'', b'v', 55, 0, 0, 0), 1)
+        batch.append((cbcs.CMD_DCP_MUTATION, 1, b'k1', 0, 0, 0, b'', b'v', 80, 0, 0, 0), 1)
+        progress = {}
+        pump_checkpoint.batch_progress(batch, progress)
+        self.assertEqual(progress, {0: 55, 1: 80})
+
+        checkpoint = pump_checkpoint.Checkpoint()
+        pump_checkpoint.flush(cur, checkpoint, 'default', 'a', progress)
+        self.assertEqual(progress, {})
+
+        resumed = defaultdict(int)
+        pump_checkpoint.resume(resumed, checkpoint, 'default', 'a')
+        self.assertEqual(resumed['seqno'], {pair_index: {'0': 55, '1': 80}})
+        self.assertEqual(resumed['failoverlog'], {pair_index: {'0': [(2, 50), (1, 0)]}})
+        # The source read ahead of vbucket 1's seqno into a later snapshot.
+        self.assertEqual(resumed['snapshot'], {pair_index: {'0': (40, 60), '1': (80, 80)}})
+
+    def run_units(self, processes):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'checkpoint.json')
+            opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0, 'checkpoint_file': path,
+                                    'checkpoint_interval': 60},
+                          'verbose': 0, 'threads': 2, 'processes': processes})
+            station = PumpingStation(opts, CountSource, 'count:', CountSink, 'count:')
+            station.ctl['run_msg'] = 0
+            station.ctl['tot_msg'] = 0
+            self.assertEqual(station.init_checkpoint(), 0)
+            station.checkpoint_writer.start()
+            try:
+                station.start_workers(2)
+                for host in ['a', 'b']:
+                    station.put_unit(({'name': 'default'}, {'hostname': host}, {}, {},
+                                      {'source': False, 'sink': False}, (0, None)))
+                station.wait_for_units()
+                station.checkpoint_writer.stop()
+            finally:
+                station.stop_workers()
+            rv, checkpoint = pump_checkpoint.Checkpoint.load(path)
+            self.assertEqual(rv, 0)
+            self.assertEqual(checkpoint.resume_state('default'), ({'0': 5}, {}, {'0': (5, 5)}))
+            self.assertEqual(sorted(checkpoint.state()['buckets']['default']), ['a', 'b'])
+
+    def test_station_threads(self):
+        self.run_units(False)
+
+    def test_station_processes(self):
+        self.run_units(True)
+
+
+class FlakySink(Sink):
+    """Fails the first batches it is given, like a sink whose connection
+       was reset, and stops its worker as MCSink does."""
+    reconnectable = True
+
+    def __init__(self, opts, ctl, cur, failures):
+        super(FlakySink, self).__init__(opts, 'flaky:', {'name': 'default'}, {'hostname': 'N/A'}, None, None, ctl,
+                                        cur)
+        self.failures = failures
+        self.consumed = []
+        self.init_worker(FlakySink.run)
+
+    @staticmethod
+    def run(self):
+        while True:
+            batch, future = self.pull_next_batch()
+            if not batch:
+                return self.future_done(future, 0)
+            if self.failures:
+                self.failures -= 1
+                return self.future_done(future, 'error: connection reset')
+            self.consumed.append(batch.msg(0)[2])
+            self.future_done(future, 0)
+
+    def reconnect(self):
+        return self.restart_worker()
+
+    def close(self):
+        self.push_next_batch(None, None)
+
+    def consume_batch_async(self, batch):
+        return self.push_next_batch(batch, SinkBatchFuture(self, batch))
+
+
+class RetryOnceSource(CountSource):
+    """Fails the first time it is pumped for a node, after one batch."""
+    resumable = True
+    attempts = defaultdict(int)
+    resumed = {}
+
+    def provide_batch(self):
+        hostname = self.source_node['hostname']
+        if RetryOnceSource.attempts[hostname] == 0:
+            if self.cur['tot_source_batch']:
+                RetryOnceSource.attempts[hostname] += 1
+                return f'error: connection reset: {hostname}', None
+            return super(RetryOnceSource, self).provide_batch()
+        RetryOnceSource.resumed[hostname] = self.cur['seqno'][(self.source_bucket['name'], hostname)]
+        return 0, None
+
+
+class TestRetry(unittest.TestCase):
+    def run_pump(self, extra, failures, sink_class=None):
+        opts = Ditto({'extra': dict({'report': 0, 'report_full': 0, 'backoff_cap': 0}, **extra), 'verbose': 0})
+        ctl = {'stop': False, 'rv': 0, 'run_msg': 0, 'tot_msg': 0}
+        cur = defaultdict(int)
+        sink = (sink_class or FlakySink)(opts, ctl, cur, failures)
+        source = ListSource(opts, [make_msgs(1, str(i)) for i in range(4)])
+        rv = Pump(opts, source, sink, None, None, ctl, cur).run()
+        return rv, sink, cur
+
+    def test_batch_retry(self):
+        rv, sink, cur = self.run_pump({'inflight_batches': 2, 'batch_retry': 3}, 2)
+        self.assertEqual(rv, 0)
+        # The failed batch and the one outstanding behind it are resent in order.
+        self.assertEqual(sink.consumed, [b'0:0', b'1:0', b'2:0', b'3:0'])
+        self.assertEqual(cur['tot_sink_retry_reconnect'], 2)
+        self.assertEqual(cur['tot_sink_msg'], 4)
+
+    def test_batch_retry_exhausted(self):
+        rv, sink, cur = self.run_pump({'batch_retry': 1}, 2)
+        self.assertEqual(rv, 'error: connection reset')
+        self.assertEqual(cur['tot_sink_retry_reconnect'], 1)
+
+    def test_batch_retry_reconnect_fails(self):
+        class UnreachableSink(FlakySink):
+            def reconnect(self):
+                return 'error: cannot reconnect to sink: unreachable'
+
+        rv, _, cur = self.run_pump({'batch_retry': 2}, 1, UnreachableSink)
+        # The batch's own error comes back, not the reconnect's.
+        self.assertEqual(rv, 'error: connection reset')
+        self.assertEqual(cur['tot_sink_retry_reconnect'], 2)
+
+    def test_batch_retry_not_reconnectable(self):
+        class DiskFullSink(FlakySink):
+            reconnectable = False
+
+        rv, _, cur = self.run_pump({'batch_retry': 3}, 1, DiskFullSink)
+        self.assertEqual(rv, 'error: connection reset')
+        self.assertEqual(cur['tot_sink_retry_reconnect'], 0)
+
+    def run_units(self, source_class, extra):
+        opts = Ditto({'extra': dict({'count': 5, 'report': 0, 'report_full': 0, 'backoff_cap': 0.05}, **extra),
+                      'verbose': 0, 'threads': 2, 'processes': False})
+        station = PumpingStation(opts, source_class, 'count:', CountSink, 'count:')
+        station.ctl['run_msg'] = 0
+        station.ctl['tot_msg'] = 0
+        self.assertEqual(station.init_checkpoint(), 0)
+        station.start_workers(2)
+        for host in ['a', 'b']:
+            station.put_unit(({'name': 'default'}, {'hostname': host}, {}, {},
+                              {'source': False, 'sink': False}, (0, None)))
+        station.wait_for_units()
+        station.stop_workers()
+        return station
+
+    def test_node_retry(self):
+        RetryOnceSource.attempts.clear()
+        RetryOnceSource.resumed.clear()
+        station = self.run_units(RetryOnceSource, {'node_retry': 1})
+        self.assertEqual(station.ctl['rv'], 0)
+        self.assertEqual(station.node_retries, {'a': 1, 'b': 1})
+        # Each re-queued unit resumed from the seqnos its sink acknowledged,
+        # so the msgs of the failed attempts are only counted once.
+        self.assertEqual(RetryOnceSource.resumed, {'a': {'0': 5}, 'b': {'0': 5}})
+        self.assertEqual(station.cur['tot_sink_msg'], 10)
+        self.assertEqual(station.ctl['run_msg'], 10)
+
+    def test_node_retry_not_resumable(self):
+        class RestartingSource(RetryOnceSource):
+            resumable = False
+        RetryOnceSource.attempts.clear()
+        station = self.run_units(RestartingSource, {'node_retry': 1})
+        self.assertIn(station.ctl['rv'], ['error: connection reset: a', 'error: connection reset: b'])
+        self.assertEqual(station.node_retries, {})
+
+
+class MovingSource(CountSource):
+    """Source whose node a lost vbucket 3 to node b while it was streamed."""
+    ranges = []
+
+    @staticmethod
+    def refresh_bucket(opts, spec, bucket_name):
+        return 0, {'name': bucket_name, 'rev': 2, 'nodes': [{'hostname': 'a'}, {'hostname': 'b'}]}
+
+    @staticmethod
+    def find_vbucket_node(source_bucket, vbucket_id):
+        return source_bucket['nodes'][1] if vbucket_id == 3 else None
+
+    def provide_batch(self):
+        MovingSource.ranges.append((self.source_node['hostname'], self.vbucket_range,
+                                    self.cur['seqno'].get((self.source_bucket['name'], self.source_node['hostname']))))
+        if self.source_node['hostname'] == 'a' and self.vbucket_range is None:
+            self.vbucket_moved(3)
+            self.vbucket_moved(4)
+        return 0, None
+
+
+class TestTopology(unittest.TestCase):
+    def test_topology_changed(self):
+        self.assertTrue(pump_topology.topology_changed({'rev': 1}, {'rev': 2}))
+        self.assertFalse(pump_topology.topology_changed({'rev': 2, 'nodes': [{'hostname': 'a'}]}, {'rev': 2}))
+        self.assertTrue(pump_topology.topology_changed({'nodes': [{'hostname': 'a'}]}, {'nodes': []}))
+
+    def test_watcher(self):
+        configs = [(0, {'name': 'default', 'rev': 1}), ('error: timeout', None), (0, {'name': 'default', 'rev': 2})]
+        watcher = pump_topology.TopologyWatcher(10, {'name': 'default', 'rev': 1}, lambda: configs.pop(0))
+        self.assertEqual(watcher.poll()['rev'], 1)
+        self.assertEqual(watcher.poll()['rev'], 1)
+        self.assertEqual(watcher.poll()['rev'], 2)
+        self.assertEqual(watcher.latest()['rev'], 2)
+        self.assertEqual(watcher.changes, 1)
+
+    def test_dcp_moved_vbuckets(self):
+        opts = Ditto({'extra': {'batch_max_size': 100, 'batch_max_bytes': 40000}, 'process_name': 'test'})
+        source = DCPStreamSource(opts, 'http://localhost:9112', {'name': 'default'},
+                                 {'version': '0.0.0-0000-enterprise', 'hostname': 'a'}, None, None, None,
+                                 defaultdict(int))
+        helper_class = DCPHelperClass()
+        end = struct.pack(cbcs.DCP_END_STREAM_PKT_FMT, cbcs.FLAG_DCP_END_STREAM_STATE_CHANGED)
+        done = struct.pack(cbcs.DCP_END_STREAM_PKT_FMT, cbcs.FLAG_DCP_END_STREAM_OK)
+        # cmd, errcode, opaque, cas, keylen, extlen, data, datalen, dtype, bytes_read
+        helper_class._set_response([
+            (cbcs.CMD_DCP_REQUEST_STREAM, cbcs.ERR_NOT_MY_VBUCKET, 5, 0, 0, 0, b'', 0, 0, 24),
+            (cbcs.CMD_DCP_END_STREAM, 0, 6, 0, 0, len(end), end, len(end), 0, 28),
+            (cbcs.CMD_DCP_END_STREAM, 0, 7, 0, 0, len(done), done, len(done), 0, 28),
+        ])
+        source.stream_list = {5: None, 6: None, 7: None}
+        source.response = helper_class
+        source.dcp_conn = helper_class
+        error, batch = source.provide_dcp_batch_actual()
+        self.assertEqual(error, 0)
+        self.assertTrue(source.dcp_done)
+        self.assertEqual(source.moved_vbuckets, [5, 6])
+        self.assertEqual(source.cur['tot_source_vbucket_moved'], 2)
+
+    def test_follow_moves(self):
+        opts = Ditto({'extra': {'count': 0, 'report': 0, 'report_full': 0, 'topology_interval': 60}, 'verbose': 0,
+                      'threads': 2, 'processes': False})
+        station = PumpingStation(opts, MovingSource, 'count:', CountSink, 'count:')
+        station.ctl['run_msg'] = 0
+        station.ctl['tot_msg'] = 0
+        self.assertEqual(station.init_checkpoint(), 0)
+        station.checkpoint.update('default', 'a', {3: 42}, {}, {3: (42, 42)})
+        station.start_workers(2)
+        transfer = station.begin_bucket({'name': 'default'}, {}, {}, 1)
+        station.put_unit(({'name': 'default', 'rev': 1}, {'hostname': 'a'}, {}, {},
+                          {'source': False, 'sink': False}, (0, None)))
+        with unittest.mock.patch.object(PumpingStation, 'FOLLOW_WAIT', 0):
+            self.assertIs(station.wait_for_bucket([transfer]), transfer)
+        station.end_bucket(transfer)
+        self.assertEqual(station.ctl['rv'], 0)
+        self.assertEqual(sorted(transfer.moves), [(3, 'a', 'b'), (4, 'a', None)])
+        # The moved vbucket was streamed on its new node from its recorded seqno.
+        self.assertIn(('b', [3], {'3': 42}), MovingSource.ranges)
+
+    def test_follow_moves_deferred(self):
+        opts = Ditto({'extra': {'count': 0, 'report': 0, 'report_full': 0, 'topology_interval': 60}, 'verbose': 0,
+                      'threads': 2, 'processes': False})
+        station = PumpingStation(opts, MovingSource, 'count:', CountSink, 'count:')
+        station.ctl['run_msg'] = 0
+        station.ctl['tot_msg'] = 0
+        self.assertEqual(station.init_checkpoint(), 0)
+        station.start_workers(2)
+        transfer = station.begin_bucket({'name': 'default'}, {}, {}, 1)
+        item = ({'name': 'default', 'rev': 1}, {'hostname': 'a'}, {}, {}, {'source': False, 'sink': False}, (0, [4]))
+        with station.units_done:
+            station.units_outstanding += 1
+            transfer.units_outstanding += 1
+        with unittest.mock.patch.object(PumpingStation, 'FOLLOW_WAIT', 0.2), \
+                unittest.mock.patch.object(PumpingStation, 'FOLLOW_ATTEMPTS', 3):
+            start = time.monotonic()
+            # Vbucket 4 never shows up on another node; the config is polled
+            # again on a timer rather than by the thread merging results.
+            station.unit_done((0, {}, [4]), item)
+            self.assertLess(time.monotonic() - start, 0.2)
+            self.assertIs(station.wait_for_bucket([transfer]), transfer)
+            self.assertGreaterEqual(time.monotonic() - start, 0.4)
+        station.end_bucket(transfer)
+        self.assertEqual(transfer.moves, [(4, 'a', None)])
+
+
+class TestChecksum(unittest.TestCase):
+    def make_batch(self, msgs):
+        batch = Batch(None)
+        for msg in msgs:
+            batch.append(msg, len(msg[7]))
+        return batch
+
+    def test_batch_digests(self):
+        msgs = make_msgs(4) + [(cbcs.CMD_DCP_MUTATION, 1, b'K', 0, 0, 7, b'\x00' * 8, b'V' * 40, 9, 0, 0, 0)]
+        digests = {}
+        pump_checksum.batch_digests(self.make_batch(msgs), digests)
+        self.assertEqual(sorted(digests), [0, 1])
+
+        # Neither order, compression nor deletions change the digests.
+        compressed = (cbcs.CMD_DCP_MUTATION, 1, b'K', 0, 0, 7, b'\x00' * 8, snappy.compress(b'V' * 40), 9,
+                      cbcs.DATATYPE_COMPRESSED, 0, 0)
+        deletion = (cbcs.CMD_DCP_DELETE, 0, b'KEY:0', 0, 0, 0, b'', b'', 10, 0, 0, 0)
+        reordered = {}
+        pump_checksum.batch_digests(self.make_batch([compressed, deletion] + list(reversed(msgs[:4]))), reordered)
+        self.assertEqual(reordered, digests)
+
+        changed = {}
+        pump_checksum.batch_digests(self.make_batch(msgs[:3] + [msgs[3][:7] + (b'OTHER',) + msgs[3][8:]]), changed)
+        self.assertEqual(pump_checksum.compare(digests, changed), [(0, digests[0], changed[0]), (1, digests[1], 0)])
+
+    def test_backup_round_trip(self):
+        msgs = make_msgs(3)
+        batch = self.make_batch(msgs)
+        digests = {}
+        pump_checksum.batch_digests(batch, digests)
+        opts = Ditto({'extra': {'batch_max_size': 100, 'batch_max_bytes': 40000}})
+        bucket = {'name': 'default', 'nodes': [{'hostname': 'node1'}]}
+        with tempfile.TemporaryDirectory() as tmp:
+            sink = BFDSink(opts, tmp, bucket, bucket['nodes'][0], {'buckets': [bucket]}, None,
+                           {'stop': False, 'new_session': True, 'new_timestamp': '1996-10-07T070000Z'},
+                           {'seqno': {}, 'failoverlog': {}, 'snapshot': {}})
+            rv, future = sink.consume_batch_async(batch)
+            self.assertEqual(rv, 0)
+            self.assertEqual(future.wait_until_consumed(), 0)
+            sink.close()
+            sink.record_digests(digests)
+            sink.record_digests(digests)
+            self.assertEqual(BFDSource.provide_digests(opts, tmp, bucket, None),
+                             (0, {0: (digests[0] * 2) & pump_checksum.DIGEST_MASK}))
+            meta = BFD.read_meta(sink.digest_dir)
+            self.assertEqual(meta['version'], '0.0.0')
+
+            # Reading the backup back gives the documents' digests again.
+            source = BFDSource(opts, tmp, bucket, bucket['nodes'][0], None, None, None, defaultdict(int))
+            rv, read = source.provide_batch()
+            self.assertEqual(rv, 0)
+            read_digests = {}
+            pump_checksum.batch_digests(read, read_digests)
+            self.assertEqual(read_digests, digests)
+
+    def test_verify(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'checksums.json')
+            opts = Ditto({'extra': {'checksum': 1, 'checksum_file': path}, 'verbose': 0})
+            station = PumpingStation(opts, CountSource, 'count:', CountSink, 'count:')
+            station.digests.add('default', {0: 5, 3: 7})
+            self.assertEqual(station.check_digests({'name': 'default'}, {}), 0)
+
+            opts.verify = True
+            station = PumpingStation(opts, CountSource, 'count:', pump.DigestSink, 'verify:')
+            station.digests.add('default', {0: 5, 3: 8})
+            self.assertEqual(station.check_digests({'name': 'default'}, {}),
+                             'error: bucket: default differs from its transfer in vbuckets: [3]')
+            self.assertEqual(station.check_digests({'name': 'other'}, {}),
+                             'error: no checksums were recorded for bucket: other; give the checksum_file of its '
+                             'transfer')
+            station.digests.add('default', {3: pump_checksum.DIGEST_MASK})
+            self.assertEqual(station.check_digests({'name': 'default'}, {}), 0)
+
+
+class BarrierSource(CountSource):
+    """Source whose first batch waits for the units of another bucket."""
+    barrier = None
+
+    def provide_batch(self):
+        if self.remaining:
+            BarrierSource.barrier.wait(2)
+        return super(BarrierSource, self).provide_batch()
+
+
+class TestBucketConcurrency(unittest.TestCase):
+    def run_buckets(self, concurrency):
+        opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0, 'data_only': 1, 'topology_interval': 0,
+                                'bucket_concurrency': concurrency},
+                      'verbose': 0, 'threads': 2, 'processes': False})
+        BarrierSource.barrier = threading.Barrier(2)
+        station = PumpingStation(opts, BarrierSource, 'count:', CountSink, 'count:')
+        buckets = [{'name': name, 'nodes': [{'hostname': 'a'}]} for name in ['b1', 'b2', 'b3', 'b4']]
+        try:
+            rv = station.transfer_buckets(buckets, {}, {})
+        finally:
+            station.stop_workers()
+        return rv, station
+
+    def test_concurrent_buckets(self):
+        with unittest.mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            rv, station = self.run_buckets(2)
+        self.assertEqual(rv, 0)
+        self.assertEqual(station.cur['tot_sink_msg'], 20)
+        self.assertEqual(station.transfers, {})
+        # Each bucket reports on its own msgs, while others are transferring.
+        reports = [line.split() for line in stderr.getvalue().splitlines() if line.startswith(' byte ')]
+        self.assertEqual([report[2] for report in reports], ['25'] * 4)
+
+    def test_one_bucket_at_a_time(self):
+        rv, station = self.run_buckets(1)
+        self.assertEqual(rv, 'error: worker failed: ')
+        self.assertEqual(station.transfers, {})
+
+    def test_bucket_map(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'buckets.json')
+            with open(path, 'w') as f:
+                json.dump({'old': 'new'}, f)
+            rv, renames = pump.load_bucket_map(path)
+            self.assertEqual(rv, 0)
+            opts = Ditto({'bucket_source': None, 'bucket_destination': None, 'bucket_renames': renames})
+            self.assertEqual(pump.bucket_opts(opts, b'old').bucket_destination, 'new')
+            self.assertEqual(pump.bucket_opts(opts, 'other').bucket_destination, 'other')
+            self.assertEqual(pump.bucket_opts(opts, 'other').bucket_source, 'other')
+            self.assertIsNone(opts.bucket_source)
+
+            with open(path, 'w') as f:
+                json.dump(['old', 'new'], f)
+            self.assertEqual(pump.load_bucket_map(path)[0],
+                             f'error: bucket_map file: {path} must map source bucket names to destination bucket names')
+
+
+class DesignSource(BarrierSource):
+    @staticmethod
+    def provide_design(opts, source_spec, source_bucket, source_map):
+        return 0, '{"_id": "_design/d"}'
+
+
+class OverlapSink(CountSink):
+    """Sink whose design docs are consumed alongside the msgs, and which
+       only takes the msgs once it has the design doc."""
+    threads = []
+
+    @staticmethod
+    def overlap_metadata(opts):
+        return True
+
+    @staticmethod
+    def consume_design(opts, sink_spec, sink_map, source_bucket, source_map, source_design):
+        OverlapSink.threads.append(threading.current_thread().name)
+        BarrierSource.barrier.wait(2)
+        return 0
+
+
+class TestMetadataOverlap(unittest.TestCase):
+    def test_overlap(self):
+        opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0, 'topology_interval': 0},
+                      'verbose': 0, 'threads': 1, 'processes': False})
+        BarrierSource.barrier = threading.Barrier(2)
+        OverlapSink.threads = []
+        station = PumpingStation(opts, DesignSource, 'count:', OverlapSink, 'count:')
+        try:
+            rv = station.transfer_buckets([{'name': 'default', 'nodes': [{'hostname': 'a'}]}], {}, {})
+        finally:
+            station.stop_workers()
+        self.assertEqual(rv, 0)
+        self.assertEqual(OverlapSink.threads, ['metadata'])
+        self.assertEqual(station.cur['tot_sink_msg'], 5)
+
+    def test_defer_index_build(self):
+        opts = Ditto({'extra': {'defer_index_build': 1}, 'username': 'u', 'password': 'p', 'username_dest': None,
+                      'password_dest': None, 'ssl': False, 'no_ssl_verify': False, 'cacert': None})
+        definitions = {'definitions': [{'name': 'ix1', 'deferred': False}, {'name': 'ix2'}]}
+        with unittest.mock.patch('pump_cb.ClusterManager') as cluster_manager:
+            cluster_manager.return_value.restore_index_metadata.return_value = (None, None)
+            rv = CBSink.consume_index(opts, 'http://localhost:8091', {'buckets': [{'name': 'default'}]},
+                                      {'name': 'default'}, {}, json.dumps(definitions))
+            self.assertIsNone(rv)
+            _, restored = cluster_manager.return_value.restore_index_metadata.call_args[0]
+        self.assertEqual([d['deferred'] for d in restored['definitions']], [True, True])
+
+
+class EstimateSource(CountSource):
+    """Estimates only once every node's estimate has started."""
+    barrier = threading.Barrier(2)
+
+    @staticmethod
+    def total_msgs(opts, source_bucket, source_node, source_map):
+        if source_node['hostname'] == 'c':
+            return 'error: no stats', None
+        EstimateSource.barrier.wait(2)
+        return 0, opts.extra['count']
+
+
+class TestEstimates(unittest.TestCase):
+    def test_concurrent_estimates(self):
+        opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0, 'data_only': 1, 'topology_interval': 0},
+                      'verbose': 0, 'threads': 2, 'processes': False})
+        EstimateSource.barrier = threading.Barrier(2)
+        station = PumpingStation(opts, EstimateSource, 'count:', CountSink, 'count:')
+        nodes = [{'hostname': host} for host in ['a', 'b', 'c']]
+        try:
+            rv = station.transfer_buckets([{'name': 'default', 'nodes': nodes}], {}, {})
+        finally:
+            station.stop_workers()
+        self.assertEqual(rv, 0)
+        self.assertEqual(station.ctl['tot_msg'], 10)
+        self.assertEqual(station.cur['tot_sink_msg'], 15)
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_budget(self):
+        budget = pump_memory.MemoryBudget(100)
+        self.assertTrue(budget.acquire(60, 0))
+        self.assertFalse(budget.acquire(60, 0))
+        budget.charge(60)
+        self.assertEqual(budget.usage(), (120, 120, 100))
+        budget.release(120)
+        # A request larger than the budget is granted once nothing is held.
+        self.assertTrue(budget.acquire(500, 0))
+        budget.release(500)
+        self.assertEqual(budget.usage(), (0, 500, 100))
+
+    def test_lease(self):
+        budget = pump_memory.MemoryBudget(1000)
+        lease = pump_memory.Lease(budget, lambda: False, chunk=100)
+        self.assertTrue(lease.take(10))
+        self.assertEqual(budget.usage()[0], 100)
+        self.assertTrue(lease.take(150))
+        self.assertEqual(budget.usage()[0], 200)
+        lease.give(100)
+        self.assertEqual(budget.usage()[0], 200)
+        # Once everything buffered is given back, so is the unused chunk.
+        lease.give(60)
+        self.assertEqual(budget.usage()[0], 0)
+        self.assertTrue(lease.take(10))
+        stopped = pump_memory.Lease(budget, lambda: True, chunk=1000)
+        self.assertFalse(stopped.take(1000))
+        lease.close()
+        self.assertEqual(budget.usage()[0], 0)
+        self.assertEqual(budget.idle, 0)
+        self.assertFalse(lease.take(1))
+
+    def test_idle_leases(self):
+        budget = pump_memory.MemoryBudget(512 * 1024)
+        leases = [pump_memory.Lease(budget, lambda: False) for _ in range(3)]
+        for lease in leases[:2]:
+            self.assertTrue(lease.take(1000))
+            lease.give(1000)
+        # Drained leases hold none of the budget, so a document bigger than a
+        # lease's chunk doesn't wait on them.
+        self.assertEqual(budget.usage()[0], 0)
+        self.assertTrue(leases[2].take(300 * 1024))
+        leases[2].give(300 * 1024)
+
+        # Neither does it wait on the unused bytes of leases still buffering.
+        for lease in leases[:2]:
+            self.assertTrue(lease.take(1000))
+        self.assertEqual(budget.usage()[0], 512 * 1024)
+        self.assertTrue(leases[2].take(300 * 1024))
+        for lease in leases:
+            lease.close()
+        self.assertEqual(budget.usage()[0], 0)
+        self.assertEqual(budget.idle, 0)
+
+        # Without room for a whole chunk, a lease waits for just what it needs.
+        budget.charge(400 * 1024)
+        self.assertTrue(pump_memory.Lease(budget, lambda: False).take(1000))
+        self.assertEqual(budget.usage()[0], 400 * 1024 + 1000)
+
+    def test_transfer_within_budget(self):
+        opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0, 'data_only': 1, 'topology_interval': 0,
+                                'batch_max_size': 1, 'inflight_batches': 4, 'memory_budget': 1},
+                      'verbose': 0, 'threads': 2, 'processes': False})
+        station = PumpingStation(opts, CountSource, 'count:', CountSink, 'count:')
+        nodes = [{'hostname': host} for host in ['a', 'b']]
+        try:
+            rv = station.transfer_buckets([{'name': 'default', 'nodes': nodes}], {}, {})
+        finally:
+            station.stop_workers()
+        self.assertEqual(rv, 0)
+        self.assertEqual(station.cur['tot_sink_msg'], 10)
+        used, peak, _ = station.memory.usage()
+        self.assertEqual(used, 0)
+        self.assertGreater(peak, 0)
+
+
+class TestMsgFilter(unittest.TestCase):
+    def test_no_filter(self):
+        self.assertEqual(pump_filter.MsgFilter.from_opts(Ditto({})), (0, None))
+        source = Source(Ditto({}), 'count:', {}, {}, {}, {}, {}, defaultdict(int))
+        self.assertFalse(source.skip(b'k', 0))
+
+    def test_filters(self):
+        rv, msg_filter = pump_filter.MsgFilter.from_opts(Ditto({'key': '^a', 'key_prefix': ['ab', 'ac'],
+                                                                'vbucket_ids': '0-3,9', 'skip_deleted': True,
+                                                                'skip_expired': True}))
+        self.assertEqual(rv, 0)
+        self.assertEqual(msg_filter.vbucket_ids, frozenset([0, 1, 2, 3, 9]))
+        self.assertIsNone(msg_filter.skip(b'abc', 2, cbcs.CMD_DCP_MUTATION, 0))
+        self.assertIsNone(msg_filter.skip('acd', 9))
+        self.assertEqual(msg_filter.skip(b'ad', 2), pump_filter.SKIP_KEY)
+        self.assertEqual(msg_filter.skip(b'abc', 4), pump_filter.SKIP_VBUCKET)
+        self.assertIsNone(msg_filter.skip(b'abc', pump_filter.UNKNOWN_VBUCKET))
+        self.assertEqual(msg_filter.skip(b'abc', 2, cbcs.CMD_DCP_DELETE), pump_filter.SKIP_DELETED)
+        self.assertEqual(msg_filter.skip(b'abc', 2, cbcs.CMD_DCP_MUTATION, int(time.time()) - 10),
+                         pump_filter.SKIP_EXPIRED)
+        self.assertIsNone(msg_filter.skip(b'abc', 2, cbcs.CMD_DCP_MUTATION, 60))
+
+    def test_unknown_vbucket(self):
+        # Msgs of sources without vbuckets, such as CSV, are filtered by the
+        # vbucket their key hashes to in a cluster sink's bucket.
+        sink_map = {'buckets': [{'vBucketServerMap': {'vBucketMap': [[0]] * 1024}}]}
+        self.assertEqual(pump_filter.sink_vbuckets_num(sink_map), 1024)
+        self.assertEqual(pump_filter.sink_vbuckets_num(None), 0)
+        vbucket_id = hash_vbucket_ids([b'abc'], 1024)[0]
+        source = Source(Ditto({'id': vbucket_id}), 'csv:', {}, {}, {}, sink_map, {}, defaultdict(int))
+        self.assertFalse(source.skip('abc', pump_filter.UNKNOWN_VBUCKET))
+        self.assertTrue(source.skip(b'abd', pump_filter.UNKNOWN_VBUCKET))
+        self.assertEqual(source.cur[pump_filter.SKIP_VBUCKET], 1)
+
+    def test_collections(self):
+        rv, msg_filter = pump_filter.MsgFilter.from_opts(Ditto({'collection_ids': '8-a', 'collection': ['8'],
+                                                                'key_prefix': ['k']}))
+        self.assertEqual(rv, 0)
+        self.assertIsNone(msg_filter.skip(encode_collection_id(9) + b'key', 0))
+        self.assertEqual(msg_filter.skip(encode_collection_id(0) + b'key', 0), pump_filter.SKIP_COLLECTION)
+        self.assertEqual(msg_filter.skip(encode_collection_id(8) + b'other', 0), pump_filter.SKIP_KEY)
+
+    def test_bad_options(self):
+        self.assertEqual(pump.EndPoint.check_base(Ditto({'key': '('}), 'count:'),
+                         'error: could not parse key regexp: (')
+        self.assertEqual(pump.EndPoint.check_base(Ditto({'vbucket_ids': '5-1'}), 'count:'),
+                         'error: could not parse vbucket ids: 5-1')
+
+    def test_skips_counted(self):
+        cur = defaultdict(int)
+        source = Source(Ditto({'id': 1}), 'count:', {}, {}, {}, {}, {}, cur)
+        self.assertTrue(source.skip(b'k', 0))
+        self.assertFalse(source.skip(b'k', 1))
+        self.assertTrue(source.skip(b'k', 2))
+        self.assertEqual(cur[pump_filter.SKIP_VBUCKET], 2)
+        self.assertEqual(pump_filter.skip_counts(cur), 'vbucket: 2')
+
+
+class TestBlackholeSink(unittest.TestCase):
+    def test_blackhole(self):
+        self.assertTrue(pump.BlackholeSink.can_handle(None, 'blackhole://'))
+        opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0, 'data_only': 1, 'topology_interval': 0,
+                                'inflight_batches': 2},
+                      'verbose': 0, 'threads': 2, 'processes': False})
+        station = PumpingStation(opts, CountSource, 'count:', pump.BlackholeSink, 'blackhole://')
+        nodes = [{'hostname': host} for host in ['a', 'b', 'c']]
+        try:
+            rv = station.transfer_buckets([{'name': 'default', 'nodes': nodes}], {}, {})
+        finally:
+            station.stop_workers()
+        self.assertEqual(rv, 0)
+        self.assertEqual(station.cur['tot_sink_msg'], 15)
+        self.assertEqual(station.cur['tot_sink_batch'], 3)
+
+
+class TestProfile(unittest.TestCase):
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0, 'data_only': 1,
+                                    'topology_interval': 0, 'inflight_batches': 1, 'profile': tmp,
+                                    'profile_interval': 0.001},
+                          'verbose': 0, 'threads': 2, 'processes': False})
+            station = PumpingStation(opts, CountSource, 'count:', pump.BlackholeSink, 'blackhole://')
+            nodes = [{'hostname': host} for host in ['a:8091', 'b:8091']]
+            try:
+                rv = station.transfer_buckets([{'name': 'my bucket', 'nodes': nodes}], {}, {})
+            finally:
+                station.stop_workers()
+                pump_profile.stop_sampler()
+            self.assertEqual(rv, 0)
+            for host in ['a%3A8091', 'b%3A8091']:
+                files = os.listdir(os.path.join(tmp, 'bucket-my+bucket', f'node-{host}'))
+                self.assertEqual(len([f for f in files if f.startswith('worker-w')]), 1)
+                self.assertEqual(len([f for f in files if f.startswith('sink-s')]), 1)
+                self.assertIn(f'stacks-{os.getpid()}.collapsed', files)
+
+    def test_collapse(self):
+        def inner():
+            return pump_profile.collapse('worker', sys._getframe())
+        stack = inner()
+        self.assertTrue(stack.startswith('worker;'))
+        self.assertTrue(stack.endswith(';test_pumps.py:test_collapse;test_pumps.py:inner'))
+
+
+class TestAsyncEngine(unittest.TestCase):
+    def transfer(self, sink_class):
+        opts = Ditto({'extra': {'count': 5, 'report': 0, 'report_full': 0, 'data_only': 1, 'topology_interval': 0,
+                                'inflight_batches': 2, 'engine': 'async', 'async_loops': 2, 'async_units': 0},
+                      'verbose': 0, 'threads': 2, 'processes': False})
+        station = PumpingStation(opts, CountSource, 'count:', sink_class, 'blackhole://')
+        nodes = [{'hostname': host} for host in ['a', 'b', 'c']]
+        try:
+            rv = station.transfer_buckets([{'name': 'default', 'nodes': nodes}], {}, {})
+        finally:
+            station.stop_workers()
+        self.assertEqual(rv, 0)
+        self.assertEqual(station.cur['tot_sink_msg'], 15)
+        self.assertEqual(station.cur['tot_sink_batch'], 3)
+
+    def test_loop_sink(self):
+        self.transfer(pump.BlackholeSink)
+
+    def test_worker_sink(self):
+        self.transfer(CountSink)
+
+    def test_recv_msgs_async(self):
+        sink = MCSink(Ditto({'extra': {'engine': 'async'}}), 'localhost:9878', None, None, None,
+                      {'buckets': ['default']}, {'stop': False}, defaultdict(int))
+        self.assertIsNone(sink.worker)
+        msgs = [(cbcs.CMD_DCP_MUTATION, 0, f'KEY:{i}'.encode(), 0, 0, 0, b'', b'VAL', 0, 0, 0, 0) for i in range(3)]
+        ours, theirs = socket.socketpair()
+        ours.setblocking(False)
+        responses = b''.join(struct.pack(cbcs.RES_PKT_FMT, cbcs.RES_MAGIC_BYTE, cbcs.CMD_SET, 0, 0, 0,
+                                         cbcs.ERR_SUCCESS, len(b'body'), i, 0) + b'body' for i in range(3))
+
+        async def recv():
+            loop = asyncio.get_running_loop()
+            # The responses arrive split across packets.
+            loop.call_later(0.01, theirs.sendall, responses[:30])
+            loop.call_later(0.02, theirs.sendall, responses[30:])
+            return await sink.recv_msgs_async(Ditto({'s': ours, 'host': 'localhost', 'port': 9878}), msgs, [])
+        try:
+            self.assertEqual(asyncio.run(recv()), (0, False, False))
+        finally:
+            ours.close()
+            theirs.close()
+
+    def test_dcp_reads_on_loop(self):
+        class LoopConn(DCPHelperClass):
+            def __init__(self, sock):
+                super().__init__([])
+                self.s = sock
+
+            def audit(self, event, body):
+                pass
+
+            def close(self):
+                self.s.close()
+
+        opts = Ditto({'extra': {'batch_max_size': 100, 'batch_max_bytes': 40000, 'max_retry': 0},
+                      'process_name': 'test', 'ssl': False})
+        source = DCPStreamSource(opts, 'http://localhost:9112', {'name': 'default'},
+                                 {'hostname': 'localhost:8091', 'version': '0.0.0-0000-enterprise'}, None, None,
+                                 None, defaultdict(int))
+        self.assertTrue(source.reads_on_loop())
+        ours, theirs = socket.socketpair()
+        source.dcp_conn = LoopConn(ours)
+        source.loop_buffer = RecvBuffer(4096, 64)
+        source.node_vbucket_map = [0]
+        source.stream_list = {0: (0, 0, 0, 3, 0, 0, 0)}
+
+        def packet(opcode, extra, key=b'', value=b''):
+            body = extra + key + value
+            return struct.pack(cbcs.RES_PKT_FMT, cbcs.RES_MAGIC_BYTE, opcode, len(key), len(extra), 0, 0,
+                               len(body), 0, 0) + body
+
+        mutations = b''.join(packet(cbcs.CMD_DCP_MUTATION, struct.pack(cbcs.DCP_MUTATION_PKT_FMT, i, 1, 0, 0, 0, 0, 0),
+                                    f'KEY:{i}'.encode(), b'VAL') for i in range(1, 4))
+        end = packet(cbcs.CMD_DCP_END_STREAM, struct.pack(cbcs.DCP_END_STREAM_PKT_FMT, 0))
+
+        async def provide():
+            loop = asyncio.get_running_loop()
+            # The responses arrive split across packets, while the loop waits.
+            loop.call_later(0.01, theirs.sendall, mutations[:50])
+            loop.call_later(0.02, theirs.sendall, mutations[50:] + end)
+            keys = []
+            while True:
+                rv, batch = await source.provide_batch_async()
+                self.assertEqual(rv, 0)
+                if not batch:
+                    return keys
+                keys += [msg[2] for msg in batch.msgs]
+        try:
+            self.assertEqual(asyncio.run(provide()), [b'KEY:1', b'KEY:2', b'KEY:3'])
+        finally:
+            ours.close()
+            theirs.close()
+        self.assertTrue(source.dcp_done)
+        self.assertIsNone(source.dcp_conn)
+        # No reader thread was started.
+        self.assertIsNone(source.ident)